@@ -11,7 +11,7 @@ from scipy.linalg import lstsq, eig
 from scipy.stats import qmc
 from scipy.spatial.distance import pdist, cdist, squareform
 from scipy.optimize import Bounds
-from utils.sutils import linear, quadratic, quadraticSolve, quadraticSolveHOnly, symMatfromVec, maxEigenEstimate, boxIntersect
+from utils.sutils import linear, quadratic, quadraticSolve, quadraticSolveHOnly, symMatfromVec, maxEigenEstimate, boxIntersect, convert_to_smt_grads
 
 
 # Hessian estimation to generate an anisotropic mapping of the space
@@ -38,6 +38,7 @@ class AnisotropicRefine(ASCriteria):
         super().__init__(model, **kwargs)
 
         self.supports["obj_derivatives"] = True  
+        self.supports["batch_eval"] = True
         
     def _init_options(self):
         #options: neighborhood, surrogate, exact
@@ -198,9 +199,9 @@ class AnisotropicRefine(ASCriteria):
         if(self.options["objective"] == "mvar"):
             self.vmodel = KRG(
                 metric_warp=metric, 
-                corr=model.options["corr"], 
-                poly=model.options["poly"],
-                n_start=model.options["n_start"],
+                corr=self.model.options["corr"], 
+                poly=self.model.options["poly"],
+                n_start=self.model.options["n_start"],
                 print_global=False)
             self.vmodel.set_training_values(trx, trf)
             self.vmodel.train()
@@ -221,64 +222,36 @@ class AnisotropicRefine(ASCriteria):
         trf = self.model.training_points[None][0][1]
         m, n = trx.shape
 
-        N = self.numer
+        X = np.atleast_2d(x)
         C = 5.
 
         if(self.options["objective"] == "mvar"):
-            ans = self.vmodel.predict_variances(np.array([x]))
+            ans = self.vmodel.predict_variances(X)[:,0]
         else:
-            sum = np.zeros(m)
-            mwork = self.mmodel.predict_values(np.array([x]))
-            for i in range(m):
-                work = x-trx[i]
-                #sum += 1./(np.sqrt(np.matmul(np.matmul(work, mwork), work)**2) + 1e-10)
-                dist = np.matmul(np.matmul(work, mwork), work)
-
-                if(self.options["objective"] == "inv"):
-                    sum[i] = N/(dist + 1e-10)
-                elif(self.options["objective"] == "geom"):
-                    sum[i] = N/(np.power(dist, n/2.)  + 1e-10)
-                elif(self.options["objective"] == "abs"):
-                    sum[i] = -dist
-                else:    
-                    sum[i] = np.exp(-np.sqrt(dist))
-
-            ans = np.sum(sum)/m
+            mwork = self.mmodel.predict_values(X)
+            dist = self._metric_dist(X, trx, mwork)
+            ans = np.sum(self._dist_objective(dist, n), axis=1)/m
         
         # only loop over previous batch, since we only have those gradients
         if(self.options["objerr"]):
             mg = self.grad.shape[0]
-            esum = np.zeros(mg)
+            esum = np.zeros(X.shape[0])
+            fhat = self.model.predict_values(X)[:,0]
             for i in range(mg):
-                work = x-trx[i]
-                fhat = self.model.predict_values(np.array([x]))
-                ft = linear(x, trx[i], trf[i], self.grad[i])
-                esum[i] = np.abs(fhat - ft)*np.exp(-np.linalg.norm(work)*C)
+                work = X-trx[i]
+                ft = trf[i] + np.dot(work, self.grad[i])
+                esum += np.abs(fhat - ft)*np.exp(-np.linalg.norm(work, axis=1)*C)
                 
             import pdb; pdb.set_trace()
-            ans -= np.sum(esum)
+            ans -= esum
         
         
         mb = 0
         if(self.options["bpen"]):
             #ATTEMPT 3
             mb, nb = self.bpts.shape
-            bsum = np.zeros(mb)
-            for i in range(mb):
-                work = x-self.bpts[i]
-                #sum += 1./(np.sqrt(np.matmul(np.matmul(work, mwork), work)**2) + 1e-10)
-                dist = np.matmul(np.matmul(work, mwork), work)
-
-                if(self.options["objective"] == "inv"):
-                    bsum[i] = N/(dist + 1e-10)
-                elif(self.options["objective"] == "geom"):
-                    bsum[i] = N/(np.power(dist, n/2.)  + 1e-10)
-                elif(self.options["objective"] == "abs"):
-                    bsum[i] = -dist
-                else:    
-                    bsum[i] = np.exp(-np.sqrt(dist))
-
-            ans += np.sum(bsum)/mb
+            dist = self._metric_dist(X, self.bpts, mwork)
+            ans += np.sum(self._dist_objective(dist, n), axis=1)/mb
 
         return ans 
 
@@ -289,102 +262,98 @@ class AnisotropicRefine(ASCriteria):
         trf = self.model.training_points[None][0][1]
         m, n = trx.shape
 
-        N = self.numer
+        X = np.atleast_2d(x)
         C = 5.
 
         if(self.options["objective"] == "mvar"):
             #ans = self.vmodel.predict_variances(x)
-            dsum = self.vmodel.predict_variance_derivatives(np.array([x]))
+            dsum = self.vmodel.predict_variance_derivatives(X)
         else:
-            sum = 0
-            sum = np.zeros(m)
-            mwork = self.mmodel.predict_values(np.array([x]))
-            dmwork = self.mmodel.predict_derivatives(np.array([x]))
-            dsum = np.zeros(n)
-            for i in range(m):
-                work = x-trx[i]
-
-                leftprod = np.matmul(work, mwork)
-                rightprod = np.matmul(mwork, work)
-                dist = np.matmul(leftprod, work)
-                ddist = np.zeros(n)
-                ddist += rightprod[0]
-                ddist += leftprod[0]
-
-                for j in range(n):
-                    ddist[j] += np.matmul(np.matmul(work, dmwork[0,j,:,:]), work)
-
-                if(self.options["objective"] == "inv"):
-                    sum[i] = N/(dist + 1e-10)    
-                    dsum += (-N/((dist + 1e-10)**2))*ddist/m# + dN/(dist + 1e-10)
-                elif(self.options["objective"] == "geom"):
-                    sum[i] = N/(np.power(dist, n/2.)  + 1e-10)
-                    dsum += (-N/((np.power(dist, n/2.) + 1e-10)**2))*((n/2.)*np.power(dist, n/2.-1.))*ddist/m
-                elif(self.options["objective"] == "abs"):
-                    sum[i] = -dist
-                    dsum += -ddist/m
-                else:
-                    sum[i] = np.exp(-np.sqrt(dist))
-                    dsum += np.exp(-np.sqrt(dist))*(-1./(2.*np.sqrt(dist)))*ddist/m
-
+            mwork = self.mmodel.predict_values(X)
+            dmwork = self.mmodel.predict_derivatives(X)
+            dist, ddist = self._metric_dist(X, trx, mwork, dmwork)
+            dsum = np.einsum('ij,ijk->ik', self._dist_objective(dist, n, deriv=True), ddist)/m
 
         # only loop over previous batch, since we only have those gradients
         if(self.options["objerr"]):
             mg = self.grad.shape[0]
-            esum = np.zeros(mg)
-            desum = np.zeros(n)
-            dfhat = np.zeros(n)
+            desum = np.zeros_like(X)
+            fhat = self.model.predict_values(X)[:,0]
+            dfhat = convert_to_smt_grads(self.model, X, deriv_predict=True)
             for i in range(mg):
-                work = x-trx[i]
-                fhat = self.model.predict_values(np.array([x]))
-                for j in range(self.dim):
-                    dfhat[j] = self.model.predict_derivatives(np.array([x]), j)
-                desum += np.abs(dfhat - self.grad[i])*np.exp(-np.linalg.norm(work)*C)
-                ft = linear(x, trx[i], trf[i], self.grad[i])
-                esum[i] = np.abs(fhat - ft)*np.exp(-np.linalg.norm(work)*C)
-                desum += esum[i]*(-C*x/np.linalg.norm(work))
+                work = X-trx[i]
+                wnorm = np.linalg.norm(work, axis=1)
+                efac = np.exp(-wnorm*C)
+                desum += np.abs(dfhat - self.grad[i])*efac[:,None]
+                ft = trf[i] + np.dot(work, self.grad[i])
+                esum = np.abs(fhat - ft)*efac
+                desum += esum[:,None]*(-C*X/wnorm[:,None])
                 
             dsum -= desum
 
         if(self.options["bpen"]):
             #ATTEMPT 3
             mb, nb = self.bpts.shape
-
-            N = self.numer
-
-            bsum = np.zeros(mb)
-            dbsum = np.zeros(nb)
-            for i in range(mb):
-                work = x-self.bpts[i]
-
-                leftprod = np.matmul(work, mwork)
-                rightprod = np.matmul(mwork, work)
-                dist = np.matmul(leftprod, work)
-                ddist = np.zeros(n)
-                ddist += rightprod[0]
-                ddist += leftprod[0]
-
-                for j in range(n):
-                    ddist[j] += np.matmul(np.matmul(work, dmwork[0,j,:,:]), work)
-
-                if(self.options["objective"] == "inv"):
-                    bsum[i] = N/(dist + 1e-10)    
-                    dbsum += (-N/((dist + 1e-10)**2))*ddist/mb
-                elif(self.options["objective"] == "geom"):
-                    bsum[i] = N/(np.power(dist, n/2.)  + 1e-10)
-                    dbsum += (-N/((np.power(dist, n/2.) + 1e-10)**2))*((n/2.)*np.power(dist, n/2.-1.))*ddist/mb
-                elif(self.options["objective"] == "abs"):
-                    bsum[i] = -dist
-                    dbsum += -ddist/mb
-                else:
-                    bsum[i] = np.exp(-np.sqrt(dist))
-                    dbsum += np.exp(-np.sqrt(dist))*(-1./(2.*np.sqrt(dist)))*ddist/mb
-
-            dsum += dbsum
+            dist, ddist = self._metric_dist(X, self.bpts, mwork, dmwork)
+            dsum += np.einsum('ij,ijk->ik', self._dist_objective(dist, n, deriv=True), ddist)/mb
 
         return dsum 
 
 
+    def _metric_dist(self, X, pts, mwork, dmwork=None):
+        """
+        Squared distances from each row of X to each of pts in the metric
+        evaluated at the rows of X, and their derivatives with respect to X
+
+        Parameters
+        ----------
+        X : np.ndarray[nt, n]
+        pts : np.ndarray[m, n]
+        mwork : np.ndarray[nt, n, n]
+            Metric at X
+        dmwork : np.ndarray[nt, n, n, n]
+            Metric derivatives at X, if the distance derivatives are needed
+
+        Returns
+        -------
+        dist : np.ndarray[nt, m]
+        ddist : np.ndarray[nt, m, n]
+        """
+        work = X[:,None,:] - pts[None,:,:]
+        leftprod = np.einsum('ijk,ikl->ijl', work, mwork)
+        dist = np.einsum('ijk,ijk->ij', leftprod, work)
+        if dmwork is None:
+            return dist
+
+        rightprod = np.einsum('ikl,ijl->ijk', mwork, work)
+        ddist = leftprod + rightprod + np.einsum('ijk,iqkl,ijl->ijq', work, dmwork, work)
+        return dist, ddist
+
+    def _dist_objective(self, dist, n, deriv=False):
+        """
+        Objective term for each metric distance, or its derivative with respect
+        to the distance
+        """
+        N = self.numer
+        obj = self.options["objective"]
+        if(obj == "inv"):
+            if deriv:
+                return -N/((dist + 1e-10)**2)
+            return N/(dist + 1e-10)
+        elif(obj == "geom"):
+            if deriv:
+                return (-N/((np.power(dist, n/2.) + 1e-10)**2))*((n/2.)*np.power(dist, n/2.-1.))
+            return N/(np.power(dist, n/2.)  + 1e-10)
+        elif(obj == "abs"):
+            if deriv:
+                return -np.ones_like(dist)
+            return -dist
+        else:
+            if deriv:
+                return np.exp(-np.sqrt(dist))*(-1./(2.*np.sqrt(dist)))
+            return np.exp(-np.sqrt(dist))
+
+
 
 
     def pre_asopt(self, bounds, dir=0):
@@ -1,5 +1,6 @@
 import numpy as np
 import copy
+import time
 
 from matplotlib import pyplot as plt
 from smt.utils.options_dictionary import OptionsDictionary
@@ -36,6 +37,7 @@ class AnisotropicTransform(ASCriteria):
         self.metric = None
         self.mmodel = None #POU model of the anisotropy metric
         self.sequence = init_sequence #Quasi Monte Carlo sequence for space-filling design
+        self.timings = {"solve":0., "nsolve":0, "iter":0} # accumulated neighborhood solve time, points mapped, Newton iterations
 
         super().__init__(model, **kwargs)
 
@@ -59,6 +61,9 @@ class AnisotropicTransform(ASCriteria):
 
         #number of closest points to match differential distance
         self.options.declare("nmatch", self.dim*2, types=int)
+
+        #options: newton (batched Gauss-Newton over all points), least_squares (scipy, one point at a time)
+        self.options.declare("solver", "newton", types=str)
         
     def initialize(self, model=None, grad=None):
 
@@ -291,9 +296,107 @@ class AnisotropicTransform(ASCriteria):
         # generate new point from the sequence
         xinew = self.sequence.random(1)
         xinew = qmc.scale(xinew, bounds[:,0], bounds[:,1])
-        nmatch = self.options["nmatch"]
 
         # find the corresponding anisotropic point
+        t0 = time.perf_counter()
+        if(self.options["solver"] == "newton"):
+            xnew = self.transform(xinew, bounds)[0]
+        else:
+            xnew = self._transform_lsq(xinew, bounds)
+        self.timings["solve"] += time.perf_counter() - t0
+        self.timings["nsolve"] += 1
+
+        self.trxi = np.append(self.trxi, xinew, axis=0)
+        self.trx = np.append(self.trx, np.array([xnew]), axis=0)
+
+        return xnew
+
+    def transform(self, xinew, bounds, maxiter=100, xtol=1e-10, ftol=1e-12):
+        """
+        Map points from the isotropic to the anisotropic space, such that their
+        metric distances to the nmatch closest existing points match the
+        isotropic distances, solving the least squares systems of all points
+        as one stacked Levenberg-Marquardt damped Gauss-Newton iteration
+
+        post_asopt still maps one point per call (B = 1), so the speedup over
+        _transform_lsq there comes from the solver, not from batching
+
+        Parameters
+        ----------
+        xinew : np.ndarray
+            isotropic points, (B, dim)
+        bounds : np.ndarray
+            bounds of the domain, the solutions are kept inside
+        maxiter : int
+            maximum number of iterations
+        xtol, ftol : float
+            step and relative residual reduction tolerance, points stop
+            iterating once either is met
+
+        Returns
+        -------
+        xnew : np.ndarray
+            anisotropic points, (B, dim)
+        """
+        xinew = np.atleast_2d(xinew)
+        B = xinew.shape[0]
+        nmatch = self.options["nmatch"]
+
+        # only existing points have a metric
+        nm = self.mmodel.shape[0]
+        dists = cdist(xinew, self.trxi[:nm])
+        ind = np.argsort(dists, axis=1)[:,0:nmatch]
+        work = xinew[:,None,:] - self.trxi[ind]
+        d2r = np.einsum('bki,bki->bk', work, work)
+        nbhdx = self.trx[ind]
+        M = self.mmodel[ind]
+
+        x = np.clip(copy.deepcopy(xinew), bounds[:,0], bounds[:,1])
+        res = get_residual_batch(x, d2r, nbhdx, M)
+        cost = np.einsum('bk,bk->b', res, res)
+        lam = np.full(B, 1e-3)
+        eye = np.eye(self.dim)
+        active = np.ones(B, dtype=bool)
+        for it in range(maxiter):
+            a = np.nonzero(active)[0]
+            if a.shape[0] == 0:
+                break
+            self.timings["iter"] += 1
+
+            J = get_res_jac_batch(x[a], nbhdx[a], M[a])
+            g = np.einsum('bki,bk->bi', J, res[a])
+
+            # freeze variables on a bound that the descent direction points out of
+            fixed = ((x[a] <= bounds[:,0]) & (g > 0.)) | ((x[a] >= bounds[:,1]) & (g < 0.))
+            J[fixed[:,None,:].repeat(nmatch, axis=1)] = 0.
+            g[fixed] = 0.
+
+            JTJ = np.einsum('bki,bkj->bij', J, J)
+            scl = np.einsum('bii->b', JTJ)/self.dim + 1e-30
+            A = JTJ + (lam[a]*scl)[:,None,None]*eye
+            step = -np.linalg.solve(A, g[:,:,None])[:,:,0]
+            xt = np.clip(x[a] + step, bounds[:,0], bounds[:,1])
+            rt = get_residual_batch(xt, d2r[a], nbhdx[a], M[a])
+            ct = np.einsum('bk,bk->b', rt, rt)
+
+            # accept improving steps and relax the damping, otherwise increase it
+            better = ct < cost[a]
+            dx = np.linalg.norm(xt - x[a], axis=1)
+            done = better & ((dx <= xtol*(xtol + np.linalg.norm(x[a], axis=1))) | (cost[a] - ct <= ftol*cost[a]))
+            done |= (cost[a] == 0.) | (lam[a] > 1e16) | (np.linalg.norm(g, axis=1) == 0.)
+
+            ab = a[better]
+            x[ab] = xt[better]
+            res[ab] = rt[better]
+            cost[ab] = ct[better]
+            lam[a] = np.where(better, lam[a]/3., lam[a]*4.)
+            active[a[done]] = False
+
+        return x
+
+    def _transform_lsq(self, xinew, bounds):
+        # single point version of transform, with scipy's least_squares
+        nmatch = self.options["nmatch"]
         dists = cdist(xinew, self.trxi)
         #dists = cdist(xinew, self.trx)
         ind = np.argsort(dists)
@@ -328,15 +431,9 @@ class AnisotropicTransform(ASCriteria):
             if(xnew[i] < bounds[i,0]):
                 xnew[i] = bounds[i,0]
 
-
-        self.trxi = np.append(self.trxi, xinew, axis=0)
-        self.trx = np.append(self.trx, np.array([results.x]), axis=0)
-
         return results.x
 
 
-
-
 def get_residual(x, xinew, nbhdx, nbhdxi, M, nmatch):
     d2r = np.zeros(nmatch)
     d2l = np.zeros(nmatch)
@@ -348,6 +445,19 @@ def get_residual(x, xinew, nbhdx, nbhdxi, M, nmatch):
     res = d2r - d2l
     return res
         
+def get_residual_batch(x, d2r, nbhdx, M):
+    # stacked get_residual, x (B, dim), d2r (B, nmatch), nbhdx (B, nmatch, dim), M (B, nmatch, dim, dim)
+    workx = x[:,None,:] - nbhdx
+    d2l = np.einsum('bki,bkij,bkj->bk', workx, M, workx)
+    res = d2r - d2l
+    return res
+
+def get_res_jac_batch(x, nbhdx, M):
+    # stacked get_res_jac, (B, nmatch, dim)
+    workx = x[:,None,:] - nbhdx
+    dres = -2*np.einsum('bki,bkij->bkj', workx, M)
+    return dres
+
 def get_res_jac(x, xinew, nbhdx, nbhdxi, M, nmatch):
     # no dependence on rhs
     d2l = np.zeros(nmatch)
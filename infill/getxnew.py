@@ -6,10 +6,11 @@ import numpy as np
 from smt.surrogate_models import GEKPLS
 from surrogate.direct_gek import DGEK
 from scipy.stats import qmc
+from smt.sampling_methods import LHS
 from surrogate.pougrad import POUSurrogate
 from utils.error import rmse, meane, full_error
-from utils.sutils import convert_to_smt_grads, print_mpi
-import pickle, os, sys
+from utils.sutils import convert_to_smt_grads, print_mpi, divide_cases, gather_cases
+import pickle, os, sys, time
 
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
@@ -75,6 +76,10 @@ def getxnew(rcrit, bounds, batch, x_init=None, options=None):
         dy = rcrit.eval_grad(x_eff, bounds, dir)
         return dy[0,sub_ind]
 
+    # pick the whole batch from one batched evaluation of the criteria
+    if(options.get("batch_mode", "sequential") == "joint" and rcrit.opt and rcrit.supports.get("joint_batch", False)):
+        return _getxnew_joint(rcrit, bounds, batch, sub_ind, fix_ind, xfix, options)
+
     # loop over batch
     for i in range(batch):
         rx = None
@@ -95,15 +100,37 @@ def getxnew(rcrit, bounds, batch, x_init=None, options=None):
 
                 # proper multistart
                 if(options["multistart"] == 2):
-                    resx = np.zeros([m,n_u])
-                    resy = np.zeros(m)
-                    succ = np.full(m, True)
-                    for j in range(m):
-                        
-                        results = optimize(eval_eff, args=args, bounds=unit_bounds[sub_ind,:], type="local", constraints=rcrit.condict, jac=jac, x0=x0[j,sub_ind])
-                        resx[j,:] = results.x
-                        resy[j] = results.fun
-                        succ[j] = results.success
+                    # split the starts over procs, each evaluating the criteria on its own
+                    par_starts = size > 1 and m > 1 and options.get("parallel_multistart", True) and rcrit.supports.get("serial_eval", False)
+                    nprocs = size if par_starts else 1
+                    cases = divide_cases(m, nprocs)
+                    mycases = cases[rank] if par_starts else cases[0]
+
+                    # x, fun, success, time
+                    res = np.zeros([m, n_u + 3])
+                    if par_starts:
+                        rcrit.set_serial_eval(True)
+                    try:
+                        for j in mycases:
+                            ts = time.perf_counter()
+                            results = optimize(eval_eff, args=args, bounds=unit_bounds[sub_ind,:], type="local", constraints=rcrit.condict, jac=jac, x0=x0[j,sub_ind])
+                            res[j,:n_u] = results.x
+                            res[j,n_u] = results.fun
+                            res[j,n_u+1] = results.success
+                            res[j,n_u+2] = time.perf_counter() - ts
+                    finally:
+                        if par_starts:
+                            rcrit.set_serial_eval(False)
+                    if par_starts:
+                        res = gather_cases(res[mycases], cases)
+
+                    resx = res[:,:n_u]
+                    resy = res[:,n_u]
+                    succ = res[:,n_u+1].astype(bool)
+                    rcrit.multistart_times = res[:,n_u+2]
+                    if(rcrit.options["print_iter"]):
+                        print_mpi(f"o       Multistart: {m} Starts on {nprocs} Procs, Longest Start = {np.max(rcrit.multistart_times):.3f} s, Total = {np.sum(rcrit.multistart_times):.3f} s")
+
                     valid = np.where(succ)[0]
                     try:
                         rx = resx[valid[np.argmin(resy[valid])]]
@@ -112,13 +139,14 @@ def getxnew(rcrit, bounds, batch, x_init=None, options=None):
                     # print(rx)
 
                 # start at best point
+                # NOTE: this used to compute y0 and then start from x0[0] anyway
                 elif(options["multistart"] == 1):
-                    x0b = None
-                    y0 = np.zeros(m)
-                    for j in range(m):
-                        y0[j] = eval_eff(x0[j], bounds_used, i)
+                    x0_eff = np.zeros([m, n])
+                    x0_eff[:,sub_ind] = x0[:,sub_ind]
+                    x0_eff[:,fix_ind] = xfix
+                    y0 = rcrit.evaluate_batch(x0_eff, bounds_used, i)
                     ind = np.argmin(y0)
-                    x0b = x0[0]
+                    x0b = x0[ind]
                     results = optimize(eval_eff, args=args, bounds=unit_bounds[sub_ind,:], type="local", constraints=rcrit.condict, jac=jac, x0=x0b[sub_ind])
                     rx = results.x
 
@@ -148,6 +176,73 @@ def getxnew(rcrit, bounds, batch, x_init=None, options=None):
     return xnew
 
 
+def _getxnew_joint(rcrit, bounds, batch, sub_ind, fix_ind, xfix, options):
+    """
+    Pick every point of a batch from a single evaluate_batch call on a set of
+    candidates, greedily, adding the criteria's clustering penalty for each
+    picked point to the remaining candidates. The cost is one criteria
+    evaluation per candidate, and a distance computation per candidate and
+    batch point, instead of one optimization per batch point.
+
+    The candidates are not refined with a local optimizer, so their number
+    (options["joint_ncand"], 100 per refined dimension by default) controls
+    how close the picks get to the criteria minima. The start points from
+    pre_asopt are candidates as well, and the LHS is seeded with
+    options["joint_seed"] plus the number of training points, so each
+    adaptation step draws a different, reproducible set.
+    """
+    n = len(bounds)
+    n_u = len(sub_ind)
+    unit_bounds = np.zeros([n,2])
+    unit_bounds[:,1] = 1.
+
+    x0, lbounds = rcrit.pre_asopt(bounds, dir=0)
+    bounds_used = bounds
+    if(lbounds is not None):
+        bounds_used = lbounds
+
+    ncand = options.get("joint_ncand", None)
+    if ncand is None:
+        ncand = 100*n_u
+    seed = options.get("joint_seed", 0)
+    if seed is not None:
+        seed += rcrit.ntr
+    xc = None
+    if rank == 0:
+        sampling = LHS(xlimits=unit_bounds[sub_ind,:], criterion='m', random_state=seed)
+        xc = sampling(ncand)
+    xc = comm.bcast(xc)
+
+    # add the criteria's own start points
+    x0 = qmc.scale(x0, bounds_used[:,0], bounds_used[:,1], reverse=True)
+    xc = np.append(xc, np.clip(x0[:,sub_ind], 0., 1.), axis=0)
+    ncand = xc.shape[0]
+
+    xc_eff = np.zeros([ncand, n])
+    xc_eff[:,sub_ind] = xc
+    xc_eff[:,fix_ind] = xfix
+
+    ts = time.perf_counter()
+    y = rcrit.evaluate_batch(xc_eff, bounds_used, 0)
+
+    xnew = []
+    for i in range(batch):
+        k = np.argmin(y)
+        rx = qmc.scale(xc[[k],:], bounds_used[sub_ind,0], bounds_used[sub_ind,1])
+        xnew.append(rcrit.post_asopt(rx, bounds, dir=i))
+
+        y += rcrit.batch_penalty(xc_eff, xc_eff[k], bounds_used)
+        y[k] = np.inf
+
+    if(rcrit.options["print_iter"]):
+        print_mpi(f"o       Joint Batch: {batch} Points from {ncand} Candidates, Time = {time.perf_counter() - ts:.3f} s")
+
+    xnew = np.concatenate(xnew, axis=0)
+    print_mpi(xnew)
+
+    return xnew
+
+
 """
 Run Adaptive Sampling
 
@@ -212,25 +307,35 @@ def adaptivesampling(func, model0, rcrit, bounds, ntr, e_tol=None, batch=1, opti
             f0 = model.training_points[None][0][1]
             g0 = rcrit.grad
             nt, dim = t0.shape
+
+            # save training data at each interval regardless
+            if i in intervals.tolist():
+                hist.append(copy.deepcopy(model.training_points[None]))
             #x0 = np.zeros([1, dim])
 
             # get the new points
             xnew = np.array(getxnew(rcrit, bounds, batch_use[i], x_init=rcrit.fix_val, options=options))
             # add the new points to the model
+            fnew = func(xnew)
+            gnew = convert_to_smt_grads(func, xnew)
             t0 = np.append(t0, xnew, axis=0)
-            f0 = np.append(f0, func(xnew), axis=0)
-            g0 = np.append(g0, convert_to_smt_grads(func, xnew), axis=0)
+            f0 = np.append(f0, fnew, axis=0)
+            g0 = np.append(g0, gnew, axis=0)
             added += batch_use[i]
             # g0 = np.append(g0, np.zeros([xnew.shape[0], xnew.shape[1]]), axis=0)
             # for j in range(dim):
             #     g0[nt:,j] = func(xnew, j)[:,0]
 
-            model.set_training_values(t0, f0)
-            convert_to_smt_grads(model, t0, g0)
-            # if(isinstance(model, GEKPLS) or isinstance(model, POUSurrogate) or isinstance(model0, DGEK)):
-            #     for j in range(dim):
-            #         model.set_training_derivatives(t0, g0[:,j], j)
-            model.train()
+            if(isinstance(model, POUSurrogate)):
+                # only redo the parts of the model the new points touch
+                model.add_points(xnew, fnew, gnew)
+            else:
+                model.set_training_values(t0, f0)
+                convert_to_smt_grads(model, t0, g0)
+                # if(isinstance(model, GEKPLS) or isinstance(model, POUSurrogate) or isinstance(model0, DGEK)):
+                #     for j in range(dim):
+                #         model.set_training_derivatives(t0, g0[:,j], j)
+                model.train()
 
             # evaluate errors
             if(options["errorcheck"] is not None):
@@ -250,11 +355,9 @@ def adaptivesampling(func, model0, rcrit, bounds, ntr, e_tol=None, batch=1, opti
                 # errh2 = None
                 #hist = None
 
-            # save training data at each interval regardless
-            if i in intervals.tolist():
-                hist.append(copy.deepcopy(rcrit.model.training_points[None]))        
 
-            rcrit.initialize(model, g0)
+            # share the trained model, and only redo what the new points touch
+            rcrit.update(xnew, fnew, gnew, model)
             
             en = 0.
             e_tol_p = 0.
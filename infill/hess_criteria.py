@@ -1,5 +1,6 @@
 import numpy as np
 import copy
+import time
 
 # from matplotlib import pyplot as plt
 # from smt.utils.options_dictionary import OptionsDictionary
@@ -12,7 +13,7 @@ from scipy.stats import qmc
 from scipy.spatial import KDTree
 from scipy.spatial.distance import pdist, cdist, squareform
 # from scipy.optimize import Bounds
-from utils.sutils import divide_cases, innerMatrixProduct, quadraticSolveHOnly, symMatfromVec, estimate_pou_volume,  standardization2, gen_dist_func_nb
+from utils.sutils import divide_cases, innerMatrixProduct, symMatUnpack, estimate_pou_volume, update_pou_volume, standardization2, gen_dist_func_nb, gather_cases, estimate_stencil_hessians, stale_stencils
 from mpi4py import MPI
 
 comm = MPI.COMM_WORLD
@@ -38,6 +39,9 @@ class HessianRefine(ASCriteria):
         self.grad = grad
         self.bounds = bounds
         self.Mc = None
+        self.timings = {"compute":0., "comm":0.} # accumulated evaluation time, local computation vs result assembly
+        self.eval_cache = None # scaled points and trees for _evaluate, see _eval_cache
+        self.vol_samples = None # random points of the cell volume estimate, see _set_volumes
 
         super().__init__(model, **kwargs)
         self.name = 'POUHESS'
@@ -45,6 +49,8 @@ class HessianRefine(ASCriteria):
         self.scaler = 0
 
         self.supports["obj_derivatives"] = True  
+        self.supports["batch_eval"] = True
+        self.supports["joint_batch"] = True
         
     def _init_options(self):
         declare = self.options.declare
@@ -80,6 +86,12 @@ class HessianRefine(ASCriteria):
             types=bool,
             desc="scale criteria in a cell by the approximate volume of the cell"
         )
+        declare(
+            "volume_seed",
+            None,
+            types=(int, type(None)),
+            desc="seed for the random points of the cell volume estimate, for reproducible volumes"
+        )
         declare(
             "out_of_bounds", 
             0, 
@@ -122,11 +134,73 @@ class HessianRefine(ASCriteria):
         if(grad is not None):
             self.grad = grad
 
+        self.eval_cache = None
+
+        trx, trf, trg = self._normalized_data()
+
+        # Determine rho for the error model
+        if self.options["rho"] is not None:
+            self.rho = self.options["rho"]
+        else:
+            self.rho = self.options['rscale']*pow(self.ntr, 1./self.dim)
+        self.rho2 = 5000. # rho to use for energy calc
+
+        # Generate kd tree for nearest neighbors lookup
+        self.tree = KDTree(trx)
+
+        # Check if the trained surrogate model has hessian data
+        if isinstance(self.model, POUHessian):
+            self._model_hessians()
+        else:
+            self.H = np.zeros([self.ntr, self.dim, self.dim])
+            self.Mc = np.zeros(self.ntr)
+            self.stencil_rad = np.zeros(self.ntr)
+            self._estimate_hessians(np.arange(self.ntr), trx, trf, trg)
+
+        self._set_volumes(trx)
+
+    def _update(self, new_x, new_f, new_g):
+
+        nnew = new_x.shape[0]
+        nold = self.ntr - nnew
+        y_std_old = self.y_sca
+
+        self.eval_cache = None
+
+        trx, trf, trg = self._normalized_data()
+
+        if self.options["rho"] is not None:
+            self.rho = self.options["rho"]
+        else:
+            self.rho = self.options['rscale']*pow(self.ntr, 1./self.dim)
+
+        self.tree = KDTree(trx)
+
+        if isinstance(self.model, POUHessian):
+            # the model already updated its own Hessians
+            self._model_hessians()
+        else:
+            # the Hessian solves are linear in the normalized data, so untouched
+            # stencils only see the change in output scaling
+            self.H = np.append(self.H*(y_std_old/self.y_sca), np.zeros([nnew, self.dim, self.dim]), axis=0)
+            self.Mc = np.append(self.Mc, np.zeros(nnew))
+            self.stencil_rad = np.append(self.stencil_rad, np.zeros(nnew))
+
+            # old stencils change if a new point lands within their radius
+            inds = stale_stencils(self.tree, trx, self.stencil_rad, nold)
+            self._estimate_hessians(inds, trx, trf, trg)
+
+        self._set_volumes(trx, nnew)
+
+    def _normalized_data(self):
+        """
+        Get the training data normalized the same way as the model, and store
+        the scaling
+        """
         #NOTE: Slicing here because GEKPLS appends grad approx
         if not isinstance(self.model, POUHessian):
             trxs = self.model.training_points[None][0][0]
             trfs = self.model.training_points[None][0][1]
-            trg = np.zeros_like(trxs)
             (
                 trx,
                 trf,
@@ -146,7 +220,6 @@ class HessianRefine(ASCriteria):
         else:
             trx = self.model.X_norma[0:self.ntr]#model.training_points[None][0][0]
             trf = self.model.y_norma[0:self.ntr]#training_points[None][0][1]
-            trg = np.zeros_like(trx)
             # if(isinstance(self.model, GEKPLS)):
             #     for j in range(self.dim):
             #         trg[:,j] = self.model.g_norma[:,j].flatten()
@@ -158,52 +231,36 @@ class HessianRefine(ASCriteria):
             self.y_off = self.model.y_mean
             self.y_sca = self.model.y_std
 
-        # Determine rho for the error model
-        if self.options["rho"] is not None:
-            self.rho = self.options["rho"]
-        else:
-            self.rho = self.options['rscale']*pow(self.ntr, 1./self.dim)
-        self.rho2 = 5000. # rho to use for energy calc
+        return trx, trf, trg
 
-        # Generate kd tree for nearest neighbors lookup
-        self.tree = KDTree(trx)
+    def _model_hessians(self):
+        self.H = self.model.h
+        self.Mc = self.model.Mc
+        if self.H.ndim == 2:
+            self.H = symMatUnpack(self.H, self.dim)
 
-        # Check if the trained surrogate model has hessian data
-        try:
-            self.H = model.h
-            self.Mc = model.Mc
-        except:
-            indn = []
-            nstencil = self.options["neval"]
-            for i in range(self.ntr):
-                dists, ind = self.tree.query(trx[i], nstencil)
-                indn.append(ind)
-            hess = []
-            mcs = np.zeros(self.ntr)
-            for i in range(self.ntr):
-                Hh, mc = quadraticSolveHOnly(trx[i,:], trx[indn[i][1:nstencil],:], \
-                                         trf[i], trf[indn[i][1:nstencil]], \
-                                         trg[i,:], trg[indn[i][1:nstencil],:], return_cond=True)
-
-                hess.append(np.zeros([self.dim, self.dim]))
-                mcs[i] = mc
-                for j in range(self.dim):
-                    for k in range(self.dim):
-                        hess[i][j,k] = Hh[symMatfromVec(j,k,self.dim)]
-
-            # self.h = hess
-            # self.Mc = mcs
-            self.H = comm.allreduce(hess)
-            self.Mc = comm.allreduce(mcs)
-
-        m, n = trx.shape
+    def _estimate_hessians(self, inds, trx, trf, trg):
+        """
+        Estimate the Hessians of training points inds from their nearest neighbor
+        stencils, for models that do not provide them, and store them in self.H,
+        along with the system condition number in self.Mc and the stencil radius
+        in self.stencil_rad
+        """
+        self.H[inds], self.Mc[inds], self.stencil_rad[inds] = estimate_stencil_hessians(
+            self.tree, trx, trf, trg, inds, self.options["neval"])
 
+    def _set_volumes(self, trx, nnew=None):
         # factor in cell volume
         fakebounds = copy.deepcopy(self.bounds)
         fakebounds[:,0] = 0.
         fakebounds[:,1] = 1.
+        seed = self.options["volume_seed"]
         if self.options["scale_by_volume"]:
-            self.dV = estimate_pou_volume(trx, fakebounds)
+            # only the random points closer to appended points change cells
+            if nnew is not None and self.vol_samples is not None:
+                self.dV, self.vol_samples = update_pou_volume(trx, nnew, fakebounds, self.vol_samples, seed=seed)
+            else:
+                self.dV, self.vol_samples = estimate_pou_volume(trx, fakebounds, seed=seed, return_samples=True)
         else:
             self.dV = np.ones(trx.shape[0])
 
@@ -213,62 +270,42 @@ class HessianRefine(ASCriteria):
         cap = self.options["min_contribution"]
         cmin = self.options["min_points"]
         numeval = X_cont.shape[0]
-        cases = divide_cases(numeval, size)
+        # single points (optimizer iterations) are evaluated on each proc, without communication
+        ecomm = self._eval_comm() if numeval > 1 else MPI.COMM_SELF
+        cases = divide_cases(numeval, ecomm.size)
+        t0 = time.perf_counter()
         try:
             delta = self.model.options["delta"]
         except:
             delta = 1e-10
 
-        Mc = np.ones(self.ntr)
-        if self.options["scale_by_cond"]:
-            Mc = self.Mc
-
-        trx = qmc.scale(self.trx, bounds[:,0], bounds[:,1], reverse=True)
-
-        # exhaustive search for closest sample point, for regularization
-        # import pdb; pdb.set_trace()
-        # D = cdist(np.array([x]), trx)
-        # distf = gen_dist_func_nb(parallel=True)
-        distf = cdist
-        # if self.energy_mode and  self.D_cache is None:
-        #     diff = trx.shape[0] - self.D_cache.shape[1]
-
-        #     if diff > 0:
-        #         self.D_cache = np.hstack([self.D_cache, distf(X_cont[cases[rank],:], trx[-diff:,:])])
-        #     # import pdb; pdb.set_trace()
-
-        #     D = self.D_cache
+        cache = self._eval_cache(bounds)
+        trx = cache["trx"]
 
-        # else:
-        D = distf(X_cont[cases[rank],:], trx)
+        # closest sample point, for regularization
+        mindist_p, dum = cache["tree_all"].query(X_cont[cases[ecomm.rank],:], 1)
 
         # neighbors
-        neighbors_all, ball_rad = self.neighbors_func(X_cont, self.rho, cap, cmin, self.ntr, cases)
-
-        mindist_p = np.min(D, axis=1)
-        mindist = np.zeros(numeval)
-        c = 0
-        for k in cases[rank]:
-            mindist[k] = mindist_p[c]
-            c += 1
+        neighbors_all, ball_rad = self.neighbors_func(X_cont, self.rho, cap, cmin, self.ntr, cases, ecomm=ecomm, tree=cache["tree"])
 
-        mindist = comm.allreduce(mindist)
+        t1 = time.perf_counter()
+        mindist = gather_cases(mindist_p, cases, comm=ecomm)
+        t2 = time.perf_counter()
 
-        D = None
-        fac_all = self.dV*Mc
+        fac_all = cache["fac"]
         y_ = np.zeros(numeval)
         if self.energy_mode:
             # y_ = np.zeros([numeval, X_cont.shape[1]])#self.higher_terms(X_cont[0,:] - trx, None, self.H).shape[1]])
             c = 0
             # print(f"PAST EN EVAL PREP {rank}", flush = True)
-            for k in cases[rank]:
+            for k in cases[ecomm.rank]:
             # for k in range(numeval):
                 
                 neighbors = neighbors_all
                 if ball_rad:
                     # neighbors = neighbors_all[k]
                     neighbors = neighbors_all[c]
-                    xc = trx[neighbors,:]
+                xc = trx[neighbors,:]
                 fac = fac_all[neighbors]
 
                 # work = X_cont[k,:] - trx[:self.ntr,:]
@@ -297,17 +334,14 @@ class HessianRefine(ASCriteria):
             # print(f"PAST EN EVAL LOOP {rank}", flush = True)
         else: 
             c = 0
-            for k in cases[rank]:
+            for k in cases[ecomm.rank]:
             # for k in range(numeval):
             # for k in prange(numeval):
                 neighbors = neighbors_all
                 if ball_rad:
                     # neighbors = neighbors_all[k]
                     neighbors = neighbors_all[c]
-                    # try:
-                    xc = trx[neighbors,:]
-                    # except:
-                    #     import pdb; pdb.set_trace()
+                xc = trx[neighbors,:]
                 fac = fac_all[neighbors]
 
                 # work = X_cont[k,:] - trx[:self.ntr,:]
@@ -324,7 +358,9 @@ class HessianRefine(ASCriteria):
                 c += 1
         # y_ = pou_crit_loop(X_cont, D, trx, fac, mindist, delta, self.energy_mode, self.higher_terms, self.H, self.rho)
         
-        y_ = comm.allreduce(y_)
+        t3 = time.perf_counter()
+        y_ = gather_cases(y_[cases[ecomm.rank]], cases, comm=ecomm)
+        self._add_timings(t0, t1, t2, t3)
         ans = -abs(y_)
 
         
@@ -350,11 +386,7 @@ class HessianRefine(ASCriteria):
         # this should only work for 
         for i in range(dir):
             ind = self.ntr + i
-            work = x - trx[ind]
-            # dirdist = np.sqrt(np.dot(work, work)) 
-            dirdist = np.linalg.norm(work) 
-            # ans += 1./(np.dot(work, work) + 1e-10)
-            ans += np.exp(-self.rho*(dirdist + delta))
+            ans += self._batch_penalty(X_cont, trx[ind], bounds)
 
         return ans 
     
@@ -371,40 +403,33 @@ class HessianRefine(ASCriteria):
         numeval = X_cont.shape[0]
         cap = self.options["min_contribution"]
         cmin = self.options["min_points"]
-        cases = divide_cases(numeval, size)
+        # single points (optimizer iterations) are evaluated on each proc, without communication
+        ecomm = self._eval_comm() if numeval > 1 else MPI.COMM_SELF
+        cases = divide_cases(numeval, ecomm.size)
+        t0 = time.perf_counter()
         dim = X_cont.shape[1]
         try:
             delta = self.model.options["delta"]
         except:
             delta = 1e-10
 
-        Mc = np.ones(self.ntr)
-        if self.options["scale_by_cond"]:
-            Mc = self.Mc
-
-        trx = qmc.scale(self.trx, bounds[:,0], bounds[:,1], reverse=True)
-        # exhaustive search for closest sample point, for regularization
-        # D = cdist(X_cont, trx)
-        # mindist = np.min(D, axis=1)
-
-        D = cdist(X_cont[cases[rank],:], trx)
+        cache = self._eval_cache(bounds)
+        trx = cache["trx"]
 
-        neighbors_all, ball_rad = self.neighbors_func(X_cont, self.rho, cap, cmin, trx.shape[0], cases)
-        mindist_p = np.min(D, axis=1)
-        mindist = np.zeros(numeval)
-        c = 0
-        for k in cases[rank]:
-            mindist[k] = mindist_p[c]
-            c += 1
+        # closest sample point, for regularization
+        mindist_p, dum = cache["tree_all"].query(X_cont[cases[ecomm.rank],:], 1)
 
-        mindist = comm.allreduce(mindist)
+        neighbors_all, ball_rad = self.neighbors_func(X_cont, self.rho, cap, cmin, self.ntr, cases, ecomm=ecomm, tree=cache["tree"])
+        t1 = time.perf_counter()
+        mindist = gather_cases(mindist_p, cases, comm=ecomm)
+        t2 = time.perf_counter()
 
-        fac_all = self.dV*Mc
+        fac_all = cache["fac"]
 
         y_ = np.zeros(numeval)
         dy_ = np.zeros([numeval, dim])
         c = 0
-        for k in cases[rank]:
+        for k in cases[ecomm.rank]:
         # for k in range(numeval):
         # for k in prange(numeval):
 
@@ -412,7 +437,7 @@ class HessianRefine(ASCriteria):
             if ball_rad:
                 # neighbors = neighbors_all[k]
                 neighbors = neighbors_all[c]
-                xc = trx[neighbors,:]
+            xc = trx[neighbors,:]
             fac = fac_all[neighbors]
 
             # for i in range(self.ntr):
@@ -440,28 +465,36 @@ class HessianRefine(ASCriteria):
 
             c += 1
 
-        y_ = comm.allreduce(y_)
-        dy_ = comm.allreduce(dy_)
+        t3 = time.perf_counter()
+        terms = gather_cases(np.hstack([y_[:,None], dy_])[cases[ecomm.rank]], cases, comm=ecomm)
+        self._add_timings(t0, t1, t2, t3)
+        y_ = terms[:,0]
+        dy_ = terms[:,1:]
         ans = np.einsum('i,ij->ij',-np.sign(y_), dy_)
 
         #TODO: Parallelize this query as well?
         # for batches, loop over already added points to prevent clustering
         for i in range(dir):
             ind = self.ntr + i
-            work = x - trx[ind]
+            work = X_cont - trx[ind]
             #dwork = np.eye(n)
             # d2 = np.dot(work, work)
             # dd2 = 2*work
-            dirdist = np.linalg.norm(work) 
+            dirdist = np.linalg.norm(work, axis=1) 
             # term = 1.0/(d2 + 1e-10)
             # ans += -1.0/((d2 + 1e-10)**2)*dd2
-            ddirdist = work/dirdist
-            quant = -self.rho*ddirdist*np.exp(-self.rho*(dirdist+ delta))
+            ddirdist = work/dirdist[:,None]
+            quant = -self.rho*ddirdist*np.exp(-self.rho*(dirdist+ delta))[:,None]
             ans += quant
 
             # import pdb; pdb.set_trace()
         return ans
 
+    def _add_timings(self, t0, t1, t2, t3):
+        # compute in [t0, t1] and [t2, t3], communication in between and after
+        self.timings["compute"] += (t1 - t0) + (t3 - t2)
+        self.timings["comm"] += (t2 - t1) + (time.perf_counter() - t3)
+
     def higher_terms(self, dx, g, h):
         terms = np.zeros(dx.shape[0])
         
@@ -475,11 +508,10 @@ class HessianRefine(ASCriteria):
 
     def higher_terms_deriv(self, dx, g, h):
         # terms = (g*dx).sum(axis = 1)
-        dterms = np.zeros_like(dx)
         # for j in range(dx.shape[0]):
-        for d in range(dx.shape[1]):
-            # dterms[j,d] = np.dot(h[j,d,:], dx[j,:])#0.5*innerMatrixProduct(h, dx)
-            dterms = np.einsum('ik, ik ->i', h[:,d,:], dx)
+        #     dterms[j,d] = np.dot(h[j,d,:], dx[j,:])#0.5*innerMatrixProduct(h, dx)
+        # every column d at once, h is symmetric
+        dterms = np.einsum('ijk,ik->ij', h, dx)
 
         if self.options["return_rescaled"]:
             dterms *= self.y_sca
@@ -487,6 +519,41 @@ class HessianRefine(ASCriteria):
 
 
 
+    def _eval_cache(self, bounds):
+        """
+        Training data in the optimizer's coordinates, kept until the bounds or
+        the points change, i.e. once per infill iteration and batch point
+        """
+        key = (np.asarray(bounds).tobytes(), self.trx.shape[0])
+        if self.eval_cache is not None and self.eval_cache["key"] == key:
+            return self.eval_cache
+
+        Mc = np.ones(self.ntr)
+        if self.options["scale_by_cond"]:
+            Mc = self.Mc
+
+        trx = qmc.scale(self.trx, bounds[:,0], bounds[:,1], reverse=True)
+        self.eval_cache = {
+            "key":key,
+            "trx":trx,
+            "tree":KDTree(trx[:self.ntr]), # POU centers, for neighbor queries
+            "tree_all":KDTree(trx), # also earlier points in the batch, for the closest distance
+            "fac":self.dV*Mc,
+        }
+        return self.eval_cache
+
+    def _batch_penalty(self, x, xb, bounds):
+        try:
+            delta = self.model.options["delta"]
+        except:
+            delta = 1e-10
+
+        work = x - xb
+        # dirdist = np.sqrt(np.dot(work, work)) 
+        dirdist = np.linalg.norm(work, axis=1) 
+        # ans += 1./(np.dot(work, work) + 1e-10)
+        return np.exp(-self.rho*(dirdist + delta))
+
     def _pre_asopt(self, bounds, dir=0):
         trx = qmc.scale(self.trx, bounds[:,0], bounds[:,1], reverse=True)
 
@@ -521,13 +588,19 @@ class HessianRefine(ASCriteria):
         return x
     
 
-    def neighbors_func(self, X_cont, rho, cap, cmin, numsample, cases):
+    def neighbors_func(self, X_cont, rho, cap, cmin, numsample, cases, ecomm=None, tree=None):
+
+        if ecomm is None:
+            ecomm = self._eval_comm()
+        if tree is None:
+            tree = self.tree
+        X_rows = X_cont[cases[ecomm.rank],:]
 
         neighbors_all = list(range(numsample))
         ball_rad = None
         if(cap):
             ball_rad = -np.log(cap)/rho
-            neighbors_all = self.tree.query_ball_point(X_cont[cases[rank],:], ball_rad)
+            neighbors_all = tree.query_ball_point(X_rows, ball_rad)
             redo = []
             for i in range(len(neighbors_all)):
                 over = len(neighbors_all[i]) - cmin
@@ -535,7 +608,7 @@ class HessianRefine(ASCriteria):
                     redo.append(i)
 
             if len(redo) > 0:
-                dum, neighbors_redo = self.tree.query(X_cont[cases[rank],:][redo,:], cmin)
+                dum, neighbors_redo = tree.query(X_rows[redo,:], min(cmin, numsample))
 
                 for j in range(len(neighbors_redo)):
                     neighbors_all[redo[j]] = neighbors_redo[j]
@@ -12,6 +12,7 @@ from scipy.stats import qmc
 from scipy.spatial.distance import pdist, cdist, squareform
 from scipy.optimize import NonlinearConstraint
 from utils.sutils import convert_to_smt_grads, print_rc_plots
+from utils.loo import LOOPredictor
 
 
 # SFCVT
@@ -26,7 +27,7 @@ class POUSFCVT(ASCriteria):
         super().__init__(model, **kwargs)
         self.scaler = 0
 
-        self.supports["obj_derivatives"] = False  
+        self.supports["obj_derivatives"] = True  
         self.supports["uses_constraints"] = True  
         
     def _init_options(self):
@@ -55,6 +56,7 @@ class POUSFCVT(ASCriteria):
         self.condict = {
             "type":"ineq",
             "fun":self.eval_constraint,
+            "jac":self.eval_constraint_grad,
             "args":[],
         }
 
@@ -100,7 +102,15 @@ class POUSFCVT(ASCriteria):
 
         return ans 
 
-    def eval_constraint(self, x, bounds, dir=0):
+    def _eval_grad(self, x, bounds, dir=0):
+
+        y, dy = self.cvmodel._predict_jacobian(np.atleast_2d(x))
+
+        ans = -np.sign(y)[:,None]*dy
+
+        return ans
+
+    def eval_constraint(self, x, bounds=None, dir=0):
         
         m = self.trx.shape[0]
 
@@ -110,6 +120,14 @@ class POUSFCVT(ASCriteria):
         # import pdb; pdb.set_trace()
         return y 
 
+    def eval_constraint_grad(self, x, bounds=None, dir=0):
+
+        xmin, ind = self.tree.query(np.array([x]), 1)
+
+        dy = (x - self.tree.data[ind])/np.maximum(xmin, np.finfo(float).tiny)[:,None]
+
+        return dy
+
 
 
 
@@ -170,6 +188,7 @@ class SFCVT(ASCriteria):
         super().__init__(model, **kwargs)
         self.scaler = 0
 
+        self.supports["obj_derivatives"] = True  
         self.supports["uses_constraints"] = True  
 
     def _init_options(self):
@@ -212,40 +231,13 @@ class SFCVT(ASCriteria):
 
         # set up constraints
         self.condict = NonlinearConstraint(self.eval_constraint,
-                        lb = 0., ub = np.inf)
+                        lb = 0., ub = np.inf, jac = self.eval_constraint_grad)
         
-        # Compute the error at each left-out point, don't bother storing left out models it's a waste
-        loosm = None
+        # Compute the error at each left-out point, without refitting where the model allows it
         trx_true = self.model.training_points[None][0][0]
-        abs_err_sc = np.zeros([self.ntr, 1])
-        for i in range(self.ntr):
-            loosm = copy.deepcopy(self.model)
-            loosm.options.update({"print_global":False})
-
-            kx = 0
-
-            # Give each LOO model its training data, and retrain if not approximating
-            trx = copy.deepcopy(loosm.training_points[None][kx][0])
-            trf = copy.deepcopy(loosm.training_points[None][kx][1])
-            trg = None
-                
-            trx = np.delete(trx, i, 0)
-            trf = np.delete(trf, i, 0)
-            
-            loosm.set_training_values(trx, trf)
-            if(loosm.supports["training_derivatives"]):
-                trg = convert_to_smt_grads(self.model)
-                trg = np.delete(trg, i, 0)
-                convert_to_smt_grads(loosm, trx, trg)
-
-            # if(self.options["approx"] == False):
-            loosm.train()
-
-            # now compute scaled absolute error 
-            # import pdb; pdb.set_trace()
-            M_i = self.model.predict_values(trx_true[i:i+1,:])[0]
-            M_i_m = loosm.predict_values(trx_true[i:i+1,:])[0]
-            abs_err_sc[i,:] = abs((M_i - M_i_m)/M_i)
+        M = self.model.predict_values(trx_true)[:,0]
+        M_m = LOOPredictor(self.model).values()
+        abs_err_sc = np.atleast_2d(abs((M - M_m)/M)).T
 
         # min dist constraint
         self.S = 0
@@ -266,6 +258,16 @@ class SFCVT(ASCriteria):
 
         return ans # to work with optimizers
 
+    def _eval_grad(self, x, bounds, dir=0):
+
+        if(len(x.shape) != 2):
+            x = np.array([x])
+
+        # cvsurr is trained in the same space as the model
+        ans = -convert_to_smt_grads(self.cvsurr, x, deriv_predict=True)
+
+        return ans
+
     def pre_asopt(self, bounds, dir=0):
         
         # NOTE: DO NOT USE X_norma HERE FOR GEK, IT INCLUDES EXTRA POINTS
@@ -283,16 +285,22 @@ class SFCVT(ASCriteria):
         return x
         
 
-    def _eval_constraint(self, x, dir=0):
+    def _eval_constraint(self, x, bounds=None, dir=0):
         t0 = qmc.scale(self.model.training_points[None][0][0], self.bounds[:,0], self.bounds[:,1], reverse=True)
 
-        con = np.zeros(self.ntr)
-        for i in range(self.ntr):
-            con[i] = np.linalg.norm(x - t0[i])
+        con = np.linalg.norm(x - t0, axis=1)
 
         # import pdb; pdb.set_trace()
         return con - self.S
 
+    def _eval_constraint_grad(self, x, bounds=None, dir=0):
+        t0 = qmc.scale(self.model.training_points[None][0][0], self.bounds[:,0], self.bounds[:,1], reverse=True)
+
+        work = x - t0
+        dcon = work/np.maximum(np.linalg.norm(work, axis=1), np.finfo(float).tiny)[:,None]
+
+        return dcon
+
 
 
 
@@ -316,6 +324,7 @@ class POUSSA(ASCriteria):
         super().__init__(model, **kwargs)
 
         self.supports["obj_derivatives"] = True  
+        self.supports["batch_eval"] = True
         
     def _init_options(self):
         declare = self.options.declare
@@ -349,6 +358,7 @@ class POUSSA(ASCriteria):
         self.condict = {
             "type":"ineq",
             "fun":self.eval_constraint,
+            "jac":self.eval_constraint_grad,
             "args":[],
         }
 
@@ -384,14 +394,13 @@ class POUSSA(ASCriteria):
     def _evaluate(self, x, bounds, dir=0):
         
         m = self.trx.shape[0]
+        X = np.atleast_2d(x)
 
         # compute CDM
-        cdm = 0
-        for i in range(m):
-            work = x - self.trx[i]
-            cdm += np.dot(work, work)
+        work = X[:,None,:] - self.trx[None,:,:]
+        cdm = np.einsum('ijk,ijk->i', work, work)
         
-        y = cdm*self.cvmodel._predict_values(np.array([x]))**2
+        y = cdm*self.cvmodel._predict_values(X)**2
 
         ans = -abs(y)
 
@@ -403,56 +412,39 @@ class POUSSA(ASCriteria):
         
         m = self.trx.shape[0]
 
-        xmin = self.tree.query(np.array([x]), 1)
+        xmin = self.tree.query(np.array([x]), 1)[0]
 
-        y = np.linalg.norm(x - xmin) - self.options["eps"]
+        y = xmin - self.options["eps"]
 
         return y 
 
+    def _eval_constraint_grad(self, x, bounds, dir=0):
+
+        xmin, ind = self.tree.query(np.array([x]), 1)
+
+        dy = (x - self.tree.data[ind])/np.maximum(xmin, np.finfo(float).tiny)[:,None]
+
+        return dy
+
 
     def _eval_grad(self, x, bounds, dir=0):
         
-        # delta = self.model.options["delta"]
-
-        # # exhaustive search for closest sample point, for regularization
-        # D = cdist(np.array([x]), self.trx)
-        # mindist = min(D[0])
-
-        # numer = 0
-        # denom = 0
-        # dnumer = np.zeros(self.dim)
-        # ddenom = np.zeros(self.dim)
-        # dwork = np.ones(self.dim)
-
-        # for i in range(self.ntr):
-        #     work = x - self.trx[i]
-        #     dist = D[0][i] + delta#np.sqrt(D[0][i] + delta)
-        #     ddist = work/D[0][i]
-        #     local = 0.5*innerMatrixProduct(self.H[i], work)*self.dV[i]
-        #     dlocal = np.dot(self.H[i], work)*self.dV[i]
-        #     expfac = np.exp(-self.rho*(dist-mindist))
-        #     dexpfac = -self.rho*expfac*ddist
-        #     numer += local*expfac
-        #     dnumer += local*dexpfac + dlocal*expfac
-        #     denom += expfac
-        #     ddenom += dexpfac
-
-        # y = numer/denom
-        # dy = (denom*dnumer - numer*ddenom)/(denom**2)
-
-        # ans = -np.sign(dy)*dy
-
-        # # for batches, loop over already added points to prevent clustering
-        # for i in range(dir):
-        #     ind = self.ntr + i
-        #     work = x - self.trx[ind]
-        #     #dwork = np.eye(n)
-        #     d2 = np.dot(work, work)
-        #     dd2 = 2*work
-        #     term = 1.0/(d2 + 1e-10)
-        #     ans += -1.0/((d2 + 1e-10)**2)*dd2
+        m = self.trx.shape[0]
+        X = np.atleast_2d(x)
+
+        # CDM and its gradient
+        work = X[:,None,:] - self.trx[None,:,:]
+        cdm = np.einsum('ijk,ijk->i', work, work)
+        dcdm = 2.*np.sum(work, axis=1)
+
+        cv, dcv = self.cvmodel._predict_jacobian(X)
+
+        y = cdm*cv**2
+        dy = dcdm*(cv**2)[:,None] + (2.*cdm*cv)[:,None]*dcv
+
+        ans = -np.sign(y)[:,None]*dy
         
-        return None
+        return ans
 
 
 
@@ -469,11 +461,7 @@ class POUSSA(ASCriteria):
                 # x = np.linspace(bounds[0][0], bounds[0][1], ndir)
                 # y = np.linspace(bounds[1][0], bounds[1][1], ndir)
                 x = np.linspace(0., 1., ndir)
-                F  = np.zeros([ndir]) 
-                for i in range(ndir):
-                    xi = np.zeros([1])
-                    xi[0] = x[i]
-                    F[i]  = self.evaluate(xi, bounds, dir=dir)    
+                F  = self.evaluate_batch(x[:,None], bounds, dir=dir)    
                 plt.plot(x, F)
                 plt.ylim(top=0.1)
                 plt.ylim(bottom=np.min(F))
@@ -491,13 +479,9 @@ class POUSSA(ASCriteria):
                 x = np.linspace(0., 1., ndir)
                 y = np.linspace(0., 1., ndir)   
                 X, Y = np.meshgrid(x, y)
-                F  = np.zeros([ndir, ndir]) 
-                for i in range(ndir):
-                    for j in range(ndir):
-                        xi = np.zeros([2])
-                        xi[0] = x[i]
-                        xi[1] = y[j]
-                        F[i,j]  = self.evaluate(xi, bounds, dir=dir)    
+                # F[i,j] at (x[i], y[j])
+                xg, yg = np.meshgrid(x, y, indexing='ij')
+                F  = self.evaluate_batch(np.column_stack([xg.ravel(), yg.ravel()]), bounds, dir=dir).reshape(ndir, ndir)
                 cs = plt.contourf(Y, X, F, levels = np.linspace(np.min(F), 0., 25))
                 plt.colorbar(cs)
                 trxs = self.trx #qmc.scale(self.trx, bounds[:,0], bounds[:,1], reverse=True)
@@ -13,9 +13,10 @@ from scipy.spatial.distance import pdist, cdist, squareform
 from scipy.optimize import Bounds
 from scipy.integrate import nquad
 from scipy.stats import qmc
-from utils.stat_comps import _mu_sigma_comp, _mu_sigma_grad
+from utils.stat_comps import _mu_sigma_comp, _mu_sigma_grad, SobolIntegrator
 from utils.error import _gen_var_lists
 from utils.sutils import convert_to_smt_grads, print_rc_plots, standardization2, linear, quadratic, quadraticSolve, quadraticSolveHOnly, symMatfromVec, maxEigenEstimate, boxIntersect
+from utils.loo import LOOPredictor
 
 from mpi4py import MPI
 
@@ -40,8 +41,8 @@ class ASCriteria():
         """
         self.name = 'Base'
 
-        # copy the surrogate model object
-        self.model = copy.deepcopy(model)
+        # the surrogate model object, copied once options are set if copy_model
+        self.model = model
 
         # get the size of the training set
         kx = 0
@@ -68,6 +69,9 @@ class ASCriteria():
         supports["obj_derivatives"] = False
         supports["uses_constraints"] = False
         supports["rescaling"] = False
+        supports["serial_eval"] = True # evaluations are either serial or honor set_serial_eval
+        supports["batch_eval"] = False # _evaluate and _eval_grad accept a 2D array of points
+        supports["joint_batch"] = False # _batch_penalty is implemented, batches can be picked jointly
 
         # set options
         self.options = OptionsDictionary()
@@ -120,12 +124,38 @@ class ASCriteria():
             None,
             desc="for energy calc, account for mean+stdev implementation"
         )
+        self.options.declare(
+            "energy_integrator",
+            "lhs",
+            desc="energy integration, \"lhs\": mean over a fixed LHS point set, \"sobol\": scrambled Sobol replicates refined to energy_rtol, or an object with the integrate method of utils.stat_comps.SobolIntegrator"
+        )
+        self.options.declare(
+            "energy_rtol",
+            1e-2,
+            types=float,
+            desc="target relative accuracy of the energy for the sobol integrator"
+        )
+        self.options.declare(
+            "energy_max_points",
+            None,
+            desc="point budget of the sobol integrator, 5000 per refined dimension if None"
+        )
+        self.options.declare(
+            "copy_model",
+            True,
+            types=bool,
+            desc="work on a copy of the surrogate model, False to share it with the caller, e.g. for criteria kept up to date through update"
+        )
 
 
         self.options.update(kwargs)
 
+        if self.options["copy_model"]:
+            self.model = copy.deepcopy(model)
+
         self.opt = True
         self.condict = () #for constrained optimization
+        self.serial_eval = False
 
         # note that evaluate and eval_grad will behave the same no matter what,
         # but this will help with multistart and post processing steps
@@ -152,6 +182,9 @@ class ASCriteria():
         # flag for speeding up energy calculations if possible
         self.energy_mode = False
         self.D_cache = None
+        self.e_integrator = None # see _energy_integrator
+        self.e_scrit = None # criteria without volume scaling for eta_weight, see _energy_scrit
+        self.energy_err = None # error estimate of the last energy, if the integrator gives one
 
         dim_u = len(self.sub_ind)
         xlimits_u = np.zeros([dim_u,2])
@@ -162,7 +195,28 @@ class ASCriteria():
             e_x = samp(5000*dim_u)
         self.e_x = comm.bcast(e_x)
 
-        self.initialize(self.model)
+        # self.model is already set up, don't copy it again
+        self.initialize()
+
+    def set_serial_eval(self, serial):
+        """
+        Evaluate the criteria, and its model if it splits predictions over
+        procs, entirely on each proc, so that procs can evaluate different
+        points independently (e.g. parallel multistart in getxnew)
+
+        Parameters
+        ----------
+        serial : bool
+            If True, evaluate on this proc only, otherwise split evaluations over all procs
+        """
+        self.serial_eval = serial
+        if hasattr(self.model, "serial_eval"):
+            self.model.serial_eval = serial
+
+    def _eval_comm(self):
+        if getattr(self, "serial_eval", False):
+            return MPI.COMM_SELF
+        return comm
 
     # set static variables if we're only refining over a subspace
     # do nothing otherwise
@@ -177,7 +231,39 @@ class ASCriteria():
         else:
             ValueError(f'Invalid number of inputs given ({len_given} != total dim {dim_t}, {len_given} != reduced dim {dim_r})')
 
-        return 
+        return
+
+    def update(self, new_x, new_f, new_g=None, model=None):
+        """
+        Update the criteria after points were added to its model, without
+        copying the model. Criteria that implement _update only recompute
+        the local quantities the new points affect, the rest rebuild
+        themselves from the shared model through initialize.
+
+        Parameters
+        ----------
+        new_x : np.ndarray
+            New training inputs, already added to the model
+        new_f : np.ndarray
+            New training outputs
+        new_g : np.ndarray
+            New training gradients, if the criteria uses them
+        model : smt SurrogateModel object
+            Model trained with the new points, shared by the criteria. If None,
+            self.model is assumed to contain them already
+        """
+        if(model is not None):
+            self.model = model
+
+        kx = 0
+        self.dim = self.model.training_points[None][kx][0].shape[1]
+        self.ntr = self.model.training_points[None][kx][0].shape[0]
+        self.trx = self.model.training_points[None][kx][0]
+
+        if(new_g is not None and getattr(self, "grad", None) is not None):
+            self.grad = np.append(self.grad, new_g, axis=0)
+
+        self._update(np.atleast_2d(new_x), new_f, new_g)
 
 
     def pre_asopt(self, bounds, dir=0):
@@ -255,8 +341,16 @@ class ASCriteria():
         ans = self._evaluate(x, bounds, dir=dir)
 
         # apply pdf weightings if present
-        weight = np.ones_like(ans)
+        ans_w = ans*self._pdf_weight(x, bounds)
+        return ans_w
+
+    def _pdf_weight(self, x, bounds):
+        """
+        Weighting applied by evaluate at each row of x, the product of the pdfs
+        over the refined dimensions times the area of their bounds
+        """
         xw = np.atleast_2d(x)
+        weight = np.ones(xw.shape[0])
         area = 1.0
         for j in range(xw.shape[1]):
             if isinstance(self.pdfs[j], float) or j not in self.sub_ind:
@@ -264,15 +358,43 @@ class ASCriteria():
             else:
 
                 try:
-                    if self.pdf_name_list[j] == 'uniform' or self.pdf_name_list[j] == 'beta':
-                        weight *= self.pdfs[j].pdf(xw[:,j:j+1])[:,0]
-                    else:
-                        weight *= self.pdfs[j].pdf(qmc.scale(xw[:,j:j+1], bounds[j,0], bounds[j,1]))[:,0]
+                    weight *= self._pdf_1d(j, xw[:,j], bounds)
                 except:
                     import pdb; pdb.set_trace()
                 area *= bounds[j,1] - bounds[j,0]
-        ans_w = ans*weight*area
-        return ans_w
+        return weight*area
+    
+    def _pdf_weight_grad(self, x, bounds, h=1e-7):
+        """
+        Weighting of _pdf_weight and its gradient at each row of x. The pdfs
+        have no derivatives, so each is differenced along its own dimension
+        """
+        xw = np.atleast_2d(x)
+        pdfs = np.ones(xw.shape)
+        dpdfs = np.zeros(xw.shape)
+        area = 1.0
+        for j in range(xw.shape[1]):
+            if isinstance(self.pdfs[j], float) or j not in self.sub_ind:
+                continue
+            # central where possible, one-sided at the bounds
+            xp = np.minimum(xw[:,j] + h, 1.0)
+            xm = np.maximum(xw[:,j] - h, 0.0)
+            pdfs[:,j] = self._pdf_1d(j, xw[:,j], bounds)
+            dpdfs[:,j] = (self._pdf_1d(j, xp, bounds) - self._pdf_1d(j, xm, bounds))/(xp - xm)
+            area *= bounds[j,1] - bounds[j,0]
+
+        weight = np.prod(pdfs, axis=1)
+        dweight = np.zeros(xw.shape)
+        for j in range(xw.shape[1]):
+            dweight[:,j] = dpdfs[:,j]*np.prod(np.delete(pdfs, j, axis=1), axis=1)
+
+        return weight*area, dweight*area
+
+    def _pdf_1d(self, j, xj, bounds):
+        # pdf of dimension j at the scaled coordinates xj
+        if self.pdf_name_list[j] == 'uniform' or self.pdf_name_list[j] == 'beta':
+            return self.pdfs[j].pdf(xj)
+        return self.pdfs[j].pdf(qmc.scale(xj[:,None], bounds[j,0], bounds[j,1])[:,0])
     
     def eval_grad(self, x, bounds, dir=0):
 
@@ -281,53 +403,144 @@ class ASCriteria():
         ans = self._eval_grad(x, bounds, dir=dir)
         ans_w = ans
         if self.options["pdf_weight"]:
-            h = 1e-8
-            ans_f = self._evaluate(x, bounds, dir=dir)
-            weight = np.ones_like(ans_f)
-            xw = np.atleast_2d(x)
-            dweight = np.zeros_like(xw)
-            area = 1.0
-            for j in range(xw.shape[1]):
-                if isinstance(self.pdfs[j], float) or j not in self.sub_ind:
-                    weight *= 1.0
-                    dweight *= 1.0
-                else:
-                    weight *= self.pdfs[j].pdf(qmc.scale(xw[:,j:j+1], bounds[j,0], bounds[j,1]))[:,0]
-                    area *= bounds[j,1] - bounds[j,0]
-                    for k in range(xw.shape[1]):
-                        if isinstance(self.pdfs[k], float):
-                            dweight[:,j] *= self.pdfs[k]
-                        else:
-                            if j != k:
-                                dweight[:,j] *= self.pdfs[j].pdf(qmc.scale(xw[:,j:j+1], bounds[j,0], bounds[j,1]))[:,0]
-                            else:
-                                fac = 1.0
-                                step = xw[:,j:j+1] + h
-                                if step > 1.0: # just in case
-                                    fac = -1.0
-                                    step = xw[:,j:j+1] - h
-                                dweight[:,j] *= fac*(self.pdfs[j].pdf(qmc.scale(step, bounds[j,0], bounds[j,1]))[:,0] -
-                                            self.pdfs[j].pdf(qmc.scale(xw[:,j:j+1], bounds[j,0], bounds[j,1]))[:,0])/h
-        
-            ans_w = np.einsum('i,ij->ij', ans_f, np.atleast_2d(dweight)) + np.einsum('i,ij->ij', weight, np.atleast_2d(ans))
-            ans_w *= area
+            # product rule on the weighting applied by evaluate
+            ans_f = np.reshape(self._evaluate(x, bounds, dir=dir), -1)
+            weight, dweight = self._pdf_weight_grad(x, bounds)
+            ans_w = np.einsum('i,ij->ij', ans_f, dweight) + np.einsum('i,ij->ij', weight, np.atleast_2d(ans))
         return ans_w
 
-    def eval_constraint(self, x, bounds, dir=0):
+    def check_grads(self, x, bounds, dir=0, h=1e-6, constraint=False):
+        """
+        Compare the analytic gradient of the criteria, or of its constraints,
+        with central differences
+
+        Parameters
+        ----------
+        x : np.ndarray[nt, dim]
+            Points in the scaled space, as passed to evaluate
+        bounds : np.ndarray[dim, 2]
+        dir : int
+            Index of the point in the current batch
+        h : float
+            Finite difference step
+        constraint : bool
+            If True, check eval_constraint_grad against eval_constraint
+
+        Returns
+        -------
+        grad : np.ndarray[nt, dim], or [nt, ncon, dim] for constraints
+            Analytic gradient
+        grad_fd : np.ndarray
+            Finite difference gradient
+        err : np.ndarray[nt]
+            Largest absolute difference in each row, relative to the largest
+            finite difference entry
+        """
+        x = np.atleast_2d(x)
+        nt, dim = x.shape
+
+        if constraint:
+            func = lambda xk: np.ravel(self.eval_constraint(xk, bounds, dir=dir))
+            grad = np.array([np.atleast_2d(self.eval_constraint_grad(x[k], bounds, dir=dir)) for k in range(nt)])
+        else:
+            func = lambda xk: self.evaluate_batch(xk, bounds, dir=dir)[0]
+            grad = self.eval_grad_batch(x, bounds, dir=dir)
+
+        grad_fd = np.zeros_like(grad)
+        for k in range(nt):
+            for j in range(dim):
+                xp = np.copy(x[k])
+                xm = np.copy(x[k])
+                xp[j] += h
+                xm[j] -= h
+                grad_fd[k,...,j] = (func(xp) - func(xm))/(2*h)
+
+        work = np.abs(grad - grad_fd).reshape(nt, -1)
+        scale = np.max(np.abs(grad_fd).reshape(nt, -1), axis=1)
+        err = np.max(work, axis=1)/np.maximum(scale, 1e-14)
+
+        return grad, grad_fd, err
+
+    def evaluate_batch(self, x, bounds, dir=0):
+        """
+        Evaluate the criteria at every row of x, in a single call to _evaluate
+        if the criteria supports batches and point by point otherwise
+
+        Parameters
+        ----------
+        x : np.ndarray[nt, dim]
+            Points in the scaled space, as passed to evaluate
+        bounds : np.ndarray[dim, 2]
+        dir : int
+            Index of the point in the current batch
+
+        Returns
+        -------
+        ans : np.ndarray[nt]
+        """
+        x = np.atleast_2d(x)
+        if self.supports["batch_eval"]:
+            return np.reshape(self.evaluate(x, bounds, dir=dir), x.shape[0])
+
+        ans = np.zeros(x.shape[0])
+        for k in range(x.shape[0]):
+            ans[k] = np.ravel(self.evaluate(x[k], bounds, dir=dir))[0]
+        return ans
+
+    def eval_grad_batch(self, x, bounds, dir=0):
+        """
+        Gradient of the criteria at every row of x, see evaluate_batch
+
+        Returns
+        -------
+        dans : np.ndarray[nt, dim]
+        """
+        x = np.atleast_2d(x)
+        if self.supports["batch_eval"]:
+            return np.reshape(self.eval_grad(x, bounds, dir=dir), x.shape)
+
+        dans = np.zeros(x.shape)
+        for k in range(x.shape[0]):
+            dans[k] = np.ravel(self.eval_grad(x[k], bounds, dir=dir))
+        return dans
+
+    def batch_penalty(self, x, xb, bounds):
+        """
+        Change in the weighted criteria at every row of x once xb is added to
+        the current batch, the same clustering term _evaluate adds for the
+        earlier points of a batch through dir. Used to pick a whole batch from
+        one evaluate_batch call, see supports["joint_batch"]
+
+        Parameters
+        ----------
+        x : np.ndarray[nt, dim]
+            Points in the scaled space, as passed to evaluate
+        xb : np.ndarray[dim]
+            Newly picked point, in the same space
+        bounds : np.ndarray[dim, 2]
+
+        Returns
+        -------
+        pen : np.ndarray[nt]
+        """
+        x = np.atleast_2d(x)
+        return self._batch_penalty(x, xb, bounds)*self._pdf_weight(x, bounds)
+
+    def eval_constraint(self, x, bounds=None, dir=0):
 
         # _x = ensure_2d_array(x, 'x')
 
         ans = self._eval_constraint(x, bounds, dir=dir)
 
-        pass
+        return ans
 
-    def eval_constraint_grad(self, x, bounds, dir=0):
+    def eval_constraint_grad(self, x, bounds=None, dir=0):
 
         # _x = ensure_2d_array(x, 'x')
 
         ans = self._eval_constraint_grad(x, bounds, dir=dir)
 
-        pass
+        return ans
 
     """
     Overwrite
@@ -344,12 +557,19 @@ class ASCriteria():
     def initialize(self, model=None):
         pass
 
+    def _update(self, new_x, new_f, new_g):
+        # rebuild from the shared model by default
+        self.initialize()
+
     def _evaluate(self, x, bounds, dir=0):
         pass
 
     def _eval_grad(self, x, bounds, dir=0):
         pass
 
+    def _batch_penalty(self, x, xb, bounds):
+        pass
+
     def _eval_constraint(self, x, bounds, dir=0):
         pass
 
@@ -381,68 +601,72 @@ class ASCriteria():
             fix_ind = [x for x in np.arange(0, n).tolist() if x not in sub_ind]
             xfix = qmc.scale(np.array([self.fix_val]), xlimits[fix_ind,0], xlimits[fix_ind,1], reverse=True)#[fix_ind]
 
-        def eval_eff(x, bounds, direction):
+        def full_x(x):
             x = np.atleast_2d(x)
             x_eff = np.zeros([x.shape[0], n])
             x_eff[:,sub_ind] = x
             x_eff[:,fix_ind] = xfix
-
-            y = self.evaluate(x_eff, bounds, direction)
-            
-            return y
+            return x_eff
 
         self.energy_mode = True
         # print(f"PAST EN PREP {rank}", flush = True)
         # energy, d0 = nquad(eval_eff, unit_bounds[sub_ind,:], args=(xlimits, dir))
-        res = eval_eff(self.e_x, xlimits, dir)
 
         # account for mean plus stdev
         if self.options["eta_weight"] is not None:
             # get original crit
-            scrit = HessianRefine(self.model, convert_to_smt_grads(self.model), xlimits, sub_index=sub_ind, 
-                                  pdf_weight=self.options["pdf_weight"], neval=self.options['neval'], rho=self.rho, 
-                                  rscale=self.options['rscale'],  scale_by_volume=False, 
-                                  return_rescaled=True, min_contribution=1e-14, 
-                                  print_rc_plots=False)
-
-            def eval_eff2(x, bounds, direction):
-                x = np.atleast_2d(x)
-                x_eff = np.zeros([x.shape[0], n])
-                x_eff[:,sub_ind] = x
-                x_eff[:,fix_ind] = xfix
-
-                y = scrit.evaluate(x_eff, bounds, direction)
-
-                return y
-
-            eta = self.options["eta_weight"]
-            mpart = np.sum(res, axis=0)/self.e_x.shape[0]
-            # Wu = 
-            x_eff = np.zeros([self.e_x.shape[0], n])
-            x_eff[:,sub_ind] = self.e_x
-            x_eff[:,fix_ind] = xfix
-            exs = qmc.scale(x_eff, xlimits[:,0], xlimits[:,1])
+            scrit = self._energy_scrit(xlimits, sub_ind)
             pdf_list, uncert_list, static_list, scales, pdf_name_list = _gen_var_lists(self.options['pdf_weight'], xlimits)
-            stats, vals = _mu_sigma_comp(self.model.predict_values, exs.shape[0], exs, xlimits, scales[sub_ind], pdf_list, tf = None, weights=None)
-            gstats, gvals = _mu_sigma_grad(self.model.predict_derivatives, exs.shape[0], exs, xlimits, scales[sub_ind], fix_ind, pdf_list, tf = vals, weights=None)
-            mn = stats[0]
-            dmn = gstats[0]
-            Wu = vals - mn
-            work = gvals[:,fix_ind] -dmn
-            dWu = np.linalg.norm(work, axis= 1)#*np.sign(work).flatten())
-
-            res2 = eval_eff2(self.e_x, xlimits, dir)
-            spart = abs(np.dot(res, dWu)/self.e_x.shape[0] + np.dot(res2, Wu)/self.e_x.shape[0])
-
-            energy = eta*mpart - (1.-eta)*np.sqrt(spart)
-            # breakpoint()
-        # print(f"PAST EN EVAL {rank}", flush = True)
-        else:
-            term = np.sum(res, axis=0)/self.e_x.shape[0]
-            if isinstance(term, np.ndarray):
-                energy = -np.linalg.norm(term[sub_ind])
+
+        # criteria values at the integration points, along with the model
+        # values and gradients when the stdev term needs them
+        def energy_terms(x):
+            x_eff = full_x(x)
+            res = self.evaluate_batch(x_eff, xlimits, dir).reshape(x_eff.shape[0], -1)
+            if self.options["eta_weight"] is not None:
+                exs = qmc.scale(x_eff, xlimits[:,0], xlimits[:,1])
+                res = np.append(res, scrit.evaluate_batch(x_eff, xlimits, dir).reshape(x_eff.shape[0], -1), axis=1)
+                res = np.append(res, self.model.predict_values(exs), axis=1)
+                res = np.append(res, convert_to_smt_grads(self.model, exs, deriv_predict=True), axis=1)
+            return res
+
+        # energy from the criteria values at points e_x
+        def energy_est(e_x, vals):
+            if self.options["eta_weight"] is not None:
+                res = vals[:,0]
+                res2 = vals[:,1]
+                eta = self.options["eta_weight"]
+                mpart = np.sum(res, axis=0)/e_x.shape[0]
+                # Wu = 
+                exs = qmc.scale(full_x(e_x), xlimits[:,0], xlimits[:,1])
+                stats, fvals = _mu_sigma_comp(None, exs.shape[0], exs, xlimits, scales[sub_ind], pdf_list, tf = vals[:,2:3], weights=None)
+                gstats, gvals = _mu_sigma_grad(None, exs.shape[0], exs, xlimits, scales[sub_ind], fix_ind, pdf_list, tf = fvals, tg = vals[:,3:], weights=None)
+                mn = stats[0]
+                dmn = gstats[0]
+                Wu = fvals - mn
+                work = gvals[:,fix_ind] -dmn
+                dWu = np.linalg.norm(work, axis= 1)#*np.sign(work).flatten())
+
+                spart = abs(np.dot(res, dWu)/e_x.shape[0] + np.dot(res2, Wu)/e_x.shape[0])
+
+                energy = eta*mpart - (1.-eta)*np.sqrt(spart)
+                # breakpoint()
+            # print(f"PAST EN EVAL {rank}", flush = True)
             else:
-                energy = term
+                term = np.sum(vals, axis=0)/e_x.shape[0]
+                if term.shape[0] > 1:
+                    energy = -np.linalg.norm(term[sub_ind])
+                else:
+                    energy = term[0]
+            return energy
+
+        integrator = self._energy_integrator(len(sub_ind))
+        if integrator is None:
+            energy = energy_est(self.e_x, energy_terms(self.e_x))
+        else:
+            # values only change with the data, the direction and the fixed variables
+            key = (self.ntr, self.trx.shape[0], dir, xlimits.tobytes(), np.asarray(self.fix_val, dtype=float).tobytes())
+            energy, self.energy_err = integrator.integrate(energy_terms, key=key, estimate=energy_est)
         
         # multiply by volume ?
         # vol = 1
@@ -453,14 +677,53 @@ class ASCriteria():
         self.energy_mode = False
         return -energy
 
+    def _energy_integrator(self, dim_u):
+        # None integrates over self.e_x
+        integ = self.options["energy_integrator"]
+        if isinstance(integ, str):
+            if integ == "lhs":
+                return None
+            if integ != "sobol":
+                raise ValueError(f'Unknown energy integrator {integ}')
+            if self.e_integrator is None or self.e_integrator.dim != dim_u:
+                self.e_integrator = SobolIntegrator(dim_u, rtol=self.options["energy_rtol"], 
+                                                    max_points=self.options["energy_max_points"])
+            return self.e_integrator
+        return integ
+
+    def _energy_scrit(self, xlimits, sub_ind):
+        # reuse the criteria while the model only gains points, instead of
+        # building it for every energy call
+        trx = self.model.training_points[None][0][0]
+        scrit = self.e_scrit
+        if scrit is not None and scrit.model is self.model and scrit.ntr < trx.shape[0]:
+            trf = self.model.training_points[None][0][1]
+            nold = scrit.ntr
+            scrit.options.update({"rho":self.rho})
+            scrit.update(trx[nold:], trf[nold:], convert_to_smt_grads(self.model)[nold:])
+        elif scrit is None or scrit.model is not self.model or scrit.ntr != trx.shape[0]:
+            # the criteria with an incremental _update, imported here since
+            # hess_criteria imports this module
+            from infill.hess_criteria import HessianRefine as HessianRefineInc
+            scrit = HessianRefineInc(self.model, convert_to_smt_grads(self.model), xlimits, sub_index=sub_ind, 
+                                     pdf_weight=self.options["pdf_weight"], neval=self.options['neval'], rho=self.rho, 
+                                     rscale=self.options['rscale'],  scale_by_volume=False, 
+                                     return_rescaled=True, min_contribution=1e-14, 
+                                     print_rc_plots=False, copy_model=False)
+            self.e_scrit = scrit
+
+        return scrit
+
     
 """
 A Continuous Leave-One-Out Cross Validation function
 """
 class looCV(ASCriteria):
     def __init__(self, model, **kwargs):
-        super().__init__(model, **kwargs)
         self.dminmax = None
+        super().__init__(model, **kwargs)
+
+        self.supports["obj_derivatives"] = True
 
 
     def _init_options(self):
@@ -472,6 +735,7 @@ class looCV(ASCriteria):
         self.condict = {
             "type":"ineq",
             "fun":self.eval_constraint,
+            "jac":self.eval_constraint_grad,
             "args":[],
         }
 
@@ -482,75 +746,57 @@ class looCV(ASCriteria):
             self.dim = self.model.training_points[None][kx][0].shape[1]
             self.ntr = self.model.training_points[None][kx][0].shape[0]
 
-        # Create a list of LOO surrogate models
-        self.loosm = []
-        for i in range(self.ntr):
-            self.loosm.append(copy.deepcopy(self.model))
-            self.loosm[i].options.update({"print_global":False})
-
-            kx = 0
-
-            # Give each LOO model its training data, and retrain if not approximating
-            trx = self.loosm[i].training_points[None][kx][0]
-            trf = self.loosm[i].training_points[None][kx][1]
-            trg = []
-                
-            trx = np.delete(trx, i, 0)
-            trf = np.delete(trf, i, 0)
-            
-
-            self.loosm[i].set_training_values(trx, trf)
-            if(isinstance(self.model, GEKPLS) or isinstance(self.model, POUSurrogate)):
-                for j in range(self.dim):
-                    trg.append(self.loosm[i].training_points[None][j+1][1]) #TODO:make this optional
-                for j in range(self.dim):
-                    trg[j] = np.delete(trg[j], i, 0)
-                for j in range(self.dim):
-                    self.loosm[i].set_training_derivatives(trx, trg[j][:], j)
-
-            if(self.options["approx"] == False):
-                self.loosm[i].train()
+        # LOO predictions, only copies and retrains the model if it has no faster way
+        self.loo = LOOPredictor(self.model, retrain=not self.options["approx"])
 
         # Get the cluster threshold for exploration constraint
-        dists = pdist(trx)
-        dists = squareform(dists)
-        mins = np.zeros(self.ntr)
-        for i in range(self.ntr):
-            ind = dists[i,:]
-            ind = np.argsort(ind)
-            mins[i] = dists[i,ind[1]]
-        self.dminmax = max(mins)
+        trx = self.model.training_points[None][0][0]
+        dists = squareform(pdist(trx))
+        self.dminmax = max(np.sort(dists, axis=1)[:,1])
 
     #TODO: This could be a variety of possible LOO-averaging functions
-    def _evaluate(self, x, dir=0):
+    def _evaluate(self, x, bounds, dir=0):
         
         if(len(x.shape) != 2):
             x = np.array([x])
 
         # evaluate the point for the original model
         #import pdb; pdb.set_trace()
-        M = self.model.predict_values(x).flatten()
+        M = self.model.predict_values(x)
 
-        # now evaluate the point for each LOO model and sum
-        y = 0
-        for i in range(self.ntr):
-            Mm = self.loosm[i].predict_values(x).flatten()
-            y += (1/self.ntr)*((M-Mm)**2)
+        # now evaluate the point for each LOO model and average
+        Mm = self.loo.predict(x)
+        y = np.mean((M - Mm)**2, axis=1)
         
         ans = -np.sqrt(y)
 
         return ans # to work with optimizers
 
+    def _eval_grad(self, x, bounds, dir=0):
+
+        x = np.atleast_2d(x)
+
+        M = self.model.predict_values(x)
+        dM = convert_to_smt_grads(self.model, x, deriv_predict=True)
+
+        Mm = self.loo.predict(x)
+        dMm = self.loo.predict_derivatives(x)
+
+        work = M - Mm
+        y = np.mean(work**2, axis=1)
+        dy = 2*np.einsum('ij,ijk->ik', work, dM[:,None,:] - dMm)/work.shape[1]
+
+        # not differentiable where all LOO models agree
+        ans = -dy/(2*np.maximum(np.sqrt(y), 1e-16)[:,None])
+
+        return ans
+
     # if only using local optimization, start the optimizer at the worst LOO point
     def _pre_asopt(self, bounds, dir=0):
         t0 = self.model.training_points[None][0][0]
         #import pdb; pdb.set_trace()
-        diff = np.zeros(self.ntr)
-
-        for i in range(self.ntr):
-            M = self.model.predict_values(t0[[i]]).flatten()
-            Mm = self.loosm[i].predict_values(t0[[i]]).flatten()
-            diff[i] = abs(M - Mm)
+        M = self.model.predict_values(t0).flatten()
+        diff = abs(M - self.loo.values())
 
         ind = np.argmax(diff)
 
@@ -561,15 +807,21 @@ class looCV(ASCriteria):
         return x
         
 
-    def _eval_constraint(self, x, dir=0):
+    def _eval_constraint(self, x, bounds=None, dir=0):
         t0 = self.model.training_points[None][0][0]
 
-        con = np.zeros(self.ntr)
-        for i in range(self.ntr):
-            con[i] = np.linalg.norm(x - t0[i])
+        con = np.linalg.norm(x - t0, axis=1)
 
         return con - 0.5*self.dminmax
 
+    def _eval_constraint_grad(self, x, bounds=None, dir=0):
+        t0 = self.model.training_points[None][0][0]
+
+        work = x - t0
+        dcon = work/np.maximum(np.linalg.norm(work, axis=1), np.finfo(float).tiny)[:,None]
+
+        return dcon
+
 
 # Hessian estimation and direction criteria
 
@@ -917,6 +1169,8 @@ class TEAD(ASCriteria):
         self.cand = None
         self.dminmax = None
         self.lmax = None
+        self.emax = None
+        self.trg = None
         self.grad = grad
         self.bounds = bounds
         self.bad_list = None
@@ -925,6 +1179,8 @@ class TEAD(ASCriteria):
 
         super().__init__(model, **kwargs)
 
+        self.supports["obj_derivatives"] = True
+        self.supports["batch_eval"] = True
         self.opt = False #no optimization performed for this
         
     def _init_options(self):
@@ -960,57 +1216,91 @@ class TEAD(ASCriteria):
                 for j in range(self.dim):
                     trg[:,j] = self.model.training_points[None][j+1][1].flatten()
         else:
-            for j in range(self.dim):
-                trg[:,j] = self.model.predict_derivatives(trx, j)[:,0]
-        
+            trg = convert_to_smt_grads(self.model, trx, deriv_predict=True)
+        self.trg = trg
+
+        # number of points to pick
+        self.nnew = self.options["improve"]
+        if(self.nnew == 0):
+            self.nnew = 1
 
         # 1. Generate candidate points, determine reference distances and neighborhoods
         sampling = LHS(xlimits=self.bounds, criterion='m')
         ncand = self.options["ncand"]
         self.cand = sampling(ncand)
-        dists = cdist(self.cand, trx)
-
-        mins = np.zeros(ncand)
-        nbhd = np.zeros([ncand, self.options["neval"]], dtype=int)
-        for i in range(ncand):
-            ind = dists[i,:]
-            ind = np.argsort(ind)
-            mins[i] = dists[i,ind[0]]
-            nbhd[i] = ind[0:self.options["neval"]]
+        mins, nbhd, lerr, dmax = self._tead_terms(self.cand)
         self.dminmax = max(mins)
-        self.lmax = np.amax(dists)
+        self.lmax = max(dmax)
+        self.emax = max(lerr)
 
         # 2. For every candidate point, sum the discrepancies between the linear (quadratic)
-        # prediction in the neighborhood and the surrogate value at the candidate point
-        lerr = np.zeros(ncand)
-        err = np.zeros(ncand)
-        for i in range(ncand):
-            for key in nbhd[i,0:self.options["neval"]]:
-                fh = linear(self.cand[i], trx[key], trf[key], trg[:][key])
-                lerr[i] += abs(model.predict_values(self.cand[[i],:]) - fh)
-
-            lerr[i] /= self.options["neval"]
-
-        emax = max(lerr)
-        for i in range(ncand):
-            # ADDING A DISTANCE PENALTY TERM
-            lerr[i] /= emax
-            w = 1. - mins[i]/self.lmax
-            err[i] += mins[i]/self.dminmax + w*lerr[i]
+        # prediction in the neighborhood and the surrogate value at the candidate point,
+        # with a distance penalty term
+        err = -self._evaluate(qmc.scale(self.cand, self.bounds[:,0], self.bounds[:,1], reverse=True), self.bounds)
 
         # 2a. Pick some percentage of the "worst" points
         badlist = np.argsort(err)
         badlist = badlist[-self.nnew:]
         bads = self.cand[badlist]
-        bad_nbhd = np.zeros([bads.shape[0], self.options["neval"]], dtype=int)
-        for i in range(bads.shape[0]):
-            bad_nbhd[i,:] = nbhd[badlist[i]]
+        bad_nbhd = nbhd[badlist]
 
         # we have what we need
         self.bad_list = badlist
         self.bads = bads
         self.bad_nbhd = bad_nbhd
 
+    def _evaluate(self, x, bounds, dir=0):
+        """
+        Negative TEAD score at the rows of x, scaled to bounds, using the
+        reference distances and error of the candidate set
+        """
+        X = qmc.scale(np.atleast_2d(x), bounds[:,0], bounds[:,1])
+        mins, nbhd, lerr, dmax = self._tead_terms(X)
+
+        w = 1. - mins/self.lmax
+        err = mins/self.dminmax + w*lerr/self.emax
+
+        return -err
+
+    def _eval_grad(self, x, bounds, dir=0):
+
+        X = qmc.scale(np.atleast_2d(x), bounds[:,0], bounds[:,1])
+        mins, nbhd, lerr, dmax, dmins, dlerr = self._tead_terms(X, grad=True)
+
+        w = 1. - mins/self.lmax
+        dw = -dmins/self.lmax
+        derr = dmins/self.dminmax + (dw*lerr[:,None] + w[:,None]*dlerr)/self.emax
+
+        return -derr*(bounds[:,1] - bounds[:,0])
+
+    def _tead_terms(self, X, grad=False):
+        """
+        Distance to the nearest sample, neighborhood, mean discrepancy between
+        the neighborhood linear predictions and the surrogate, and distance to
+        the farthest sample for each row of X. If grad, also the gradients of
+        the distance and the discrepancy
+        """
+        trx = self.model.training_points[None][0][0]
+        trf = self.model.training_points[None][0][1].flatten()
+        neval = self.options["neval"]
+
+        dists = cdist(X, trx)
+        nbhd = np.argsort(dists, axis=1)[:,0:neval]
+        mins = dists[np.arange(X.shape[0]), nbhd[:,0]]
+
+        fm = self.model.predict_values(X)
+        fh = trf[nbhd] + np.einsum('ijk,ijk->ij', X[:,None,:] - trx[nbhd], self.trg[nbhd])
+        lerr = np.mean(abs(fm - fh), axis=1)
+
+        if not grad:
+            return mins, nbhd, lerr, np.max(dists, axis=1)
+
+        dmins = (X - trx[nbhd[:,0]])/mins[:,None]
+        dfm = convert_to_smt_grads(self.model, X, deriv_predict=True)
+        dlerr = np.mean(np.sign(fm - fh)[:,:,None]*(dfm[:,None,:] - self.trg[nbhd]), axis=1)
+
+        return mins, nbhd, lerr, np.max(dists, axis=1), dmins, dlerr
+
     def _post_asopt(self, x, bounds, dir=0):
 
         return self.bads[dir]
@@ -1048,7 +1338,7 @@ BAD WORKAROUND INCOMING
 from scipy.spatial import KDTree
 from scipy.spatial.distance import pdist, cdist, squareform
 # from scipy.optimize import Bounds
-from utils.sutils import divide_cases, innerMatrixProduct, quadraticSolveHOnly, symMatfromVec, estimate_pou_volume,  standardization2, gen_dist_func_nb
+from utils.sutils import divide_cases, innerMatrixProduct, quadraticSolveHOnly, symMatfromVec, symMatUnpack, estimate_pou_volume,  standardization2, gen_dist_func_nb
 
 
 
@@ -1066,6 +1356,8 @@ class HessianRefine(ASCriteria):
         self.scaler = 0
 
         self.supports["obj_derivatives"] = True  
+        self.supports["serial_eval"] = False # evaluations always split over all procs
+        self.supports["batch_eval"] = True
         
     def _init_options(self):
         declare = self.options.declare
@@ -1191,8 +1483,10 @@ class HessianRefine(ASCriteria):
 
         # Check if the trained surrogate model has hessian data
         try:
-            self.H = model.h
-            self.Mc = model.Mc
+            self.H = self.model.h
+            self.Mc = self.model.Mc
+            if self.H.ndim == 2:
+                self.H = symMatUnpack(self.H, self.dim)
         except:
             indn = []
             nstencil = self.options["neval"]
@@ -1371,9 +1665,9 @@ class HessianRefine(ASCriteria):
         # this should only work for 
         for i in range(dir):
             ind = self.ntr + i
-            work = x - trx[ind]
+            work = X_cont - trx[ind]
             # dirdist = np.sqrt(np.dot(work, work)) 
-            dirdist = np.linalg.norm(work) 
+            dirdist = np.linalg.norm(work, axis=1) 
             # ans += 1./(np.dot(work, work) + 1e-10)
             ans += np.exp(-self.rho*(dirdist + delta))
 
@@ -1469,15 +1763,15 @@ class HessianRefine(ASCriteria):
         # for batches, loop over already added points to prevent clustering
         for i in range(dir):
             ind = self.ntr + i
-            work = x - trx[ind]
+            work = X_cont - trx[ind]
             #dwork = np.eye(n)
             # d2 = np.dot(work, work)
             # dd2 = 2*work
-            dirdist = np.linalg.norm(work) 
+            dirdist = np.linalg.norm(work, axis=1) 
             # term = 1.0/(d2 + 1e-10)
             # ans += -1.0/((d2 + 1e-10)**2)*dd2
-            ddirdist = work/dirdist
-            quant = -self.rho*ddirdist*np.exp(-self.rho*(dirdist+ delta))
+            ddirdist = work/dirdist[:,None]
+            quant = -self.rho*ddirdist*np.exp(-self.rho*(dirdist+ delta))[:,None]
             ans += quant
 
             # import pdb; pdb.set_trace()
@@ -1496,11 +1790,10 @@ class HessianRefine(ASCriteria):
 
     def higher_terms_deriv(self, dx, g, h):
         # terms = (g*dx).sum(axis = 1)
-        dterms = np.zeros_like(dx)
         # for j in range(dx.shape[0]):
-        for d in range(dx.shape[1]):
-            # dterms[j,d] = np.dot(h[j,d,:], dx[j,:])#0.5*innerMatrixProduct(h, dx)
-            dterms = np.einsum('ik, ik ->i', h[:,d,:], dx)
+        #     dterms[j,d] = np.dot(h[j,d,:], dx[j,:])#0.5*innerMatrixProduct(h, dx)
+        # every column d at once, h is symmetric
+        dterms = np.einsum('ijk,ik->ij', h, dx)
 
         if self.options["return_rescaled"]:
             dterms *= self.y_sca
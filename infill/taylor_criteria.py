@@ -36,6 +36,8 @@ class TaylorRefine(ASCriteria):
         super().__init__(model, **kwargs)
 
         self.supports["obj_derivatives"] = True  
+        self.supports["batch_eval"] = True
+        self.supports["joint_batch"] = True
         
     def _init_options(self):
 
@@ -99,13 +101,13 @@ class TaylorRefine(ASCriteria):
         m, n = trx.shape
         N = self.numer
 
-        ans = -self.tmodel.predict_values(np.array([x]), self.model)#*(10**n)
+        X = np.atleast_2d(x)
+        ans = -self.tmodel.predict_values(X, self.model)#*(10**n)
 
         # for batches, loop over already added points to prevent clustering
         for i in range(dir):
             ind = self.ntr + i
-            work = x - trx[ind]
-            ans += N/(np.dot(work, work) + 1e-10)
+            ans += self._batch_penalty(X, trx[ind], bounds)
 
         return ans 
 
@@ -118,23 +120,29 @@ class TaylorRefine(ASCriteria):
         m, n = trx.shape
         N = self.numer
 
-        ans = -self.tmodel.predict_derivatives(np.array([x]), self.model)#*(10**n)
+        X = np.atleast_2d(x)
+        ans = -self.tmodel.predict_derivatives(X, self.model)#*(10**n)
 
         # for batches, loop over already added points to prevent clustering
         for i in range(dir):
             ind = self.ntr + i
-            work = x - trx[ind]
+            work = X - trx[ind]
             #dwork = np.eye(n)
-            d2 = np.dot(work, work)
+            d2 = np.einsum('ij,ij->i', work, work)
             dd2 = 2*work
-            term = N/(d2 + 1e-10)
-            ans += -N/((d2 + 1e-10)**2)*dd2
+            ans += (-N/((d2 + 1e-10)**2))[:,None]*dd2
         
         return ans
 
 
 
 
+    def _batch_penalty(self, x, xb, bounds):
+
+        work = x - xb
+        return self.numer/(np.einsum('ij,ij->i', work, work) + 1e-10)
+
+
     def pre_asopt(self, bounds, dir=0):
         
         trx = self.trx
@@ -149,10 +157,8 @@ class TaylorRefine(ASCriteria):
             xc = np.random.rand(n)*(bounds[:,1] - bounds[:,0]) + bounds[:,0]
             xc = np.array([xc])
 
-        errs = np.zeros(ntries)
         xc_scale = qmc.scale(xc, bounds[:,0], bounds[:,1], reverse=True)
-        for i in range(ntries):
-            errs[i] = self.evaluate(xc_scale[i], bounds, dir=0)
+        errs = self.evaluate_batch(xc_scale, bounds, dir=0)
 
         # For batches, set a numerator based on the scale of the error
         self.numer = abs(np.mean(errs))/100.
@@ -163,7 +169,7 @@ class TaylorRefine(ASCriteria):
 
     def post_asopt(self, x, bounds, dir=0):
 
-        self.trx = np.append(self.trx, np.array([x]), axis=0)
+        self.trx = np.append(self.trx, np.atleast_2d(x), axis=0)
 
         return x
 
@@ -182,6 +188,8 @@ class TaylorExploreRefine(TaylorRefine):
 
         super().__init__(model, grad, bounds, **kwargs)
 
+        # no clustering term for batches, only the distance term to all points
+        self.supports["joint_batch"] = False
 
         
     def _init_options(self):
@@ -199,17 +207,15 @@ class TaylorExploreRefine(TaylorRefine):
 
         # TODO: Need to normalize these in some way
         # error term
-        ans = -self.tmodel.predict_values(np.array([x]), self.model)
+        X = np.atleast_2d(x)
+        ans = -self.tmodel.predict_values(X, self.model)
 
         # distance term
-        for i in range(m):
-            work = x-trx[i]
-            #dist = np.matmul(np.matmul(work, mwork), work)
-            dist = np.linalg.norm(work)
-            if(self.options["objective"] == "inv"):
-                ans += N/(m*(dist + 1e-10))
-            elif(self.options["objective"] == "abs"):
-                ans += -dist/m
+        dist = cdist(X, trx)
+        if(self.options["objective"] == "inv"):
+            ans += np.sum(N/(m*(dist + 1e-10)), axis=1)
+        elif(self.options["objective"] == "abs"):
+            ans += -np.sum(dist, axis=1)/m
 
         return ans 
 
@@ -222,17 +228,16 @@ class TaylorExploreRefine(TaylorRefine):
         m, n = trx.shape
         N = self.numer
 
-        ans = -self.tmodel.predict_derivatives(np.array([x]), self.model)
+        X = np.atleast_2d(x)
+        ans = -self.tmodel.predict_derivatives(X, self.model)
             
-        for i in range(m):
-            work = x-trx[i]
-            #dist = np.matmul(np.matmul(work, mwork), work)
-            dist = np.linalg.norm(work)
-            ddist = np.ones_like(work)
-            if(self.options["objective"] == "inv"):
-                ans += (-N/((dist + 1e-10)**2))*ddist/m
-            elif(self.options["objective"] == "abs"):
-                ans += -ddist/m
+        work = X[:,None,:] - trx[None,:,:]
+        dist = np.sqrt(np.einsum('ijk,ijk->ij', work, work))
+        ddist = work/(dist[:,:,None] + 1e-10)
+        if(self.options["objective"] == "inv"):
+            ans += np.einsum('ij,ijk->ik', -N/((dist + 1e-10)**2), ddist)/m
+        elif(self.options["objective"] == "abs"):
+            ans += -np.sum(ddist, axis=1)/m
 
         return ans
 
@@ -260,6 +265,6 @@ class TaylorExploreRefine(TaylorRefine):
 
     def post_asopt(self, x, bounds, dir=0):
         # Add new points to the distance term, but not the error term
-        self.trx = np.append(self.trx, np.array([x]), axis=0)
+        self.trx = np.append(self.trx, np.atleast_2d(x), axis=0)
 
         return x
\ No newline at end of file
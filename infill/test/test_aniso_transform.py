@@ -0,0 +1,68 @@
+import unittest
+import numpy as np
+
+from infill.aniso_transform import AnisotropicTransform, get_residual, get_res_jac, get_residual_batch, get_res_jac_batch
+from smt.problems import Rosenbrock
+from smt.sampling_methods import LHS
+from smt.surrogate_models import KRG
+from scipy.stats import qmc
+from scipy.spatial.distance import cdist
+
+
+class AnisoTransformTest(unittest.TestCase):
+
+    def setUp(self):
+        dim = 2
+        trueFunc = Rosenbrock(ndim=dim)
+        self.xlimits = trueFunc.xlimits
+        xt = LHS(xlimits=self.xlimits, criterion='m', random_state=0)(12)
+        gt = np.hstack([trueFunc(xt, j) for j in range(dim)])
+
+        model = KRG(print_global=False)
+        model.set_training_values(xt, trueFunc(xt))
+        model.train()
+
+        self.crit = AnisotropicTransform(model, qmc.Sobol(d=dim, seed=0), gt, interp="honly", pdf_weight=[0.]*dim)
+        self.xinew = LHS(xlimits=self.xlimits, random_state=4)(6)
+
+    def _nbhd(self, xinew):
+        nmatch = self.crit.options["nmatch"]
+        ind = np.argsort(cdist(np.atleast_2d(xinew), self.crit.trxi))[0][:nmatch]
+        return self.crit.trx[ind], self.crit.trxi[ind], self.crit.mmodel[ind]
+
+    def test_batch_residual(self):
+        nmatch = self.crit.options["nmatch"]
+        x = LHS(xlimits=self.xlimits, random_state=5)(self.xinew.shape[0])
+
+        nbhd = [self._nbhd(xi) for xi in self.xinew]
+        nbhdx = np.array([nb[0] for nb in nbhd])
+        d2r = np.array([np.sum((xi - nb[1])**2, axis=1) for xi, nb in zip(self.xinew, nbhd)])
+        M = np.array([nb[2] for nb in nbhd])
+        res = get_residual_batch(x, d2r, nbhdx, M)
+        jac = get_res_jac_batch(x, nbhdx, M)
+
+        for b in range(x.shape[0]):
+            nx, nxi, Mb = nbhd[b]
+            r = get_residual(x[b], self.xinew[b], nx, nxi, Mb, nmatch)
+            J = get_res_jac(x[b], self.xinew[b], nx, nxi, Mb, nmatch)
+            self.assertTrue(np.max(np.abs(res[b] - r)) < 1.e-12*np.max(np.abs(r)))
+            self.assertTrue(np.max(np.abs(jac[b] - J)) < 1.e-12*np.max(np.abs(J)))
+
+    def test_transform_matches_lsq(self):
+        nmatch = self.crit.options["nmatch"]
+        width = self.xlimits[:,1] - self.xlimits[:,0]
+        xlm = self.crit.transform(self.xinew, self.xlimits)
+
+        for b in range(self.xinew.shape[0]):
+            xls = self.crit._transform_lsq(self.xinew[[b]], self.xlimits)
+            nx, nxi, M = self._nbhd(self.xinew[b])
+            clm = np.sum(get_residual(xlm[b], self.xinew[b], nx, nxi, M, nmatch)**2)
+            cls = np.sum(get_residual(xls, self.xinew[b], nx, nxi, M, nmatch)**2)
+
+            self.assertTrue(np.all(xlm[b] >= self.xlimits[:,0]) and np.all(xlm[b] <= self.xlimits[:,1]))
+            self.assertTrue(np.max(np.abs(xlm[b] - xls)/width) < 1.e-5)
+            self.assertTrue(clm <= cls*(1. + 1.e-8) + 1.e-12)
+
+
+if __name__ == '__main__':
+    unittest.main()
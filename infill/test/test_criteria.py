@@ -0,0 +1,113 @@
+import unittest
+import numpy as np
+
+from infill.refinecriteria import looCV, TEAD
+from infill.loocv_criteria import POUSSA, POUSFCVT, SFCVT
+from infill.hess_criteria import HessianGradientRefine
+from surrogate.pougrad import POUHessian
+from smt.problems import Rosenbrock
+from smt.sampling_methods import LHS
+from smt.surrogate_models import KRG
+
+
+def _train_models(dim=2, nt=15):
+    trueFunc = Rosenbrock(ndim=dim)
+    xlimits = trueFunc.xlimits
+    xt = LHS(xlimits=xlimits, criterion='m', random_state=0)(nt)
+    ft = trueFunc(xt)
+    gt = np.hstack([trueFunc(xt, j) for j in range(dim)])
+
+    pou = POUHessian(bounds=xlimits, rscale=5.5, neval=2*dim, print_global=False)
+    pou.set_training_values(xt, ft)
+    for j in range(dim):
+        pou.set_training_derivatives(xt, gt[:,j:j+1], j)
+    pou.train()
+
+    krg = KRG(print_global=False)
+    krg.set_training_values(xt, ft)
+    krg.train()
+
+    return pou, krg, gt, xlimits
+
+
+class CriteriaGradTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pou, self.krg, self.gt, self.xlimits = _train_models()
+        dim = self.xlimits.shape[0]
+        self.pdf_weight = [0.]*dim
+
+        # test points in the unit, model and original spaces
+        self.xu = LHS(xlimits=np.array([[0., 1.]]*dim), random_state=3)(4)
+        self.xr = self.xu*(self.xlimits[:,1] - self.xlimits[:,0]) + self.xlimits[:,0]
+        self.xn = (self.xr - self.pou.X_offset)/self.pou.X_scale
+
+    def _check(self, crit, x, constraint=False, tol=1.e-5):
+        grad, grad_fd, err = crit.check_grads(x, self.xlimits, constraint=constraint)
+        self.assertTrue(np.max(err) < tol)
+
+    def test_pou_criteria(self):
+        for ctype in [POUSSA, POUSFCVT]:
+            crit = ctype(self.pou, self.gt, self.xlimits, pdf_weight=self.pdf_weight)
+            self._check(crit, self.xn)
+            self._check(crit, self.xn, constraint=True)
+
+            # nearest sample distance is not differentiable on the samples
+            dcon = crit.eval_constraint_grad(crit.trx[0], self.xlimits)
+            self.assertTrue(np.all(np.isfinite(dcon)))
+
+    def test_sfcvt(self):
+        crit = SFCVT(self.krg, self.gt, self.xlimits, pdf_weight=self.pdf_weight)
+        crit.pre_asopt(self.xlimits)
+        self._check(crit, self.xr)
+        self._check(crit, self.xr, constraint=True)
+
+    def test_loocv(self):
+        crit = looCV(self.krg, pdf_weight=self.pdf_weight)
+        self._check(crit, self.xr)
+        self._check(crit, self.xr, constraint=True)
+
+        t0 = self.krg.training_points[None][0][0]
+        dcon = crit.eval_constraint_grad(t0[0])
+        self.assertTrue(np.all(np.isfinite(dcon)))
+
+    def test_tead(self):
+        crit = TEAD(self.krg, self.gt, self.xlimits, pdf_weight=self.pdf_weight, gradexact=True, neval=3)
+        self._check(crit, self.xu)
+
+
+class EnergyCriteriaTest(unittest.TestCase):
+
+    def test_update_shares_model(self):
+        pou, krg, gt, xlimits = _train_models(nt=20)
+        trueFunc = Rosenbrock(ndim=2)
+        kwargs = {"sub_index":[1], "pdf_weight":[0.5, ['uniform']], "grad_select":[0], "eta_weight":0.5,
+                  "neval":5, "rscale":0.5, "copy_model":False}
+        e_x = np.random.default_rng(4).random([200, 1])
+
+        crit = HessianGradientRefine(pou, gt, xlimits, **kwargs)
+        crit.set_static(np.array([0.5]))
+        crit.e_x = e_x
+        crit.get_energy(xlimits)
+        scrit = crit.e_scrit
+        self.assertTrue(crit.model is pou and scrit.model is pou)
+
+        xn = LHS(xlimits=xlimits, random_state=5)(3)
+        gn = np.hstack([trueFunc(xn, j) for j in range(2)])
+        pou.add_points(xn, trueFunc(xn), gn)
+        crit.update(xn, trueFunc(xn), gn, model=pou)
+        crit.get_energy(xlimits)
+
+        # the energy criteria is updated in place, and matches a new one
+        fresh = HessianGradientRefine(pou, np.append(gt, gn, axis=0), xlimits, **kwargs)
+        fresh.set_static(np.array([0.5]))
+        fresh.e_x = e_x
+        fresh.get_energy(xlimits)
+        self.assertTrue(crit.e_scrit is scrit)
+        self.assertEqual(scrit.ntr, 23)
+        self.assertTrue(abs(scrit.rho - fresh.e_scrit.rho) < 1.e-12*fresh.e_scrit.rho)
+        self.assertTrue(np.max(np.abs(scrit.H - fresh.e_scrit.H)) < 1.e-10*np.max(np.abs(fresh.e_scrit.H)))
+
+
+if __name__ == '__main__':
+    unittest.main()
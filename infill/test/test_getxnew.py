@@ -0,0 +1,71 @@
+import unittest
+import numpy as np
+
+from infill.getxnew import getxnew
+from infill.hess_criteria import HessianRefine
+from smt.problems import Rosenbrock
+from smt.sampling_methods import LHS
+from smt.surrogate_models import KRG
+from scipy.stats import qmc
+from scipy.spatial.distance import pdist
+
+
+class JointBatchTest(unittest.TestCase):
+
+    def test_joint_batch(self):
+        dim = 2
+        batch = 3
+        trueFunc = Rosenbrock(ndim=dim)
+        xlimits = trueFunc.xlimits
+        xt = LHS(xlimits=xlimits, criterion='m', random_state=0)(10)
+        gt = np.hstack([trueFunc(xt, j) for j in range(dim)])
+
+        model = KRG(print_global=False)
+        model.set_training_values(xt, trueFunc(xt))
+        model.train()
+
+        rcrit = HessianRefine(model, gt, xlimits, neval=5, rscale=0.5, pdf_weight=[0.]*dim)
+
+        # keep the candidates and their criteria values, before any penalty
+        cand = {}
+        evaluate_batch = rcrit.evaluate_batch
+        def record(x, bounds, dir=0):
+            y = evaluate_batch(x, bounds, dir)
+            cand["x"] = np.copy(x)
+            cand["y"] = np.copy(y)
+            return y
+        rcrit.evaluate_batch = record
+
+        # and the start points of the criteria
+        pre_asopt = rcrit.pre_asopt
+        def record_starts(bounds, dir=0):
+            x0, lbounds = pre_asopt(bounds, dir)
+            cand["x0"] = np.copy(x0)
+            return x0, lbounds
+        rcrit.pre_asopt = record_starts
+
+        options = {"batch_mode":"joint", "joint_ncand":200, "joint_seed":3}
+        xnew = getxnew(rcrit, xlimits, batch, options=options)
+
+        # the start points are candidates
+        x0u = qmc.scale(cand["x0"], xlimits[:,0], xlimits[:,1], reverse=True)
+        self.assertEqual(cand["x"].shape[0], 200 + x0u.shape[0])
+        self.assertTrue(np.allclose(cand["x"][200:], x0u))
+
+        # the LHS candidates are seeded
+        first = dict(cand)
+        getxnew(rcrit, xlimits, batch, options=options)
+        self.assertTrue(np.array_equal(cand["x"][:200], first["x"][:200]))
+
+        self.assertEqual(xnew.shape, (batch, dim))
+        self.assertTrue(np.all(xnew >= xlimits[:,0]) and np.all(xnew <= xlimits[:,1]))
+        self.assertTrue(np.min(pdist(xnew)) > 0.)
+
+        # without the penalty, the second pick would be the runner up candidate
+        xu = qmc.scale(xnew, xlimits[:,0], xlimits[:,1], reverse=True)
+        runner_up = first["x"][np.argsort(first["y"])[1]]
+        self.assertTrue(np.linalg.norm(xu[1] - xu[0]) > np.linalg.norm(runner_up - xu[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,6 +16,17 @@ gpop : int
 liter : int
     Local optimizer iterations 
 errorcheck : list, [xdata, fdata]
+multistart : int
+    0: one local optimization, 1: start at the best start point, 2: optimize from every start point
+parallel_multistart : bool
+    If multistart is 2, split the start points over procs
+batch_mode : string
+    "sequential": optimize each batch point in turn, "joint": pick the whole batch
+    at once from one evaluation over a candidate set, if the criteria supports it
+joint_ncand : int
+    Number of candidates for joint batches, 100 per refined dimension if None
+joint_seed : int
+    Seed of the joint batch candidates, offset by the number of training points. Unseeded if None
 """
 
 DefaultOptOptions = {
@@ -31,5 +42,9 @@ DefaultOptOptions = {
     "liter":100,
     "ltol":1e-6,
     "errorcheck":None,
-    "multistart":2
+    "multistart":2,
+    "parallel_multistart":True,
+    "batch_mode":"sequential",
+    "joint_ncand":None,
+    "joint_seed":0
 }
\ No newline at end of file
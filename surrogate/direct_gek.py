@@ -2,7 +2,8 @@
 Implementation of direct Gradient-Enhanced Kriging in the SMT package
 """
 import numpy as np
-from scipy import linalg
+from scipy import linalg, optimize
+from scipy.linalg import lapack
 from smt.surrogate_models.krg_based import KrgBased
 from smt.utils.kriging_utils import ge_compute_pls
 
@@ -45,6 +46,13 @@ class DGEK(KrgBased):
             types=np.ndarray,
             desc="Lower/upper bounds in each dimension - ndarray [nx, 2]",
         )
+        declare(
+            "hyper_opt",
+            "Cobyla",
+            values=("Cobyla", "TNC", "L-BFGS-B"),
+            desc="Optimiser for hyperparameters optimisation, L-BFGS-B uses the analytic likelihood gradient",
+            types=(str),
+        )
         self.supports["training_derivatives"] = True
 
     def _componentwise_distance(self, dx, opt=0, theta=None, return_derivative=False):
@@ -113,184 +121,92 @@ class DGEK(KrgBased):
         noise = self.noise0
         tmp_var = theta
 
+        aug = self._augmented_system()
+        nt = self.nt
+        n_comp = self.nx
+        full_size = nt + nt*n_comp
 
         # Compute correlation kernels
-        dx = differences(self.X_norma, self.X_norma)
-        dxx, ij = cross_distances(self.X_norma)
+        dxx = aug["dx"]
         dd = self._componentwise_distance(
             dxx, theta=theta, return_derivative=True
         )
-        # dx = self.D
-        # dx = 0
-        # dd, ij = cross_distances(self.X_norma)
-        # for j in range(dd.shape[1]):
-        #     dd[:,j] *= 2*theta[j]
-        # import pdb; pdb.set_trace()
         derivative_dic = {"dx": dxx, "dd": dd}
         hess_dic = {"dx": dxx, "dd": dd}
-        r = self._correlation_types[self.options["corr"]](theta, self.D).reshape(
-            -1, 1
-        )
         r, dr = self._correlation_types[self.options["corr"]](theta, self.D, derivative_params=derivative_dic)
         d2r = self._correlation_types[self.options["corr"]](theta, self.D, derivative_params=derivative_dic, hess_params=hess_dic)
 
-
-        #check derivs
-        # h = 1e-6
-        # # self.D[0] = 0.
-        # self.D[0][0] += h
-        # rf = self._correlation_types[self.options["corr"]](theta, self.D)
-        # self.D[0][0] -= 2*h
-        # rb = self._correlation_types[self.options["corr"]](theta, self.D)
-        # d2rfd = (rf[0] - 2*r[0] + rb[0])/(h*h)
-        # print(d2rfd)
-        # print(d2r[0])
-        # import pdb; pdb.set_trace()
-
-        # Assemble augmented correlation matrix
-        n_elem = dd.shape[0]
-        n_comp = dd.shape[1]
-        full_size = self.nt + self.nt*n_comp
-
-        R = np.zeros([full_size, full_size])
-        P = np.eye(self.nt)
-        Pg = np.zeros([self.nt*n_comp, self.nt])
-        R[0:self.nt, 0:self.nt] = np.eye(self.nt) #* (1.0 + nugget + noise)
-
-
+        # Assemble augmented correlation matrix, values first, then the
+        # gradients of each sample in a contiguous block
         if(self.options["corr"] == "squar_exp"):
-            S = np.eye(self.nt*n_comp)
-            for j in range(n_comp):
-                S[j::n_comp] *= (2*theta[j])
-                R[self.nt + j::n_comp, self.nt + j::n_comp] = (2*theta[j])
+            sdiag = 2*theta
         elif(self.options["corr"] == "matern32"):
-            S = np.eye(self.nt*n_comp)
-            for j in range(n_comp):
-                S[j::n_comp] *= (3*(theta[j]**2))
-                R[self.nt + j::n_comp, self.nt + j::n_comp] = (3*(theta[j]**2))
+            sdiag = 3*(theta**2)
         else:
             raise ValueError("Not available for this correlation kernel")
 
-        # R[self.nt:(self.nt+self.nt*n_comp), self.nt:(self.nt+self.nt*n_comp)] = np.eye(self.nt)*(3*theta*theta)
-        R[self.ij[:, 0], self.ij[:, 1]] = r[:, 0]
-        R[self.ij[:, 1], self.ij[:, 0]] = r[:, 0]
-        P[self.ij[:, 0], self.ij[:, 1]] = r[:, 0]
-        P[self.ij[:, 1], self.ij[:, 0]] = r[:, 0]
-        # print(theta)
-        # print(np.linalg.cond(P))
-        # import pdb; pdb.set_trace()
-        # R[self.nt:, self.nt:] = S.copy()
+        i0 = self.ij[:, 0]
+        i1 = self.ij[:, 1]
+        g0 = aug["gind"][i0]
+        g1 = aug["gind"][i1]
+
+        R = np.zeros([full_size, full_size])
+        R[np.arange(nt), np.arange(nt)] = 1.0 #* (1.0 + nugget + noise)
+        R[aug["gind"], aug["gind"]] = sdiag[None, :]
+        R[i0, i1] = r[:, 0]
+        R[i1, i0] = r[:, 0]
 
         # hessian
-        for k in range(n_elem):
-            R[(self.nt + self.ij[k,0]*n_comp):(self.nt + self.ij[k,0]*n_comp+n_comp), (self.nt + self.ij[k,1]*n_comp):(self.nt + self.ij[k,1]*n_comp+n_comp)] = -d2r[k]
-            R[(self.nt + self.ij[k,1]*n_comp):(self.nt + self.ij[k,1]*n_comp+n_comp), (self.nt + self.ij[k,0]*n_comp):(self.nt + self.ij[k,0]*n_comp+n_comp)] = -d2r[k].T
+        R[g0[:, :, None], g1[:, None, :]] = -d2r
+        R[g1[:, :, None], g0[:, None, :]] = -np.transpose(d2r, (0, 2, 1))
 
-            S[(self.ij[k,0]*n_comp):(self.ij[k,0]*n_comp+n_comp), (self.ij[k,1]*n_comp):(self.ij[k,1]*n_comp+n_comp)] = -d2r[k]
-            S[(self.ij[k,1]*n_comp):(self.ij[k,1]*n_comp+n_comp), (self.ij[k,0]*n_comp):(self.ij[k,0]*n_comp+n_comp)] = -d2r[k].T
-        
         # upper and lower grad
-            R[self.ij[k,0], (self.nt + self.ij[k,1]*n_comp):(self.nt + self.ij[k,1]*n_comp+n_comp)] = -dr[k]
-            R[self.ij[k,1], (self.nt + self.ij[k,0]*n_comp):(self.nt + self.ij[k,0]*n_comp+n_comp)] = dr[k]
-            R[(self.nt + self.ij[k,1]*n_comp):(self.nt + self.ij[k,1]*n_comp+n_comp), self.ij[k,0]] = -dr[k].T
-            R[(self.nt + self.ij[k,0]*n_comp):(self.nt + self.ij[k,0]*n_comp+n_comp), self.ij[k,1]] = dr[k].T
-
-            Pg[(self.ij[k,1]*n_comp):(self.ij[k,1]*n_comp+n_comp), self.ij[k,0]] = -dr[k].T
-            Pg[(self.ij[k,0]*n_comp):(self.ij[k,0]*n_comp+n_comp), self.ij[k,1]] = dr[k].T
-
-
-
-        # Assemble the right hand side and the regresssion
-        # augmented y vector w/ gradients
-        Ya = self.y_norma.copy()
-        for i in range(self.nt):
-            for j in range(n_comp):
-                Ya = np.append(Ya, self.training_points[None][j+1][1][i]*(self.X_scale[j]/self.y_std))
-
-        # Rinv = linalg.inv(R)
-        Oa = np.ones(full_size)
-        Oa[self.nt:] = 0
+        R[i0[:, None], g1] = -dr
+        R[i1[:, None], g0] = dr
+        R[g1, i0[:, None]] = -dr
+        R[g0, i1[:, None]] = dr
+
+        # relative nugget, the gradient block is scaled differently from the values
+        R[np.arange(full_size), np.arange(full_size)] *= (1.0 + nugget)
+        anorm = np.max(np.sum(np.abs(R), axis=0))
+
+        # One Cholesky factorization in place of the block inverses of
+        # (Lockwood and Anitescu 2012), log det from its diagonal
+        try:
+            C = linalg.cholesky(R, lower=True, overwrite_a=True, check_finite=False)
+        except (linalg.LinAlgError, ValueError):
+            # R is not positive definite at this theta, try another
+            return reduced_likelihood_function_value, par
+
+        # 1-norm condition estimate from the factor, R itself is overwritten
+        rcond, info = lapack.dpocon(C, anorm, uplo="L")
+        if rcond < 10.*np.finfo(float).eps:
+            # numerically singular, the factor succeeded only through roundoff
+            return reduced_likelihood_function_value, par
+
+        Ya = aug["Ya"]
+        Fa = aug["Fa"]
 
-        
-        # print(theta)
-        # print(np.linalg.cond(R))
-        # import pdb; pdb.set_trace()
-
-        # Invert the augmented covariance matrix R (Lockwood and Anitescu 2012)
-        #defs
-        # PC = linalg.cholesky(P)
-        Pinv = linalg.inv(P)
-        PgPinv = np.dot(Pg, Pinv)
-        PPginv = PgPinv.T
-        M = S - np.dot(PgPinv, Pg.T)
-        Minv = linalg.inv(M)
-        # MC = linalg.cholesky(M)
-
-        detP = linalg.det(P)
-        detM = linalg.det(M)
-        detR = detP*detM
-        Rinv = np.zeros([full_size, full_size])
-        Rinv[0:self.nt, 0:self.nt] = Pinv + np.dot(np.dot(PPginv, Minv), PgPinv)
-        Rinv[0:self.nt, self.nt:] = -np.dot(PPginv, Minv)
-        Rinv[self.nt:, 0:self.nt] = -np.dot(Minv, PgPinv)
-        Rinv[self.nt:, self.nt:] = Minv
-        # C = linalg.cholesky(R, lower=True)
-        # detR = (np.diag(C) ** (2.0 / full_size)).prod()
-
-        # Rinv2 = linalg.inv(R)
-
-        # Get generalized least squared solution
-        # augmented regression matrix
-        Fa = self.F.copy()
-        for i in range(self.nt):
-            Fa = np.append(Fa, np.zeros([n_comp, Fa.shape[1]]), axis=0)
-        # Ft = linalg.solve_triangular(L, Fa, lower=True)
-        # Q, G = linalg.qr(Ft, mode="economic")
-        # sv = linalg.svd(G, compute_uv=False)
-        # rcondG = sv[-1] / sv[0]
-        # if rcondG < 1e-10:
-        #     # Check F
-        #     sv = linalg.svd(self.F, compute_uv=False)
-        #     condF = sv[0] / sv[-1]
-        #     if condF > 1e15:
-        #         raise Exception(
-        #             "F is too ill conditioned. Poor combination "
-        #             "of regression model and observations."
-        #         )
-
-        #     else:
-        #         # Ft is too ill conditioned, get out (try different theta)
-        #         return reduced_likelihood_function_value, par
-        
         # regression coeffs
         beta = linalg.lstsq(Fa, Ya)[0]
         rho = Ya - np.dot(Fa, beta)
-        rhos = self.y_norma.reshape(self.nt) - np.dot(self.F, beta)
-        # rhot = linalg.solve_triangular(C, rho, lower=True)
-
-        # import pdb; pdb.set_trace()
 
+        rhot = linalg.solve_triangular(C, rho, lower=True, check_finite=False)
+        logdetR = 2.0*np.sum(np.log10(np.diag(C)))
 
         # Compute/Organize output
-        sigma2 = np.dot(np.dot(rho, Rinv), rho) /self.nt
-        # sigma2 = (rho ** 2.0).sum(axis=0) / (self.nt)
+        sigma2 = np.dot(rhot, rhot) /self.nt
         work1 = -self.nt*np.log10(sigma2) 
-        work2 = -np.log10(detR)#**(1/full_size)
+        work2 = -logdetR
         reduced_likelihood_function_value = work1 + work2
-        # work = detR**(1/full_size)
-        # reduced_likelihood_function_value = -sigma2*(work)
-        #if(sigma2 < 0):
-        # import pdb; pdb.set_trace()
         par["sigma2"] = sigma2 * self.y_std ** 2.0
         par["beta"] = beta
-        # par["gamma"] = linalg.solve_triangular(C.T, rhot)#np.dot(Rinv, rho)
-        par["gamma"] = np.dot(Rinv, rho)#
-        par["C"] = 0
+        par["gamma"] = linalg.solve_triangular(C.T, rhot, check_finite=False)
+        par["C"] = C
         par["Ft"] = 0#Ft
         par["G"] = 0#G
         par["Q"] = 0#Q
-        par["cond"] = np.linalg.cond(R)
-        #import pdb; pdb.set_trace()
+        par["cond"] = 1.0/rcond if rcond > 0 else np.inf
         if self.name in ["MGP"]:
             reduced_likelihood_function_value += self._reduced_log_prior(theta)
 
@@ -324,6 +240,246 @@ class DGEK(KrgBased):
 
 
 
+    def _optimize_hyperparam(self, D):
+        """
+        Multistart L-BFGS-B on log10(theta) with the analytic likelihood
+        gradient. n_start is the total number of runs, from theta0 and then
+        n_start - 1 LHS points in the theta bounds. LHS points where the
+        likelihood cannot be computed are dropped, while theta0 is moved out
+        of the singular region with _feasible_start. Other optimizers,
+        kernels and noise evaluation use the KrgBased optimizer
+
+        Parameters
+        ----------
+        D : np.ndarray [nt*(nt-1)/2, dim]
+            Cross differences of the normalized training points
+
+        Returns
+        -------
+        best_optimal_rlf_value : float
+        best_optimal_par : dict()
+        best_optimal_theta : np.ndarray [dim]
+        """
+        if(self.options["hyper_opt"] != "L-BFGS-B" or self.options["corr"] != "squar_exp"
+           or self.options["eval_noise"]):
+            return super(DGEK, self)._optimize_hyperparam(D)
+
+        self.best_iteration_fail = None
+        self._thetaMemory = None
+        self.noise0 = np.array(self.options["noise0"])
+        self.D = self._componentwise_distance(D)
+
+        log10t_bounds = np.log10(self.options["theta_bounds"])
+        theta0 = np.clip(np.log10(self.options["theta0"]), log10t_bounds[0], log10t_bounds[1])
+        theta0 = theta0*np.ones(self.nx)
+        starts = []
+        theta0 = self._feasible_start(theta0, log10t_bounds[1])
+        if theta0 is not None:
+            starts.append(theta0)
+        if self.options["n_start"] > 1:
+            sampling = LHS(
+                xlimits=np.repeat(np.atleast_2d(log10t_bounds), self.nx, axis=0),
+                criterion="maximin", random_state=41
+            )
+            # screen the LHS starts, dropping those where R is singular
+            for x0 in sampling(self.options["n_start"] - 1):
+                if not np.isinf(self._reduced_likelihood_function(10.0**x0)[0]):
+                    starts.append(x0)
+
+        # the likelihood grows with the size of the augmented system, scale
+        # it so the first quasi-Newton steps stay out of the singular region
+        scale = self.nt*(1 + self.nx)
+
+        # best point of the current run where R could be factorized
+        feasible = {"x":None, "fun":np.inf}
+
+        def minus_reduced_likelihood(log10t):
+            theta = 10.0**log10t
+            red, par = self._reduced_likelihood_function(theta)
+            if np.isinf(red):
+                # failed factorization, penalize the distance from the best
+                # feasible point so the line search backs off toward it
+                work = log10t - feasible["x"]
+                return feasible["fun"] + 1.0 + np.dot(work, work), 2.0*work
+            fun = -red/scale
+            if fun < feasible["fun"]:
+                feasible["x"] = np.array(log10t)
+                feasible["fun"] = fun
+            grad = self._likelihood_gradient(theta, par)
+            return fun, -np.log(10.)*theta*grad/scale
+
+        best_fun = np.inf
+        best_optimal_theta = None
+        for x0 in starts:
+            feasible["x"] = None
+            feasible["fun"] = np.inf
+            optimize.minimize(minus_reduced_likelihood, x0, jac=True, method="L-BFGS-B",
+                              bounds=[log10t_bounds]*self.nx, options={"maxiter":100})
+
+            # the optimizer may stop on a penalized point, keep the best feasible one
+            if feasible["fun"] < best_fun:
+                best_fun = feasible["fun"]
+                best_optimal_theta = 10.0**feasible["x"]
+
+        if best_optimal_theta is None:
+            raise ValueError("Optimization failed. Try increasing the ``nugget``")
+
+        best_optimal_rlf_value, best_optimal_par = self._reduced_likelihood_function(best_optimal_theta)
+
+        return best_optimal_rlf_value, best_optimal_par, best_optimal_theta
+
+    def _feasible_start(self, log10t, log10t_max, n_bisect=20):
+        """
+        Move the starting point theta0 of the hyperparameter optimization,
+        if R is numerically singular there, toward the upper theta bound, where R is closest
+        to diagonal, stopping just past the singular region. Returns None if
+        the likelihood is not available even at the bound
+        """
+        if not np.isinf(self._reduced_likelihood_function(10.0**log10t)[0]):
+            return log10t
+        upper = log10t_max*np.ones_like(log10t)
+        if np.isinf(self._reduced_likelihood_function(10.0**upper)[0]):
+            return None
+
+        # bisect on the segment between the start and the bound
+        lo = 0.
+        hi = 1.
+        for k in range(n_bisect):
+            t = 0.5*(lo + hi)
+            if np.isinf(self._reduced_likelihood_function(10.0**(log10t + t*(upper - log10t)))[0]):
+                lo = t
+            else:
+                hi = t
+
+        return log10t + hi*(upper - log10t)
+
+    def _reduced_likelihood_gradient(self, theta):
+        """
+        Gradient of the reduced likelihood with respect to theta, the same
+        derivative the L-BFGS-B hyperparameter optimizer uses through
+        _likelihood_gradient. The regression coefficients do not depend on
+        theta, so
+
+        d(rlf)/dtheta_l = -<R^-1 - gamma gamma^T/sigma2, dR/dtheta_l>/ln(10)
+
+        and each inner product is summed over the sample pairs without
+        forming dR/dtheta_l. Only available for the squar_exp kernel
+
+        Parameters
+        ----------
+        theta : np.ndarray [dim] or [dim, 1]
+            Autocorrelation parameters
+
+        Returns
+        -------
+        grad_red : np.ndarray [dim, 1]
+            Derivative of the reduced likelihood
+        par : dict()
+            Model parameters at theta, see _reduced_likelihood_function
+        """
+        theta = np.asarray(theta, dtype=float).reshape(-1)
+        red, par = self._reduced_likelihood_function(theta)
+
+        grad_red = np.zeros([self.nx, 1])
+        if(not np.isinf(red)):
+            grad_red[:, 0] = self._likelihood_gradient(theta, par)
+
+        return grad_red, par
+
+    def _likelihood_gradient(self, theta, par):
+        # see _reduced_likelihood_gradient, par from the likelihood at theta
+        if(self.options["corr"] != "squar_exp"):
+            raise ValueError("The likelihood gradient is only available for the squar_exp kernel")
+
+        nugget = self.options["nugget"]
+        if self.options["eval_noise"]:
+            nugget = 0
+
+        aug = self._augmented_system()
+        C = par["C"]
+        gamma = par["gamma"]
+        sigma2 = par["sigma2"]/self.y_std**2
+
+        K = linalg.cho_solve((C, True), np.eye(C.shape[0]), check_finite=False)
+        K -= np.outer(gamma, gamma)/sigma2
+
+        # kernel terms at each pair, as in the likelihood
+        dx = aug["dx"]
+        d = self.D
+        dd = 2.0*theta[None, :]*dx
+        r = np.exp(-np.dot(d, theta))
+        dr = -r[:, None]*dd
+        d2r = r[:, None, None]*(dd[:, :, None]*dd[:, None, :]) - r[:, None, None]*np.diag(2.0*theta)[None, :, :]
+
+        i0 = self.ij[:, 0]
+        i1 = self.ij[:, 1]
+        g0 = aug["gind"][i0]
+        g1 = aug["gind"][i1]
+        Kvv = K[i0, i1]
+        Kgg = K[g0[:, :, None], g1[:, None, :]]
+        K0g1 = K[i0[:, None], g1]
+        K1g0 = K[i1[:, None], g0]
+
+        # <K, dR/dtheta_l> with dR/dtheta_l of each block in closed form
+        # value block, R = r
+        T = -2.0*np.dot(Kvv*r, d)
+        # gradient block, R = -d2r
+        s1 = np.einsum('kjm,kjm->k', Kgg, d2r)
+        Kdd = np.einsum('kjm,km->kj', Kgg, dd) + np.einsum('kjm,kj->km', Kgg, dd)
+        Kdiag = np.einsum('kll->kl', Kgg)
+        T -= 2.0*(np.dot(-s1, d) + np.sum(r[:, None]*(2.0*dx*Kdd - 2.0*Kdiag), axis=0))
+        # value-gradient blocks, R = -dr and R = dr
+        Kvg = K1g0 - K0g1
+        s2 = np.einsum('kj,kj->k', Kvg, dr)
+        T += 2.0*(np.dot(-s2, d) - 2.0*np.sum(r[:, None]*Kvg*dx, axis=0))
+        # diagonal of the gradient block, R = 2*theta
+        T += 2.0*(1.0 + nugget)*np.sum(K[aug["gind"], aug["gind"]], axis=0)
+
+        return -T/np.log(10.)
+
+    def _augmented_system(self):
+        """
+        Parts of the augmented system that do not depend on theta, computed
+        once per training set and reused for every likelihood evaluation.
+        The cache is keyed on the identity of X_norma only, which assumes the
+        training values and gradients are never changed without standardizing
+        again, as train() does, since that creates a new X_norma array
+
+        Returns
+        -------
+        aug : dict
+            dx : np.ndarray [nt*(nt-1)/2, dim]
+                Cross differences of the normalized training points
+            gind : np.ndarray [nt, dim]
+                Rows of the augmented system holding each sample's gradient
+            Ya : np.ndarray [nt + nt*dim]
+                Augmented values, then normalized gradients
+            Fa : np.ndarray [nt + nt*dim, p]
+                Augmented regression matrix
+        """
+        aug = getattr(self, "_aug", None)
+        if aug is not None and aug["X_norma"] is self.X_norma:
+            return aug
+
+        nt = self.nt
+        nx = self.nx
+        dx, ij = cross_distances(self.X_norma)
+
+        grads = np.zeros([nt, nx])
+        for j in range(nx):
+            grads[:, j] = self.training_points[None][j+1][1].reshape(-1)
+
+        aug = {
+            "X_norma": self.X_norma,
+            "dx": dx,
+            "gind": nt + nx*np.arange(nt)[:, None] + np.arange(nx)[None, :],
+            "Ya": np.append(self.y_norma[:, 0], (grads*(self.X_scale/self.y_std)).ravel()),
+            "Fa": np.append(self.F, np.zeros([nt*nx, self.F.shape[1]]), axis=0),
+        }
+        self._aug = aug
+
+        return aug
+
     def _predict_values(self, x):
         """
         Evaluates the model at a set of points.
@@ -343,22 +499,7 @@ class DGEK(KrgBased):
         full_size = n_eval + n_eval*n_features_x
 
         X_cont = (x - self.X_offset) / self.X_scale
-        # Get pairwise componentwise L1-distances to the input training set
-        dx = differences(X_cont, Y=self.X_norma.copy())
-        d = self._componentwise_distance(dx)
-        dd = self._componentwise_distance(
-            dx, theta=self.optimal_theta, return_derivative=True
-        )
-        derivative_dic = {"dx": dx, "dd": dd}
-        # Compute the correlation function
-        r = self._correlation_types[self.options["corr"]](self.optimal_theta, d
-        ).reshape(n_eval, self.nt)
-        dum, dr = self._correlation_types[self.options["corr"]](self.optimal_theta, d, derivative_params=derivative_dic)
-        dr = dr.reshape(n_eval, self.nt*n_features_x)
-        ra = np.zeros([n_eval, self.nt + self.nt*n_features_x])
-        #import pdb; pdb.set_trace()
-        for i in range(n_eval):
-            ra[i] = np.append(r[i], -dr[i,:])
+        ra = self._augmented_corr(X_cont)
 
         y = np.zeros(full_size)
         ya = self.y_norma.copy()
@@ -382,6 +523,85 @@ class DGEK(KrgBased):
         y = (self.y_mean + self.y_std * y_).ravel()
         return y[0:n_eval]
 
+    def _augmented_corr(self, X_cont):
+        """
+        Correlation of normalized points with the augmented (values, then
+        gradients) training data
+
+        Parameters
+        ----------
+        X_cont : np.ndarray [n_evals, dim]
+            Normalized evaluation points
+
+        Returns
+        -------
+        ra : np.ndarray [n_evals, nt + nt*dim]
+            Augmented correlation vectors
+        """
+        n_eval, n_features_x = X_cont.shape
+
+        # Get pairwise componentwise L1-distances to the input training set
+        dx = differences(X_cont, Y=self.X_norma.copy())
+        d = self._componentwise_distance(dx)
+        dd = self._componentwise_distance(
+            dx, theta=self.optimal_theta, return_derivative=True
+        )
+        derivative_dic = {"dx": dx, "dd": dd}
+        # Compute the correlation function
+        r = self._correlation_types[self.options["corr"]](self.optimal_theta, d
+        ).reshape(n_eval, self.nt)
+        dum, dr = self._correlation_types[self.options["corr"]](self.optimal_theta, d, derivative_params=derivative_dic)
+        dr = dr.reshape(n_eval, self.nt*n_features_x)
+
+        return np.hstack([r, -dr])
+
+    def predict_loo_values(self, xt=None):
+        """
+        Leave-one-out predictions, removing the value and gradient of each
+        sample from the augmented system in closed form. The hyperparameters
+        and regression coefficients are kept fixed
+
+        Parameters
+        ----------
+        xt : np.ndarray [n_evals, dim] or None
+            Evaluation point input variable values. If None, each
+            leave-one-out model is only evaluated at its left out sample
+
+        Returns
+        -------
+        y : np.ndarray [nt] if xt is None
+            Prediction of the i-th leave-one-out model at the i-th sample
+            np.ndarray [n_evals, nt] otherwise
+            Predictions of every leave-one-out model at the evaluation points
+        """
+        C = self.optimal_par["C"]
+        gamma = self.optimal_par["gamma"]
+        nt = self.nt
+        nx = self.nx
+
+        # rows of the augmented system that belong to each sample, value first
+        S = np.hstack([np.arange(nt)[:,None], nt + nx*np.arange(nt)[:,None] + np.arange(nx)[None,:]])
+
+        # diagonal blocks of R^-1 = C^-T C^-1, R^-1 itself is never formed
+        Cinv = linalg.solve_triangular(C, np.eye(C.shape[0]), lower=True, check_finite=False)
+        CS = Cinv[:,S]
+        RinvS = np.einsum('kni,knj->nij', CS, CS)
+        del Cinv, CS
+
+        # residual of each sample's block predicted from the others
+        e = np.linalg.solve(RinvS, gamma[S][:,:,None])[:,:,0]
+
+        if xt is None:
+            # a sample's correlation vector is its row of R, so only its own residual remains
+            return self.training_points[None][0][1][:,0] - self.y_std*e[:,0]
+
+        xt = np.atleast_2d(xt)
+        X_cont = (xt - self.X_offset) / self.X_scale
+        W = linalg.cho_solve((C, True), self._augmented_corr(X_cont).T, check_finite=False).T
+        dy = np.einsum('nij,ij->ni', W[:,S], e)
+
+        return self.predict_values(xt) - self.y_std*dy
+
     def _predict_derivatives(self, x, kx):
         """
         Evaluates the derivatives at a set of points.
@@ -2,7 +2,8 @@
 Implementation of direct Gradient-Enhanced RBF with squar_exp in the SMT package
 """
 import numpy as np
-from scipy import linalg
+from scipy import linalg, sparse
+from scipy.sparse.linalg import splu
 
 from smt.surrogate_models.surrogate_model import SurrogateModel
 from smt.utils.kriging_utils import differences, componentwise_distance
@@ -21,7 +22,7 @@ from smt.utils.kriging_utils import (
     matrix_data_corr,
     compute_n_param,
 )
-from sutils import getDirectCovariance
+from sutils import getDirectCovariance, wendland, wendlandNeighbors
 from scipy.stats import multivariate_normal as m_norm
 from smt.sampling_methods import LHS
 
@@ -34,6 +35,11 @@ class GRBF(SurrogateModel):
         "matern32": matern32
     }
 
+    # compactly supported, assembled and solved as sparse systems
+    _sparse_types = {
+        "wendland": wendland
+    }
+
     name = "GRBF"
 
     def _initialize(self):
@@ -43,7 +49,7 @@ class GRBF(SurrogateModel):
             "t0",
             1.0,
             types=(int, float, list, np.ndarray),
-            desc="basis function scaling parameter in exp(-d^2 * t0), t0 = 1/d0**2",
+            desc="basis function scaling parameter in exp(-d^2 * t0), t0 = 1/d0**2. for wendland, the support radius is 1/sqrt(t0)",
         )
         declare(
             "compute_theta",
@@ -62,7 +68,8 @@ class GRBF(SurrogateModel):
             "corr",
             "squar_exp",
             values=(
-                "squar_exp"
+                "squar_exp",
+                "wendland",
             ),
             desc="Basis function type",
             types=(str),
@@ -112,6 +119,10 @@ class GRBF(SurrogateModel):
             self.y_std,
         ) = standardization(xt, yt)
 
+        if self.options["corr"] in self._sparse_types:
+            self._new_train_sparse()
+            return
+
         # Calculate matrix of distances D between samples
         D, self.ij = cross_distances(self.X_norma)
         self.D = self._componentwise_distance(D)
@@ -203,6 +214,115 @@ class GRBF(SurrogateModel):
 
         self.par["gamma"] = np.dot(Rinv, rhs)
 
+    def _new_train_sparse(self):
+        """
+        Train with a compactly supported basis. Only pairs of points within
+        the support are found, with a KD-tree, and the covariance matrix
+
+        R = [P Pg.T; Pg S]
+
+        is assembled and factorized as a sparse matrix, so memory and cost
+        grow with the number of neighbors rather than the square of nt
+        """
+        nt = self.nt
+        nx = self.num["x"]
+
+        if self.options["compute_theta"]:
+            raise ValueError(
+                "compute_theta is not available for the %s basis, set t0 instead" % self.options["corr"]
+            )
+        self.theta = self.options["t0"]
+
+        self.F = self._regression_types[self.options["poly"]](self.X_norma)
+        n_samples_F = self.F.shape[0]
+        if self.F.ndim > 1:
+            p = self.F.shape[1]
+        else:
+            p = 1
+        self._check_F(n_samples_F, p)
+
+        # all pairs in the support, both orderings and the diagonal
+        i, j, dx = wendlandNeighbors(self.X_norma, self.X_norma, self.theta)
+        r, dr, d2r = self._sparse_types[self.options["corr"]](dx, self.theta, order=2)
+        npair = i.shape[0]
+
+        # P, then Pg (gradient rows at i, value columns at j) and its
+        # transpose, then S, same blocks as getDirectCovariance
+        gi = nt + i[:,None]*nx + np.arange(nx)[None,:]
+        gj = nt + j[:,None]*nx + np.arange(nx)[None,:]
+        rows = np.concatenate([
+            i,
+            gi.ravel(),
+            np.repeat(j, nx),
+            np.repeat(gi, nx, axis=1).ravel(),
+        ])
+        cols = np.concatenate([
+            j,
+            np.repeat(j, nx),
+            gi.ravel(),
+            np.tile(gj, (1, nx)).ravel(),
+        ])
+        vals = np.concatenate([
+            r,
+            -dr.ravel(),
+            -dr.ravel(),
+            -d2r.reshape(npair, nx*nx).ravel(),
+        ])
+
+        full_size = nt + nt*nx
+        R = sparse.coo_matrix((vals, (rows, cols)), shape=(full_size, full_size)).tocsc()
+        R = R + self.options["reg"]*sparse.identity(full_size, format="csc")
+
+        # augmented y vector w/ gradients, and regression matrix
+        G = np.hstack([self.training_points[None][k+1][1] for k in range(nx)])
+        Ya = np.append(self.y_norma, -G*(self.X_scale/self.y_std))
+        Fa = np.append(self.F, np.zeros([nt*nx, p]), axis=0)
+
+        beta = linalg.lstsq(Fa, Ya)[0]
+        self.par["beta"] = beta
+
+        rhs = Ya - np.dot(Fa, beta)
+        self.par["gamma"] = splu(R).solve(rhs)
+        self.par["nnz"] = R.nnz
+
+    def _predict_sparse(self, x, kx=None):
+        """
+        Values, or derivatives wrt x_kx, of the sparse model, summing only
+        over the training points within the support of each evaluation point
+        """
+        n_eval, nx = x.shape
+        X_cont = (x - self.X_offset) / self.X_scale
+
+        i, j, dx = wendlandNeighbors(X_cont, self.X_norma, self.theta)
+        gamma = self.par["gamma"][:self.nt]
+        gammag = self.par["gamma"][self.nt:].reshape(self.nt, nx)
+        beta = self.par["beta"]
+        kernel = self._sparse_types[self.options["corr"]]
+
+        if kx is None:
+            r, dr = kernel(dx, self.theta, order=1)
+            f = self._regression_types[self.options["poly"]](X_cont)
+            w = r*gamma[j] + np.einsum('ij,ij->i', dr, gammag[j])
+            y_ = np.dot(f, beta) + np.bincount(i, weights=w, minlength=n_eval)
+
+            return (self.y_mean + self.y_std * y_).ravel()
+
+        if self.options["poly"] == "constant":
+            df_dx = 0.
+        elif self.options["poly"] == "linear":
+            df_dx = beta[1 + kx]
+        else:
+            raise ValueError(
+                "The derivative is only available for ordinary kriging or "
+                + "universal kriging using a linear trend"
+            )
+
+        r, dr, d2r = kernel(dx, self.theta, order=2)
+        w = dr[:,kx]*gamma[j] + np.einsum('ij,ij->i', d2r[:,kx,:], gammag[j])
+        y = (df_dx + np.bincount(i, weights=w, minlength=n_eval))*self.y_std/self.X_scale[kx]
+
+        return y.reshape(n_eval, 1)
+
     def _train(self):
         """
         Train the model
@@ -235,6 +355,9 @@ class GRBF(SurrogateModel):
         y : np.ndarray
             Evaluation point output variable values
         """
+        if self.options["corr"] in self._sparse_types:
+            return self._predict_sparse(x)
+
         # Initialization
         n_eval, n_features_x = x.shape
         full_size = n_eval + n_eval*n_features_x
@@ -297,6 +420,9 @@ class GRBF(SurrogateModel):
         y : np.ndarray
             Derivative values.
         """
+        if self.options["corr"] in self._sparse_types:
+            return self._predict_sparse(x, kx)
+
         # Initialization
         n_eval, n_features_x = x.shape
 
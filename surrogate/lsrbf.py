@@ -3,7 +3,8 @@ Implementation of a (gradient-enhanced) RBF method with a finite number of shift
 """
 from re import L
 import numpy as np
-from scipy import linalg
+from scipy import linalg, sparse
+from scipy.sparse.linalg import lsmr
 
 from smt.surrogate_models.surrogate_model import SurrogateModel
 from smt.utils.kriging_utils import differences, componentwise_distance
@@ -22,7 +23,7 @@ from smt.utils.kriging_utils import (
     matrix_data_corr,
     compute_n_param,
 )
-from sutils import getDirectCovariance
+from sutils import getDirectCovariance, wendland, wendlandNeighbors
 from scipy.spatial.distance import pdist, squareform
 from scipy.stats import multivariate_normal as m_norm
 from smt.sampling_methods import LHS
@@ -37,6 +38,11 @@ class LSRBF(SurrogateModel):
         "squar_exp": squar_exp
     }
 
+    # compactly supported, assembled and solved as sparse systems
+    _sparse_types = {
+        "wendland": wendland
+    }
+
     name = "LSRBF"
 
     def _initialize(self):
@@ -46,7 +52,7 @@ class LSRBF(SurrogateModel):
             "t0",
             1.0,
             types=(int, float, list, np.ndarray),
-            desc="basis function scaling parameter in exp(-d^2 * t0), t0 = 1/d0**2",
+            desc="basis function scaling parameter in exp(-d^2 * t0), t0 = 1/d0**2. for wendland, the support radius is 1/sqrt(t0)",
         )
         declare(
             "theta_bounds",
@@ -60,6 +66,12 @@ class LSRBF(SurrogateModel):
             types=(bool),
             desc="choose to compute adaptive theta depending on average distances"
         )
+        declare(
+            "n_start",
+            1,
+            types=(int),
+            desc="number of gradient-based optimizer runs when computing theta, from t0 and then LHS points in theta_bounds"
+        )
         declare(
             "basis_centers",
             2,
@@ -70,7 +82,8 @@ class LSRBF(SurrogateModel):
             "corr",
             "squar_exp",
             values=(
-                "squar_exp"
+                "squar_exp",
+                "wendland",
             ),
             desc="Basis function type",
             types=(str),
@@ -84,6 +97,18 @@ class LSRBF(SurrogateModel):
 
 
         declare("reg", 1e-10, types=(int, float), desc="Regularization coeff.")
+        declare(
+            "sparse_tol",
+            1e-10,
+            types=(float),
+            desc="relative tolerance of the iterative least-squares solve for sparse basis types"
+        )
+        declare(
+            "print_cond",
+            False,
+            types=(bool),
+            desc="print the condition number of the least-squares system at every looEstimate call"
+        )
 
         self.supports["derivatives"] = True
         self.supports["output_derivatives"] = True
@@ -136,6 +161,10 @@ class LSRBF(SurrogateModel):
         # scale the centers as well
         self.Xc_norma = (self.xc - self.X_offset)/self.X_scale
 
+        if self.options["corr"] in self._sparse_types:
+            self._new_train_sparse()
+            return
+
         # Calculate matrix of distances D between samples and centers
         D, self.ij = cross_distances(self.X_norma, self.Xc_norma)
         self.D = self._componentwise_distance(D)
@@ -161,19 +190,94 @@ class LSRBF(SurrogateModel):
 
             # Rippa's method
             args = (D.copy(), True)
-            opt = optimize(self.looEstimate, args, bounds=[self.options["theta_bounds"]]*ndim, x0=self.options["t0"], type='local')
-            self.theta = opt["x"]
+            bounds = [self.options["theta_bounds"]]*ndim
+            starts = np.atleast_2d(self.options["t0"])
+            if(self.options["n_start"] > 1):
+                sampling = LHS(xlimits=np.array(bounds), criterion="maximin", random_state=41)
+                starts = np.append(starts, sampling(self.options["n_start"] - 1), axis=0)
+            best = None
+            for x0 in starts:
+                opt = optimize(self.looEstimate, args, bounds=bounds, x0=x0, jac=self.looGrad, type='local')
+                if(best is None or opt["fun"] < best["fun"]):
+                    best = opt
+            self.theta = best["x"]
         else:
             self.theta = self.options["t0"]
 
-        # get coefficients
+        # get coefficients, and drop the dense factorization
         sol = self.looEstimate(self.theta, D)
+        self._fac = None
 
         self.par["gamma"] = sol[0][0:-1]
         self.par["mean"] = sol[0][-1]
 
         #import pdb; pdb.set_trace()
 
+    def _new_train_sparse(self):
+        """
+        Train with a compactly supported basis. Only sample-center pairs
+        within the support are found, with a KD-tree, and the least-squares
+        system of looEstimate is assembled as a sparse matrix and solved
+        iteratively with LSMR
+        """
+        nt = self.nt
+        ndim = self.num["x"]
+
+        if self.options["compute_theta"]:
+            raise ValueError(
+                "compute_theta is not available for the %s basis, set t0 instead" % self.options["corr"]
+            )
+        self.theta = self.options["t0"]
+
+        i, j, dx = wendlandNeighbors(self.X_norma, self.Xc_norma, self.theta)
+        r, dr = self._sparse_types[self.options["corr"]](dx, self.theta, order=1)
+
+        # same layout as _design_matrix
+        full_size = nt
+        rows = [i, np.arange(nt)]
+        cols = [j, np.full(nt, self.nc)]
+        vals = [r, np.ones(nt)]
+        b = np.zeros(full_size)
+        b[:nt] = self.y_norma[:,0]
+        if(self.options["use_derivatives"]):
+            full_size += ndim*nt
+            b = np.append(b, np.zeros(ndim*nt))
+            for k in range(ndim):
+                rows.append((k+1)*nt + i)
+                cols.append(j)
+                vals.append(dr[:,k])
+                b[(k+1)*nt:(k+2)*nt] = self.training_points[None][k+1][1][:,0]*self.X_scale[k]/self.y_std
+
+        A = sparse.coo_matrix(
+            (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(full_size, self.nc+1),
+        ).tocsr()
+
+        tol = self.options["sparse_tol"]
+        sol = lsmr(A, b, damp=np.sqrt(self.options["reg"]), atol=tol, btol=tol, maxiter=10*(self.nc+1))
+
+        self.par["gamma"] = sol[0][0:-1]
+        self.par["mean"] = sol[0][-1]
+        self.par["nnz"] = A.nnz
+
+    def _predict_sparse(self, x, kx=None):
+        """
+        Values, or derivatives wrt x_kx, of the sparse model, summing only
+        over the centers within the support of each evaluation point
+        """
+        n_eval = x.shape[0]
+        X_cont = (x - self.X_offset) / self.X_scale
+
+        i, j, dx = wendlandNeighbors(X_cont, self.Xc_norma, self.theta)
+        r, dr = self._sparse_types[self.options["corr"]](dx, self.theta, order=1)
+
+        if kx is None:
+            y_ = self.par["mean"] + np.bincount(i, weights=r*self.par["gamma"][j], minlength=n_eval)
+            return (self.y_mean + self.y_std * y_).ravel()
+
+        y = np.bincount(i, weights=dr[:,kx]*self.par["gamma"][j], minlength=n_eval)*self.y_std/self.X_scale[kx]
+        return y.reshape(n_eval, 1)
+
     def _train(self):
         """
         Train the model
@@ -206,6 +310,9 @@ class LSRBF(SurrogateModel):
         y : np.ndarray
             Evaluation point output variable values
         """
+        if self.options["corr"] in self._sparse_types:
+            return self._predict_sparse(x)
+
         # Initialization
         n_eval, n_features_x = x.shape
         full_size = n_eval
@@ -268,6 +375,9 @@ class LSRBF(SurrogateModel):
         y : np.ndarray
             Derivative values.
         """
+        if self.options["corr"] in self._sparse_types:
+            return self._predict_sparse(x, kx)
+
         # Initialization
         n_eval, n_features_x = x.shape
 
@@ -323,63 +433,143 @@ class LSRBF(SurrogateModel):
     '''
     def looEstimate(self, theta, D, opt=False):
 
-        # import pdb; pdb.set_trace()
-        dx = 0
-        #dd, ij = cross_distances(self.X_norma)
-        dd = D.copy()
-        ndim = dd.shape[1]
-        for j in range(ndim):
-            dd[:,j] *= 2*theta[j]
+        theta = np.asarray(theta, dtype=float)
+        fac = self._factorize(theta, D)
+        c = fac["c"]
 
-        derivative_dic = {"dx": dx, "dd": dd}
-        hess_dic = {"dx": dx, "dd": dd}
-        r, dr = self._basis_types[self.options["corr"]](theta, self.D, derivative_params=derivative_dic)
-        #d2r = self._basis_types[self.options["corr"]](self.theta, self.D, hess_params=hess_dic)
+        if(self.options["print_cond"]):
+            if(self.options["use_derivatives"]):
+                print("grad cond = ", fac["cond"])
+            else:
+                print("no g cond = ", fac["cond"])
 
-        # get the covariance matrix
-        ntot = r.shape[0]
-        full_size = self.nt
-        if(self.options["use_derivatives"]):
-            full_size += ndim*self.nt
+        if(opt == True):
+            # diag((A^T A)^-1) from the same factorization
+            eloo = np.dot(c, c)/(self.nt*fac["ginv_diag"])
+            return np.sum(np.abs(eloo))
+        else:
+            return c, fac["residues"], fac["rank"], fac["s"]
 
-        A = np.zeros([full_size, self.nc+1])
-        b = np.zeros(full_size)
-        for k in range(ntot):
-            A[self.ij[k][0],self.ij[k][1]] = r[k]
+    def _factorize(self, theta, D):
+        """
+        SVD of the looEstimate design matrix, A = U S V^T, giving the least
+        squares solution, diag((A^T A)^-1) and the condition number together.
+        The last factorization is kept, since the optimizer evaluates
+        looEstimate and looGrad at the same theta
+        """
+        key = theta.tobytes()
+        fac = getattr(self, "_fac", None)
+        if fac is not None and fac["key"] == key and fac["D"] is D:
+            return fac
+
+        A, b = self._design_matrix(theta, D)
+        U, sv, Vt = linalg.svd(A, full_matrices=False, check_finite=False)
+
+        # same cutoff as scipy.linalg.lstsq with its default cond
+        keep = sv > np.finfo(float).eps*sv[0]
+        sinv = np.zeros_like(sv)
+        sinv[keep] = 1./sv[keep]
+
+        c = np.dot(Vt.T, sinv*np.dot(U.T, b))
+        rank = np.count_nonzero(keep)
+        residues = np.array([])
+        if rank == A.shape[1] and A.shape[0] > A.shape[1]:
+            res = b - np.dot(A, c)
+            residues = np.atleast_1d(np.dot(res, res))
+
+        fac = {
+            "key":key,
+            "D":D,
+            "A":A,
+            "b":b,
+            "c":c,
+            "Ginv":np.dot(Vt.T*sinv**2, Vt),
+            "ginv_diag":np.einsum('jk,j->k', Vt**2, sinv**2),
+            "cond":sv[0]/sv[-1] if sv[-1] > 0. else np.inf,
+            "residues":residues,
+            "rank":rank,
+            "s":sv,
+        }
+        self._fac = fac
+
+        return fac
+
+    def _design_matrix(self, theta, D, grad=False):
+        """
+        Least-squares system of looEstimate, A c = b, and optionally the
+        derivatives of A with respect to theta
 
-            if(self.options["use_derivatives"]):
-                # now the derivatives 
-                for j in range(ndim):
-                    A[(j+1)*self.nt + self.ij[k][0],self.ij[k][1]] = dr[k,j]
-            
+        Returns
+        -------
+        A : np.ndarray [full_size, nc + 1]
+        b : np.ndarray [full_size]
+        dA : np.ndarray [ndim, full_size, nc + 1], if grad
+        """
+        ndim = D.shape[1]
+        nt = self.nt
+        i0 = self.ij[:,0]
+        i1 = self.ij[:,1]
+        full_size = nt
+        if(self.options["use_derivatives"]):
+            full_size += ndim*nt
 
-            
-        for i in range(self.nt):
-            A[i,-1] = 1
-            b[i] = self.y_norma[i]
+        # basis and its derivative wrt x, dd as in _predict_values
+        basis = self._basis_types[self.options["corr"]]
+        dd = 2.*theta[None,:]*D
+        r, dr = basis(theta, self.D, derivative_params={"dx": D, "dd": dd})
+        r = r[:,0]
 
+        A = np.zeros([full_size, self.nc+1])
+        b = np.zeros(full_size)
+        A[i0,i1] = r
+        A[:nt,-1] = 1.
+        b[:nt] = self.y_norma[:,0]
+        if(self.options["use_derivatives"]):
+            rows = (np.arange(ndim)[None,:] + 1)*nt + i0[:,None]
+            A[rows, i1[:,None]] = dr
+            for j in range(ndim):
+                b[(j+1)*nt:(j+2)*nt] = self.training_points[None][j+1][1][:,0]*self.X_scale[j]/self.y_std
+
+        if not grad:
+            return A, b
+
+        # derivatives wrt theta_l, through grad_ind, plus the dependence of dd
+        dA = np.zeros([ndim, full_size, self.nc+1])
+        for l in range(ndim):
+            dr_l, ddr = basis(theta, self.D, grad_ind=l, derivative_params={"dx": D, "dd": dd})
+            dA[l,i0,i1] = dr_l[:,0]
             if(self.options["use_derivatives"]):
-                # now the derivatives
-                for j in range(ndim):
-                    b[(j+1)*self.nt+i] = self.training_points[None][j+1][1][i]*self.X_scale[j]/self.y_std
-
-        #linalg.lstsq(A, b)
-        #print("cond = ", np.linalg.cond(A))
-        # if(self.options["use_derivatives"]):
-        #     import pdb; pdb.set_trace()
-        sol = linalg.lstsq(A, b)
+                ddr[:,l] -= 2.*r*D[:,l]
+                dA[l, rows, i1[:,None]] = ddr
 
-        cond = np.linalg.cond(A)
-        if(self.options["use_derivatives"]):
-            print("grad cond = ", cond)
-        else:
-            print("no g cond = ", cond)
+        return A, b, dA
 
+    def looGrad(self, theta, D, opt=True):
+        """
+        Gradient of the Rippa objective looEstimate(theta, D, opt=True) with
+        respect to theta. With G = A^T A and c = G^-1 A^T b,
 
-        # import pdb; pdb.set_trace()
-        if(opt == True):
-            Ainv2 = linalg.inv(np.dot(A.T, A))
-            eloo = np.dot(sol[0], sol[0])/(self.nt*np.diag(Ainv2))
-            return np.sum(np.abs(eloo))
-        else:
-            return sol
+        dc = G^-1 (dA^T (b - A c) - A^T dA c)
+        d(G^-1)_kk = -2 (G^-1 dA^T A G^-1)_kk
+        """
+        theta = np.asarray(theta, dtype=float)
+        fac = self._factorize(theta, D)
+        A, b, dA = self._design_matrix(theta, D, grad=True)
+
+        Ginv = fac["Ginv"]
+        c = fac["c"]
+        g = fac["ginv_diag"]
+        res = b - np.dot(A, c)
+
+        # derivatives of c and of diag(G^-1), one row per theta
+        dAc = np.einsum('lmk,k->lm', dA, c)
+        dc = np.dot(np.einsum('lmj,m->lj', dA, res) - np.dot(dAc, A), Ginv)
+        AGinv = np.dot(A, Ginv)
+        dg = -2.*np.einsum('lmk,mk->lk', np.matmul(dA, Ginv), AGinv)
+
+        cc = np.dot(c, c)
+        dcc = 2.*np.dot(dc, c)
+        sg = np.sum(1./g)
+        dsg = -np.dot(dg, 1./g**2)
+
+        return (dcc*sg + cc*dsg)/self.nt
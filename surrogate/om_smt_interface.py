@@ -11,6 +11,7 @@ import numpy as np
 from smt.surrogate_models import KRG, KPLS, GEKPLS, LS
 from surrogate.direct_gek import DGEK
 from surrogate.pougrad import POUHessian
+from utils.sutils import convert_to_smt_grads
 
 from collections import OrderedDict
 from openmdao.surrogate_models.surrogate_model import SurrogateModel
@@ -115,10 +116,7 @@ class SMTSurrogate(SurrogateModel):
         """
         m, n = x.shape
 
-        jac = np.zeros(m, n)
-
-        for i in range(n):
-            jac[:,i] = self.smt_model.predict_derivatives(x, i)
+        jac = convert_to_smt_grads(self.smt_model, x, deriv_predict=True)
         if jac.shape[0] == 1 and len(jac.shape) > 2:
             return jac[0, ...]
         return jac
\ No newline at end of file
@@ -57,6 +57,21 @@ class PCEStrictSurrogate(SurrogateModel):
             desc="sampler object for collocation points. REQUIRED"
         )
 
+        declare(
+            "eval_mode",
+            "tensor",
+            values=["tensor", "dense"],
+            types=str,
+            desc="tensor: contract the collocation data one direction at a time with barycentric Lagrange weights, dense: form the full query x collocation point Lagrange matrix self.Ls"
+        )
+
+        declare(
+            "max_chunk_bytes",
+            None,
+            types=int,
+            desc="If not None and eval_mode is tensor, evaluate query points in chunks so that the partially contracted data stays under roughly this many bytes"
+        )
+
         self.sampler = None
         self.xt = None
         self.ft = None
@@ -133,6 +148,74 @@ class PCEStrictSurrogate(SurrogateModel):
         self.sampler = sampler
 
     def _predict_values(self, x: np.ndarray) -> np.ndarray:
+        if self.options["eval_mode"] == "dense":
+            return self._predict_dense(x)
+
+        xlimits = self.options['bounds']
+        sampler = self.sampler
+        N = sampler.N
+        nq = x.shape[0]
+
+        # scaled input x
+        X_cont = np.zeros_like(x)
+        for i in range(self.dim):
+            X_cont[:,i] = 2.*(x[:,i] - xlimits[i,0])/sampler.scales[i] - 1.
+
+        # collocation data as a tensor, first direction slowest as in sampler.jumps
+        ft = self.ft.reshape(sampler.N_act, -1)
+        F = ft.reshape(N[0], -1)
+
+        # query points per chunk
+        step = nq
+        max_bytes = self.options["max_chunk_bytes"]
+        if max_bytes is not None:
+            step = max(1, int(max_bytes/(F.itemsize*F.shape[1])))
+
+        y = np.zeros([nq, ft.shape[1]])
+        for start in range(0, nq, step):
+            rows = slice(start, min(start + step, nq))
+            acc = self._lagrange_weights(X_cont[rows])
+
+            # the first direction is shared by all queries, then contract the
+            # remaining ones per query
+            T = np.dot(acc[0], F)
+            for i in range(1, self.dim):
+                T = np.einsum('qa,qab->qb', acc[i], T.reshape(T.shape[0], N[i], -1))
+            y[rows] = T
+
+        if self.ft.ndim == 1:
+            return y[:,0]
+        return y
+
+    def _lagrange_weights(self, X_cont):
+        """
+        1D Lagrange polynomials of each direction at scaled query points, in
+        the barycentric form
+
+        L_j(x) = (w_j/(x - x_j))/sum_k (w_k/(x - x_k)),  w_j = 1/ld_j
+
+        Returns
+        -------
+        acc : list of np.ndarray [nq, N[i]]
+        """
+        absc = self.sampler.absc_nsc
+        acc = []
+        for i in range(self.dim):
+            diff = X_cont[:,i][:,None] - absc[i][None,:]
+
+            # queries on a node take that node's value exactly
+            exact = diff == 0.
+            diff[exact] = 1.
+            L = (1./self.ld[i])/diff
+            L /= np.sum(L, axis=1)[:,None]
+            on_node = np.any(exact, axis=1)
+            L[on_node] = exact[on_node]
+
+            acc.append(L)
+
+        return acc
+
+    def _predict_dense(self, x):
         xlimits = self.options['bounds']
         sampler = self.sampler
         dim = self.dim
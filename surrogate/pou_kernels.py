@@ -0,0 +1,98 @@
+"""
+Compiled evaluation kernels for the POU surrogates in surrogate/pougrad.py
+
+If numba is available, pou_eval_nb is a thread-parallel (prange over query
+points) version of pou_eval. Otherwise pou_eval_nb is None, and the models fall
+back to their NumPy evaluation.
+"""
+
+import numpy as np
+
+para = False
+try:
+    from numba import njit, prange
+    para = True
+except:
+    prange = range
+
+
+"""
+Evaluate the normalized POU prediction, and optionally its gradient, at a set
+of query points, using the first and second order Taylor terms of each neighbor
+
+Parameters:
+    X: ndarray(nq, dim): normalized query points
+    xc: ndarray(n, dim): normalized sample locations
+    f: ndarray(n): normalized sample values
+    g: ndarray(n, dim): normalized sample gradients
+    h: ndarray(n, K): normalized sample Hessians (zeros for first order), each
+        flattened or in compressed symmetric form
+    hmap: ndarray(dim, dim): index of each Hessian entry in a row of h
+    idx: ndarray(nq or 1, nn): neighbor indices of each query point, a single
+        row is shared between all query points
+    lens: ndarray(nq or 1): number of valid entries in each row of idx
+    mindist: ndarray(nq): distance to the closest sample point
+    rho: float: distance scaling parameter
+    delta: float: distance regularization parameter
+    do_grad: bool: also compute the gradient
+
+Returns:
+    y: ndarray(nq): normalized prediction
+    dy: ndarray(nq, dim): normalized gradient, zeros if not do_grad
+"""
+def pou_eval(X, xc, f, g, h, hmap, idx, lens, mindist, rho, delta, do_grad):
+
+    nq = X.shape[0]
+    dim = X.shape[1]
+    # 0 if every query point shares the first row of idx
+    stride = np.int64(idx.shape[0] > 1)
+
+    y = np.zeros(nq)
+    dy = np.zeros((nq, dim))
+    for q in prange(nq):
+        r = np.int64(q)*stride
+        work = np.empty(dim)
+        hw = np.empty(dim)
+        dnumer = np.zeros(dim)
+        ddenom = np.zeros(dim)
+        numer = 0.
+        denom = 0.
+        for j in range(lens[r]):
+            i = idx[r, j]
+
+            d2 = 0.
+            for a in range(dim):
+                work[a] = X[q, a] - xc[i, a]
+                d2 += work[a]*work[a]
+            dist = np.sqrt(d2 + delta)
+            expfac = np.exp(-rho*(dist - mindist[q]))
+
+            # local Taylor terms, gradient and 0.5*dx^T H dx
+            local = f[i]
+            for a in range(dim):
+                hwa = 0.
+                for b in range(dim):
+                    hwa += h[i, hmap[a, b]]*work[b]
+                hw[a] = hwa
+                local += (g[i, a] + 0.5*hwa)*work[a]
+
+            numer += local*expfac
+            denom += expfac
+
+            if do_grad:
+                for a in range(dim):
+                    dexpfac = -rho*expfac*work[a]/dist
+                    dnumer[a] += local*dexpfac + expfac*(g[i, a] + hw[a])
+                    ddenom[a] += dexpfac
+
+        y[q] = numer/denom
+        if do_grad:
+            for a in range(dim):
+                dy[q, a] = dnumer[a]/denom - numer*ddenom[a]/(denom*denom)
+
+    return y, dy
+
+
+pou_eval_nb = None
+if para:
+    pou_eval_nb = njit(pou_eval, fastmath=False, parallel=True)
@@ -1,14 +1,18 @@
 import numpy as np
 import time
+import hashlib
 
 from smt.surrogate_models.surrogate_model import SurrogateModel
+from smt.utils.checks import check_support, ensure_2d_array
 from smt.utils.options_dictionary import OptionsDictionary
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from scipy.spatial import KDTree
 from scipy.spatial.distance import pdist, cdist, squareform
 from scipy.stats import qmc
-from utils.sutils import estimate_pou_volume, innerMatrixProduct, quadraticSolveHOnly, symMatfromVec
-from utils.sutils import standardization2, divide_cases
+from utils.sutils import estimate_pou_volume, innerMatrixProduct, quadraticSolveHOnly, symMatfromVec, symMatIndexMap
+from utils.sutils import symMatPack, symMatUnpack, symMatQuadPacked, symMatVecPacked
+from utils.sutils import standardization2, divide_cases, gather_cases, estimate_stencil_hessians, stale_stencils
+from surrogate.pou_kernels import pou_eval_nb
 from mpi4py import MPI
 
 comm = MPI.COMM_WORLD
@@ -92,9 +96,51 @@ class POUSurrogate(SurrogateModel):
             desc="If not None, use to determine a ball-point radius for which POU numerator contributes greater than it. Then, use a KDTree to query points in that ball during evaluation"
         )
 
+        declare(
+            "eval_mode",
+            "loop",
+            values=["loop", "batch", "compiled"],
+            types=str,
+            desc="loop: evaluate query points one at a time, batch: evaluate blocks of query points at once with padded neighbor arrays, compiled: evaluate with the thread-parallel numba kernel in pou_kernels, falling back to batch if numba is not available"
+        )
+
+        declare(
+            "batch_size",
+            100,
+            types=int,
+            desc="Maximum number of query points per block if eval_mode is batch"
+        )
+
+        declare(
+            "max_chunk_bytes",
+            None,
+            types=int,
+            desc="If not None, evaluate query points in chunks so that distance and neighbor arrays stay under roughly this many bytes, instead of forming the full query x sample distance matrix"
+        )
+
+        declare(
+            "dtype",
+            "float64",
+            values=["float64", "float32"],
+            types=str,
+            desc="Storage precision of the normalized training locations, gradients and Hessians, and of the distance and weight computations in prediction. Sums are always accumulated in float64"
+        )
+
+        declare(
+            "neighbor_cache_size",
+            0,
+            types=int,
+            desc="Number of query chunks for which distances, neighbor lists and closest sample distances are kept in an LRU cache, reused when the same points are predicted again. 0 disables the cache"
+        )
+
         self.supports["training_derivatives"] = True
+        self.supports["derivatives"] = True
+        self.supports["jacobian"] = True
 
         self._return_terms = False # return gradient terms, only on when calling new method
+        self.clear_neighbor_cache()
+        self.reset_timings() # accumulated prediction time, local computation vs result assembly
+        self.serial_eval = False # if True, every proc predicts all of its own points
     """
     Evaluate the surrogate as-is at the point x
 
@@ -115,7 +161,7 @@ class POUSurrogate(SurrogateModel):
     # @njit(parallel=True)
     def _predict_values(self, xt):
 
-        X_cont = (xt - self.X_offset) / self.X_scale
+        X_cont = ((xt - self.X_offset) / self.X_scale).astype(self.X_norma.dtype, copy=False)
         xc = self.X_norma
         f = self.y_norma
         g = self.g_norma
@@ -128,60 +174,71 @@ class POUSurrogate(SurrogateModel):
         cmin = self.options["min_points"]
         ball_rad = None
         neighbors = None
-        cases = divide_cases(numeval, size)
+        ecomm = self._eval_comm()
+        cases = divide_cases(numeval, ecomm.size)
+        t0 = time.perf_counter()
 
         if(self.options["rscale"]):
             rho = self.options["rscale"]*pow(numsample, 1./xc.shape[1])
 
         # y_ = POUEval(X_cont, xc, f, g, h, delta, rho)
 
-        D = cdist(X_cont , xc) #numeval x numsample
-        
-        neighbors_all, ball_rad = self.neighbors_func(X_cont, rho, cap, cmin, numsample, cases)
+        # loop over rows in xt, in memory-bounded chunks if requested
+        y_ = np.zeros(numeval)
+        mindist = np.zeros(numeval)
+        eval_mode = self._eval_mode()
+        for rows in self._query_chunks(cases[ecomm.rank], numsample):
+            # exhaustive search for closest sample point, for regularization
+            D, neighbors_all, ball_rad, mindist[rows] = self._chunk_neighbors(X_cont[rows,:], rho, cap, cmin, numsample, dense=eval_mode == "loop")
 
-        # exhaustive search for closest sample point, for regularization
-        mindist = np.min(D, axis=1)
+            if eval_mode == "compiled":
+                y_[rows] = self._predict_compiled(X_cont, rows, neighbors_all, ball_rad, mindist[rows], rho, delta, False)[0]
+                continue
 
-        # loop over rows in xt
-        y_ = np.zeros(numeval)
-        c = 0
-        for k in cases[rank]:
-        # for k in range(numeval): ###NOTE: TURN INTO PRANGE?
-        # for k in prange(numeval): ###NOTE: TURN INTO PRANGE?
-            x = X_cont[k,:]
+            if eval_mode == "batch":
+                y_[rows] = self._predict_values_batch(X_cont, rows, neighbors_all, ball_rad, mindist[rows], rho, delta)
+                continue
 
-            numer = 0
-            denom = 0
+            c = 0
+            for k in rows:
+            # for k in range(numeval): ###NOTE: TURN INTO PRANGE?
+            # for k in prange(numeval): ###NOTE: TURN INTO PRANGE?
+                x = X_cont[k,:]
 
-            neighbors = neighbors_all
-            if ball_rad:
-                # neighbors = neighbors_all[k]
-                neighbors = neighbors_all[c]
-                xc = self.X_norma[neighbors]
+                numer = 0
+                denom = 0
 
-            # evaluate the surrogate, requiring the distance from every point
-            # for i in range(numsample):
+                neighbors = neighbors_all
+                if ball_rad:
+                    # neighbors = neighbors_all[k]
+                    neighbors = neighbors_all[c]
+                    xc = self.X_norma[neighbors]
 
-            work = x - xc
-            dist = np.sqrt(D[k,neighbors]**2 + delta)#np.sqrt(D[0][i] + delta)
-            expfac = np.exp(-rho*(dist-mindist[k]))
-            # local = np.zeros(numsample)
+                # evaluate the surrogate, requiring the distance from every point
+                # for i in range(numsample):
 
-            # for i in range(numsample):
-            #     local[i] = f[i] + self.higher_terms(work[i], g[i], h[i])
-            local = f[neighbors,0] + self.higher_terms(work, g[neighbors], h[neighbors])
+                work = x - xc
+                dist = np.sqrt(D[c,neighbors]**2 + delta)#np.sqrt(D[0][i] + delta)
+                expfac = self._weights(dist, mindist[k], rho)
+                # local = np.zeros(numsample)
 
-            numer = np.dot(local, expfac)
-            denom = np.sum(expfac)
-            # t2 = time.time()
+                # for i in range(numsample):
+                #     local[i] = f[i] + self.higher_terms(work[i], g[i], h[i])
+                local = f[neighbors,0] + self.higher_terms(work, g[neighbors], h[neighbors])
 
-            # exec1 += t1-t0
-            # exec2 += t2-t1
+                numer = np.dot(local, expfac)
+                denom = np.sum(expfac)
+                # t2 = time.time()
 
-            y_[k] = numer/denom
-            c += 1
+                # exec1 += t1-t0
+                # exec2 += t2-t1
 
-        y_ = comm.allreduce(y_)
+                y_[k] = numer/denom
+                c += 1
+
+        t1 = time.perf_counter()
+        y_ = gather_cases(y_[cases[ecomm.rank]], cases, comm=ecomm)
+        self._add_timings(t0, t1)
         y = (self.y_mean + self.y_std * y_).ravel()
 
         # print("mindist  = ", exec1)
@@ -210,11 +267,10 @@ class POUSurrogate(SurrogateModel):
             Derivatives at the prediction points.
         
     """
-    #TODO: Cache points to skip min dist calcs?
     # @njit(parallel=True)
     def _predict_derivatives(self, xt, kx):
 
-        X_cont = (xt - self.X_offset) / self.X_scale
+        X_cont = ((xt - self.X_offset) / self.X_scale).astype(self.X_norma.dtype, copy=False)
         xc = self.X_norma
         f = self.y_norma
         g = self.g_norma
@@ -228,82 +284,88 @@ class POUSurrogate(SurrogateModel):
         cmin = self.options["min_points"]
         ball_rad = None
         neighbors = None
-        cases = divide_cases(numeval, size)
+        ecomm = self._eval_comm()
+        cases = divide_cases(numeval, ecomm.size)
+        t0 = time.perf_counter()
 
         if(self.options["rscale"]):
             rho = self.options["rscale"]*pow(numsample, 1./xc.shape[1])
 
-        D = cdist(X_cont ,xc) #numeval x numsample
-
         # neighbors_all = list(range(numsample))
         # if(cap):
         #     ball_rad = -np.log(cap)/rho
         #     neighbors_all = self.tree.query_ball_point(X_cont, ball_rad)
 
-        neighbors_all, ball_rad = self.neighbors_func(X_cont, rho, cap, cmin, numsample, cases)
-
-        mindist = np.min(D, axis=1)
-
-        # loop over rows in xt
+        # loop over rows in xt, in memory-bounded chunks if requested
         y_ = np.zeros(numeval)
         dy_dx_ = np.zeros(numeval)
         d1_ = np.zeros(numeval)
         d2_ = np.zeros(numeval)
         d3_ = np.zeros(numeval)
-        c = 0
-        for k in cases[rank]:
-        # for k in range(numeval):
-        # for k in prange(numeval):
-            x = X_cont[k,:]
-
-            numer = 0
-            denom = 0
-            dnumer = 0#np.zeros(self.dim)
-            ddenom = 0#np.zeros(self.dim)
-
-            neighbors = neighbors_all
-            if ball_rad:
-                # neighbors = neighbors_all[k]
-                neighbors = neighbors_all[c]
-                xc = self.X_norma[neighbors]
-
-            # evaluate the surrogate, requiring the distance from every point
-            # for i in range(numsample):
-            work = x - xc
-            dist = np.sqrt(D[k,neighbors]**2 + delta)#np.sqrt(D[0][i] + delta)
-            ddist = work[:,kx]/dist
-
-            expfac = np.exp(-rho*(dist-mindist[k]))
-            dexpfac = -rho*expfac*ddist
+        # the compiled kernel does not split the derivative into terms
+        compiled = self._eval_mode() == "compiled" and not self._return_terms
+        for rows in self._query_chunks(cases[ecomm.rank], numsample):
+            D, neighbors_all, ball_rad, mindist = self._chunk_neighbors(X_cont[rows,:], rho, cap, cmin, numsample, dense=not compiled)
+
+            if compiled:
+                y_[rows], dy = self._predict_compiled(X_cont, rows, neighbors_all, ball_rad, mindist, rho, delta, True)
+                d1_[rows] = dy[:,kx] # full derivative, d2 and d3 stay zero
+                continue
+
+            c = 0
+            for k in rows:
+            # for k in range(numeval):
+            # for k in prange(numeval):
+                x = X_cont[k,:]
+
+                numer = 0
+                denom = 0
+                dnumer = 0#np.zeros(self.dim)
+                ddenom = 0#np.zeros(self.dim)
+
+                neighbors = neighbors_all
+                if ball_rad:
+                    # neighbors = neighbors_all[k]
+                    neighbors = neighbors_all[c]
+                    xc = self.X_norma[neighbors]
+
+                # evaluate the surrogate, requiring the distance from every point
+                # for i in range(numsample):
+                work = x - xc
+                dist = np.sqrt(D[c,neighbors]**2 + delta)#np.sqrt(D[0][i] + delta)
+                ddist = work[:,kx]/dist
+
+                expfac = self._weights(dist, mindist[c], rho)
+                dexpfac = -rho*expfac*ddist
 
-            # local = np.zeros(numsample)
-            dlocal = np.zeros(numsample)
-            # for i in range(numsample):
-            local = f[neighbors,0] + self.higher_terms(work, g[neighbors], h[neighbors])
-            dlocal = self.higher_terms_deriv(work, g[neighbors], h[neighbors], kx)
-
-            numer = np.dot(local, expfac)
-            dnumer = np.dot(local, dexpfac) + np.dot(dlocal, expfac)
-            denom = np.sum(expfac)
-            ddenom = np.sum(dexpfac)
-            # t2 = time.time()
-
-            # exec1 += t1-t0
-            # exec2 += t2-t1
-            
-            y_[k] = numer/denom
-            # dy_dx_[k] = (denom*dnumer - numer*ddenom)/(denom**2)
-
-            d1_[k] = np.dot(local, dexpfac)/denom
-            d2_[k] = np.dot(dlocal, expfac)/denom
-            # import pdb; pdb.set_trace()
-            d3_[k] = -(numer*ddenom)/(denom**2)
-            c += 1
-            # dy_dx_[k] = (denom*dnumer - numer*ddenom)/(denom**2)
-        y_ = comm.allreduce(y_)
-        d1_ = comm.allreduce(d1_)
-        d2_ = comm.allreduce(d2_)
-        d3_ = comm.allreduce(d3_)
+                # local = np.zeros(numsample)
+                dlocal = np.zeros(numsample)
+                # for i in range(numsample):
+                local = f[neighbors,0] + self.higher_terms(work, g[neighbors], h[neighbors])
+                dlocal = self.higher_terms_deriv(work, g[neighbors], h[neighbors], kx)
+
+                numer = np.dot(local, expfac)
+                dnumer = np.dot(local, dexpfac) + np.dot(dlocal, expfac)
+                denom = np.sum(expfac)
+                ddenom = np.sum(dexpfac)
+                # t2 = time.time()
+
+                # exec1 += t1-t0
+                # exec2 += t2-t1
+                
+                y_[k] = numer/denom
+                # dy_dx_[k] = (denom*dnumer - numer*ddenom)/(denom**2)
+
+                d1_[k] = np.dot(local, dexpfac)/denom
+                d2_[k] = np.dot(dlocal, expfac)/denom
+                # import pdb; pdb.set_trace()
+                d3_[k] = -(numer*ddenom)/(denom**2)
+                c += 1
+                # dy_dx_[k] = (denom*dnumer - numer*ddenom)/(denom**2)
+        t1 = time.perf_counter()
+        terms = gather_cases(np.stack([y_, d1_, d2_, d3_], axis=1)[cases[ecomm.rank]], cases, comm=ecomm)
+        self._add_timings(t0, t1)
+        y_, d1_, d2_, d3_ = terms.T
 
         y = (self.y_mean + self.y_std * y_).ravel()
         # dy_dx = (self.y_std * dy_dx_).ravel()/self.X_scale[kx] 
@@ -319,16 +381,446 @@ class POUSurrogate(SurrogateModel):
         return d1+d2+d3 #dy_dx
 
 
+    """
+    Evaluate the surrogate and all of its derivatives wrt x at once, sharing
+    the neighbor search, distances and weights between the partials
+
+    Parameters
+    ----------
+
+    Parameters
+        ----------
+        xt : np.ndarray[nt, nx]
+            Input values for the prediction points.
+
+        return_values : bool
+            If True, also return the prediction at the points
+
+        Returns
+        -------
+        dy_dx : np.ndarray[nt, nx]
+            Derivatives at the prediction points, one column per input.
+
+        y : np.ndarray[nt, ny]
+            Output values at the prediction points, if return_values
+        
+    """
+    def predict_jacobian(self, xt, return_values=False):
+
+        check_support(self, "derivatives")
+        xt = ensure_2d_array(xt, "xt")
+        self._check_xdim(xt)
+        n = xt.shape[0]
+
+        y, dy_dx = self._predict_jacobian(xt)
+
+        if return_values:
+            return dy_dx, y.reshape((n, self.ny))
+        return dy_dx
+
+    def _predict_jacobian(self, xt):
+
+        X_cont = ((xt - self.X_offset) / self.X_scale).astype(self.X_norma.dtype, copy=False)
+        xc = self.X_norma
+        f = self.y_norma
+        g = self.g_norma
+        h = self.h
+        numsample = xc.shape[0]
+        numeval = X_cont.shape[0]
+        dim = X_cont.shape[1]
+        delta = self.options["delta"]
+        rho = self.options["rho"]
+
+        cap = self.options["min_contribution"]
+        cmin = self.options["min_points"]
+        ecomm = self._eval_comm()
+        cases = divide_cases(numeval, ecomm.size)
+        t0 = time.perf_counter()
+
+        if(self.options["rscale"]):
+            rho = self.options["rscale"]*pow(numsample, 1./xc.shape[1])
+
+        # loop over rows in xt, in memory-bounded chunks if requested
+        y_ = np.zeros(numeval)
+        dy_dx_ = np.zeros([numeval, dim])
+        eval_mode = self._eval_mode()
+        for rows in self._query_chunks(cases[ecomm.rank], numsample):
+            D, neighbors_all, ball_rad, mindist = self._chunk_neighbors(X_cont[rows,:], rho, cap, cmin, numsample, dense=eval_mode != "compiled")
+
+            if eval_mode == "compiled":
+                y_[rows], dy_dx_[rows,:] = self._predict_compiled(X_cont, rows, neighbors_all, ball_rad, mindist, rho, delta, True)
+                continue
+
+            c = 0
+            for k in rows:
+                x = X_cont[k,:]
+
+                neighbors = neighbors_all
+                if ball_rad:
+                    neighbors = neighbors_all[c]
+                    xc = self.X_norma[neighbors]
+
+                # same terms as _predict_derivatives, but with every kx as a column
+                work = x - xc
+                dist = np.sqrt(D[c,neighbors]**2 + delta)
+                ddist = work/dist[:,None]
+
+                expfac = self._weights(dist, mindist[c], rho)
+                dexpfac = -rho*expfac[:,None]*ddist
+
+                local = f[neighbors,0] + self.higher_terms(work, g[neighbors], h[neighbors])
+                dlocal = self.higher_terms_grad(work, g[neighbors], h[neighbors])
+
+                numer = np.dot(local, expfac)
+                denom = np.sum(expfac)
+                ddenom = np.sum(dexpfac, axis=0)
+
+                y_[k] = numer/denom
+                dy_dx_[k,:] = (np.dot(local, dexpfac) + np.dot(expfac, dlocal))/denom - (numer*ddenom)/(denom**2)
+                c += 1
+
+        t1 = time.perf_counter()
+        terms = gather_cases(np.hstack([y_[:,None], dy_dx_])[cases[ecomm.rank]], cases, comm=ecomm)
+        self._add_timings(t0, t1)
+        y_ = terms[:,0]
+        dy_dx_ = terms[:,1:]
+
+        y = (self.y_mean + self.y_std * y_).ravel()
+        dy_dx = (self.y_std * dy_dx_)/self.X_scale
+
+        return y, dy_dx
+
+    """
+    Leave-one-out predictions, obtained by dropping each sample's local
+    expansion from the partition of unity. The gradients and Hessians of the
+    remaining samples are not re-estimated, as in POUCV
+
+    Parameters
+    ----------
+
+    Parameters
+        ----------
+        xt : np.ndarray[nt, nx] or None
+            Input values for the prediction points. If None, each
+            leave-one-out model is only evaluated at its left out sample
+
+        Returns
+        -------
+        y : np.ndarray[ntr] if xt is None
+            Prediction of the i-th leave-one-out model at the i-th sample
+            np.ndarray[nt, ntr] otherwise
+            Predictions of every leave-one-out model at the prediction points
+
+    """
+    def predict_loo_values(self, xt=None):
+
+        xc = self.X_norma
+        f = self.y_norma
+        g = self.g_norma
+        h = self.h
+        numsample = xc.shape[0]
+        delta = self.options["delta"]
+        rho = self.options["rho"]
+        cap = self.options["min_contribution"]
+        cmin = self.options["min_points"]
+
+        if(self.options["rscale"]):
+            rho = self.options["rscale"]*pow(numsample, 1./xc.shape[1])
+
+        at_samples = xt is None
+        if at_samples:
+            X_cont = xc.astype(np.float64)
+            y_ = np.zeros([numsample, 1])
+        else:
+            xt = ensure_2d_array(xt, "xt")
+            X_cont = ((xt - self.X_offset) / self.X_scale).astype(self.X_norma.dtype, copy=False)
+            y_ = np.zeros([X_cont.shape[0], numsample])
+        numeval = X_cont.shape[0]
+        ecomm = self._eval_comm()
+        cases = divide_cases(numeval, ecomm.size)
+        t0 = time.perf_counter()
+
+        for rows in self._query_chunks(cases[ecomm.rank], numsample):
+            D, neighbors_all, ball_rad, mindist = self._chunk_neighbors(X_cont[rows,:], rho, cap, cmin, numsample)
+
+            c = 0
+            for k in rows:
+                neighbors = np.arange(numsample)
+                if ball_rad:
+                    neighbors = np.asarray(neighbors_all[c], dtype=int)
+
+                if at_samples:
+                    # the left out sample is the query point itself
+                    neighbors = neighbors[neighbors != k]
+                    if neighbors.shape[0] == 0:
+                        neighbors = np.delete(np.arange(numsample), k)
+
+                work = X_cont[k,:] - xc[neighbors]
+                dist = np.sqrt(D[c,neighbors]**2 + delta)
+                local = f[neighbors,0] + self.higher_terms(work, g[neighbors], h[neighbors])
+
+                near = np.argmin(dist)
+                expfac = self._weights(dist, dist[near], rho)
+                numer = np.dot(local, expfac)
+                denom = np.sum(expfac)
+
+                if at_samples:
+                    y_[k,0] = numer/denom
+                    c += 1
+                    continue
+
+                # removing any sample but the closest only takes its term out of the sums
+                y_[k,:] = numer/denom
+                y_[k,neighbors] = (numer - local*expfac)/(denom - expfac)
+
+                # the closest sample can dominate both sums, so sum the rest directly
+                if neighbors.shape[0] > 1:
+                    expfac = self._weights(dist, np.partition(dist, 1)[1], rho)
+                    expfac[near] = 0.
+                    y_[k,neighbors[near]] = np.dot(local, expfac)/np.sum(expfac)
+                c += 1
+
+        t1 = time.perf_counter()
+        y_ = gather_cases(y_[cases[ecomm.rank]], cases, comm=ecomm)
+        self._add_timings(t0, t1)
+        y = self.y_mean + self.y_std * y_
+
+        if at_samples:
+            return y[:,0]
+        return y
+
+    """
+    Gradients of the leave-one-out predictions of predict_loo_values. The
+    shift of the weights by the closest distance cancels in each ratio, so it
+    is not differentiated
+
+    Parameters
+        ----------
+        xt : np.ndarray[nt, nx]
+            Input values for the prediction points
+
+        Returns
+        -------
+        dy : np.ndarray[nt, ntr, nx]
+            Gradients of every leave-one-out model at the prediction points
+
+    """
+    def predict_loo_derivatives(self, xt):
+
+        xc = self.X_norma
+        f = self.y_norma
+        g = self.g_norma
+        h = self.h
+        numsample = xc.shape[0]
+        delta = self.options["delta"]
+        rho = self.options["rho"]
+        cap = self.options["min_contribution"]
+        cmin = self.options["min_points"]
+
+        if(self.options["rscale"]):
+            rho = self.options["rscale"]*pow(numsample, 1./xc.shape[1])
+
+        xt = ensure_2d_array(xt, "xt")
+        X_cont = ((xt - self.X_offset) / self.X_scale).astype(self.X_norma.dtype, copy=False)
+        numeval, dim = X_cont.shape
+        dy_ = np.zeros([numeval, numsample, dim])
+        ecomm = self._eval_comm()
+        cases = divide_cases(numeval, ecomm.size)
+        t0 = time.perf_counter()
+
+        def ratio_grad(local, dlocal, expfac, dexpfac):
+            numer = np.dot(local, expfac)
+            denom = np.sum(expfac)
+            dnumer = np.dot(local, dexpfac) + np.dot(expfac, dlocal)
+            ddenom = np.sum(dexpfac, axis=0)
+            return numer, denom, dnumer, ddenom
+
+        for rows in self._query_chunks(cases[ecomm.rank], numsample):
+            D, neighbors_all, ball_rad, mindist = self._chunk_neighbors(X_cont[rows,:], rho, cap, cmin, numsample)
+
+            c = 0
+            for k in rows:
+                neighbors = np.arange(numsample)
+                if ball_rad:
+                    neighbors = np.asarray(neighbors_all[c], dtype=int)
+
+                work = X_cont[k,:] - xc[neighbors]
+                dist = np.sqrt(D[c,neighbors]**2 + delta)
+                ddist = work/dist[:,None]
+                local = f[neighbors,0] + self.higher_terms(work, g[neighbors], h[neighbors])
+                dlocal = self.higher_terms_grad(work, g[neighbors], h[neighbors])
+
+                near = np.argmin(dist)
+                expfac = self._weights(dist, dist[near], rho)
+                dexpfac = -rho*expfac[:,None]*ddist
+                numer, denom, dnumer, ddenom = ratio_grad(local, dlocal, expfac, dexpfac)
+
+                dy_[k,:,:] = (dnumer*denom - numer*ddenom)/(denom**2)
+
+                # removing a sample takes its term out of both sums
+                nr = numer - local*expfac
+                dr = denom - expfac
+                dnr = dnumer[None,:] - (local[:,None]*dexpfac + expfac[:,None]*dlocal)
+                ddr = ddenom[None,:] - dexpfac
+                dy_[k,neighbors,:] = dnr/dr[:,None] - nr[:,None]*ddr/(dr**2)[:,None]
+
+                # the closest sample can dominate both sums, so sum the rest directly
+                if neighbors.shape[0] > 1:
+                    expfac = self._weights(dist, np.partition(dist, 1)[1], rho)
+                    expfac[near] = 0.
+                    dexpfac = -rho*expfac[:,None]*ddist
+                    numer, denom, dnumer, ddenom = ratio_grad(local, dlocal, expfac, dexpfac)
+                    dy_[k,neighbors[near],:] = (dnumer*denom - numer*ddenom)/(denom**2)
+                c += 1
+
+        t1 = time.perf_counter()
+        dy_ = gather_cases(dy_[cases[ecomm.rank]].reshape(-1, numsample*dim), cases, comm=ecomm)
+        self._add_timings(t0, t1)
+
+        return (self.y_std*dy_.reshape(numeval, numsample, dim))/self.X_scale[None,None,:]
+
     def higher_terms(self, dx, g, h):
         return (g*dx).sum(axis = 1)
-    
+
     # wrt dx[kx]
     def higher_terms_deriv(self, dx, g, h, kx):
         dterms = np.zeros(dx.shape[0])
         dterms += g[:,kx]
         return dterms
 
+    # wrt all of dx, one column per kx
+    def higher_terms_grad(self, dx, g, h):
+        dterms = np.zeros_like(dx)
+        dterms += g
+        return dterms
+
+    def _predict_values_batch(self, X_cont, rows, neighbors_all, ball_rad, mindist, rho, delta):
+        """
+        Evaluate the normalized POU prediction for the given rows of X_cont in
+        blocks of at most batch_size points. Neighbor lists are padded to a
+        common length and masked out of the weights, so each block is a single
+        set of array operations instead of a python loop over query points.
+        mindist is only for the given rows
+
+        Returns the normalized prediction for the given rows only
+        """
+        dim = X_cont.shape[1]
+        bsize = self.options["batch_size"]
+        rows = np.asarray(rows, dtype=int)
+
+        y_ = np.zeros(rows.shape[0])
+        for l1 in range(0, rows.shape[0], bsize):
+            l2 = min(l1 + bsize, rows.shape[0])
+            brows = rows[l1:l2]
+            if ball_rad:
+                idx, mask = self._pad_neighbors(neighbors_all[l1:l2])
+            else:
+                idx = np.tile(np.asarray(neighbors_all, dtype=int), (l2-l1, 1))
+                mask = np.full(idx.shape, True)
+            nb, nn = idx.shape
+
+            work = X_cont[brows,None,:] - self.X_norma[idx]
+            dist = np.sqrt(np.einsum('ijk,ijk->ij', work, work) + delta)
+            expfac = self._weights(dist, mindist[l1:l2,None], rho)
+            expfac[~mask] = 0.
+
+            # reuse the per-point kernel on the flattened (query, neighbor) pairs
+            local = self.y_norma[idx,0] + self.higher_terms(work.reshape(nb*nn, dim),
+                                                             self.g_norma[idx].reshape(nb*nn, dim),
+                                                             self.h[idx].reshape((nb*nn,) + self.h.shape[1:])).reshape(nb, nn)
+
+            numer = np.einsum('ij,ij->i', local, expfac)
+            denom = np.sum(expfac, axis=1)
+            y_[l1:l2] = numer/denom
+
+        return y_
+
+    def _predict_compiled(self, X_cont, rows, neighbors_all, ball_rad, mindist, rho, delta, do_grad):
+        """
+        Evaluate the normalized POU prediction, and its gradient if do_grad, at
+        the given rows of X_cont with the compiled kernel. mindist is only for
+        the given rows
+
+        Returns the prediction and gradient for the given rows only
+        """
+        if rows.shape[0] == 0:
+            return np.zeros(0), np.zeros([0, X_cont.shape[1]])
+
+        if ball_rad:
+            idx, mask = self._pad_neighbors(neighbors_all)
+            lens = np.sum(mask, axis=1)
+        else:
+            idx = np.atleast_2d(np.asarray(neighbors_all, dtype=np.int64))
+            lens = np.array([idx.shape[1]], dtype=np.int64)
+
+        # dense or packed Hessians, flattened per point with an index map to each entry
+        dim = X_cont.shape[1]
+        if self.h.ndim == 2:
+            hmap = symMatIndexMap(dim)
+        else:
+            hmap = np.arange(dim*dim).reshape(dim, dim)
+
+        return pou_eval_nb(X_cont[rows,:], self.X_norma, self.y_norma[:,0], self.g_norma, self.h.reshape(self.h.shape[0], -1),
+                           hmap, idx, lens, mindist, float(rho), float(delta), do_grad)
+
+    def _eval_mode(self):
+        eval_mode = self.options["eval_mode"]
+        if eval_mode == "compiled" and pou_eval_nb is None:
+            eval_mode = "batch"
+        return eval_mode
+
+    def _query_chunks(self, rows, numsample):
+        """
+        Split the query rows owned by this rank into chunks whose distance rows,
+        neighbor lists and, in batch mode, gathered (query, neighbor) work arrays
+        fit in max_chunk_bytes. Yields all rows at once if max_chunk_bytes is None
+        """
+        rows = np.asarray(rows, dtype=int)
+        max_bytes = self.options["max_chunk_bytes"]
+        if max_bytes is None:
+            yield rows
+            return
+
+        # one distance row and one neighbor list per query point
+        row_bytes = 16*numsample
+        if self.options["eval_mode"] == "batch":
+            row_bytes += 8*numsample*(self.dim*self.dim + self.dim + 3)
+        nchunk = max(1, int(max_bytes // row_bytes))
+
+        for l1 in range(0, rows.shape[0], nchunk):
+            yield rows[l1:l1+nchunk]
+
+    def _weights(self, dist, mindist, rho):
+        """
+        Exponential POU weights. These are computed in the storage dtype, but
+        returned in float64 so that the weighted sums accumulate in double
+        precision
+        """
+        dt = self.X_norma.dtype.type
+        expfac = np.exp(-dt(rho)*(np.asarray(dist, dtype=dt) - np.asarray(mindist, dtype=dt)))
+        return expfac.astype(np.float64, copy=False)
+
+    def _pad_neighbors(self, neighbors):
+        """
+        Convert a list of variable length neighbor index lists to a padded
+        index array and a mask of the valid entries
+        """
+        lens = np.array([len(n) for n in neighbors], dtype=int)
+        nmax = np.max(lens)
+        mask = np.arange(nmax)[None,:] < lens[:,None]
+        idx = np.zeros([len(neighbors), nmax], dtype=int)
+        idx[mask] = np.concatenate([np.asarray(n, dtype=int) for n in neighbors])
+        return idx, mask
+
     def _train(self):
+
+        self._train_setup()
+
+        self._train_further()
+
+        self._set_storage()
+
+    def _train_setup(self):
         xc = self.training_points[None][0][0]
         f = self.training_points[None][0][1]
 
@@ -351,13 +843,71 @@ class POUSurrogate(SurrogateModel):
             self.g_norma[:,[i]] = self.training_points[None][i+1][1]*(self.X_scale[i]/self.y_std)
 
         self.tree = KDTree(self.X_norma)
-
-        self._train_further()
+        self.clear_neighbor_cache()
 
     def _train_further(self):
         xc = self.training_points[None][0][0]
         self.h = np.zeros([xc.shape[0], self.dim, self.dim])
         # self.dV = estimate_pou_volume(self.training_points[None][0][0], self.options["bounds"])
+
+    def _train_further_incremental(self, nnew, y_std_old):
+        self._train_further()
+
+    def _set_storage(self):
+        # training is done in float64, only the stored arrays used in prediction are converted
+        dt = np.dtype(self.options["dtype"])
+        self.X_norma = self.X_norma.astype(dt, copy=False)
+        self.g_norma = self.g_norma.astype(dt, copy=False)
+        self.h = self.h.astype(dt, copy=False)
+
+    def add_points(self, xt, yt, gt):
+        """
+        Append training points and their gradients to the existing training
+        data, and update the model with train_incremental
+
+        Parameters
+        ----------
+        xt : np.ndarray[nnew, nx]
+            New training point locations
+        yt : np.ndarray[nnew, 1]
+            New training point values
+        gt : np.ndarray[nnew, nx]
+            New training point gradients
+        """
+        xt = np.atleast_2d(xt)
+        yt = np.reshape(yt, [xt.shape[0], 1])
+        gt = np.reshape(gt, xt.shape)
+
+        xall = np.append(self.training_points[None][0][0], xt, axis=0)
+        yall = np.append(self.training_points[None][0][1], yt, axis=0)
+        gall = [np.append(self.training_points[None][j+1][1], gt[:,[j]], axis=0) for j in range(xt.shape[1])]
+
+        self.set_training_values(xall, yall)
+        for j in range(xt.shape[1]):
+            self.set_training_derivatives(xall, gall[j], j)
+
+        self.train_incremental(xt.shape[0])
+
+    def train_incremental(self, nnew):
+        """
+        Update the trained model after nnew points were appended to the end of
+        the training data. Standardization, gradients and the KDTree are redone
+        over all points, but subclass work per training point (e.g. Hessian
+        stencils) is only redone where the new points change it. Falls back to
+        a full train if the model is not trained on the first ntr - nnew points
+        """
+        ntr = self.training_points[None][0][0].shape[0]
+        if getattr(self, "X_norma", None) is None or self.X_norma.shape[0] + nnew != ntr:
+            self.train()
+            return
+
+        y_std_old = self.y_std
+
+        self._train_setup()
+
+        self._train_further_incremental(nnew, y_std_old)
+
+        self._set_storage()
         
     def get_gradient_terms(self, xt, kx):
 
@@ -367,13 +917,71 @@ class POUSurrogate(SurrogateModel):
         return d1, d2, d3
 
 
+    def _chunk_neighbors(self, X_rows, rho, cap, cmin, numsample, dense=True):
+        """
+        Distances, neighbor lists, ball radius and closest sample distance for
+        a chunk of query points. The dense distances to every sample are only
+        computed if dense, the closest sample distance comes from the KDTree
+        otherwise and D is None. If neighbor_cache_size > 0, results are kept
+        in an LRU cache keyed on the query buffer and the neighbor parameters,
+        so that repeated calls on the same points (values, then each
+        derivative) skip the distance and KDTree computations
+        """
+        nsize = self.options["neighbor_cache_size"]
+        if nsize > 0:
+            X_rows = np.ascontiguousarray(X_rows)
+            key = (hashlib.sha1(X_rows.tobytes()).hexdigest(), X_rows.shape, rho, cap, cmin, dense)
+            if key in self._ncache:
+                self._ncache.move_to_end(key)
+                self.cache_hits += 1
+                return self._ncache[key]
+            self.cache_misses += 1
+
+        D = None
+        neighbors_all, ball_rad = self._query_neighbors(X_rows, rho, cap, cmin, numsample)
+        if dense:
+            D = cdist(X_rows, self.X_norma) #nrows x numsample
+            mindist = np.min(D, axis=1)
+        else:
+            mindist = self.tree.query(X_rows, k=1)[0]
+
+        if nsize > 0:
+            self._ncache[key] = (D, neighbors_all, ball_rad, mindist)
+            while len(self._ncache) > nsize:
+                self._ncache.popitem(last=False)
+
+        return D, neighbors_all, ball_rad, mindist
+
+    def _add_timings(self, t0, t1):
+        # compute from t0 to t1, then communication until now
+        self.timings["compute"] += t1 - t0
+        self.timings["comm"] += time.perf_counter() - t1
+
+    def _eval_comm(self):
+        # predictions are split over all procs, unless each proc evaluates on its own (e.g. parallel multistart)
+        if getattr(self, "serial_eval", False):
+            return MPI.COMM_SELF
+        return comm
+
+    def reset_timings(self):
+        self.timings = {"compute":0., "comm":0.}
+
+    def clear_neighbor_cache(self):
+        self._ncache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
     def neighbors_func(self, X_cont, rho, cap, cmin, numsample, cases):
 
+        return self._query_neighbors(X_cont[cases[self._eval_comm().rank],:], rho, cap, cmin, numsample)
+
+    def _query_neighbors(self, X_rows, rho, cap, cmin, numsample):
+
         neighbors_all = list(range(numsample))
         ball_rad = None
         if(cap):
             ball_rad = -np.log(cap)/rho
-            neighbors_all = self.tree.query_ball_point(X_cont[cases[rank],:], ball_rad)
+            neighbors_all = self.tree.query_ball_point(X_rows, ball_rad)
             redo = []
             for i in range(len(neighbors_all)):
                 over = len(neighbors_all[i]) - cmin
@@ -381,7 +989,7 @@ class POUSurrogate(SurrogateModel):
                     redo.append(i)
 
             if len(redo) > 0:
-                dum, neighbors_redo = self.tree.query(X_cont[cases[rank],:][redo,:], cmin)
+                dum, neighbors_redo = self.tree.query(X_rows[redo,:], cmin)
 
                 for j in range(len(neighbors_redo)):
                     neighbors_all[redo[j]] = neighbors_redo[j]
@@ -426,15 +1034,25 @@ class POUHessian(POUSurrogate):
             types=int,
             desc="number of closest points to evaluate hessian estimate")
 
+        declare(
+            "packed_hessian",
+            False,
+            types=bool,
+            desc="Store the Hessian estimates in compressed upper triangular form, ntr x dim(dim+1)/2, instead of ntr x dim x dim")
+
         self.Mc = None
         self.supports["training_derivatives"] = True
         self.supports["derivatives"] = True
+        self.supports["jacobian"] = True
 
     def higher_terms(self, dx, g, h):
         # terms = np.dot(g, dx)
         # terms += 0.5*innerMatrixProduct(h, dx)
         terms = np.atleast_2d(g*dx).sum(axis = 1)
-        h2terms = 0.5*np.einsum('ij,ijk,ik->i', dx, h, dx)
+        if h.ndim == 2:
+            h2terms = 0.5*symMatQuadPacked(h, dx)
+        else:
+            h2terms = 0.5*np.einsum('ij,ijk,ik->i', dx, h, dx)
         terms += h2terms
 
         return terms
@@ -443,7 +1061,20 @@ class POUHessian(POUSurrogate):
         # terms = (g*dx).sum(axis = 1)
         dterms = np.zeros(dx.shape[0])
         dterms += g[:,kx]
-        h2terms = np.einsum('ik, ik ->i', h[:,kx,:], dx)
+        if h.ndim == 2:
+            h2terms = np.einsum('ik, ik ->i', h[:,symMatIndexMap(dx.shape[1])[kx]], dx)
+        else:
+            h2terms = np.einsum('ik, ik ->i', h[:,kx,:], dx)
+        dterms += h2terms
+        return dterms
+
+    def higher_terms_grad(self, dx, g, h):
+        dterms = np.zeros_like(dx)
+        dterms += g
+        if h.ndim == 2:
+            h2terms = symMatVecPacked(h, dx)
+        else:
+            h2terms = np.einsum('ijk,ik->ij', h, dx)
         dterms += h2terms
         return dterms
 
@@ -471,35 +1102,40 @@ class POUHessian(POUSurrogate):
     def _train_further(self):
         
         # hessian estimate
-        indn = []
-        nstencil = self.options["neval"]
-        # dists = pdist(self.xc)
-        # dists = squareform(dists)
-        # mins = np.zeros(self.ntr)
-        for i in range(self.ntr):
-            dists, ind = self.tree.query(self.X_norma[i], nstencil)
-            indn.append(ind)
-        hess = np.zeros([self.ntr, self.dim, self.dim])
-        mcs = np.zeros(self.ntr)
-        # import pdb; pdb.set_trace()
-        cases = divide_cases(self.ntr, size)
-        for i in cases[rank]:
-        # for i in range(self.ntr):
-            Hh, mc = quadraticSolveHOnly(self.X_norma[i,:], self.X_norma[indn[i][1:nstencil],:], \
-                                     self.y_norma[i], self.y_norma[indn[i][1:nstencil]], \
-                                     self.g_norma[i,:], self.g_norma[indn[i][1:nstencil],:], return_cond=True)
-
-            # hess.append(np.zeros([self.dim, self.dim]))
-            # hess[i] = np.zeros([self.dim, self.dim])
-            mcs[i] = mc
-            for j in range(self.dim):
-                for k in range(self.dim):
-                    hess[i,j,k] = Hh[symMatfromVec(j,k,self.dim)]
-        # self.h = hess
-        # self.Mc = mcs
-        self.h = comm.allreduce(hess)
-        self.Mc = comm.allreduce(mcs)
-        # self.dV = estimate_pou_volume(self.training_points[None][0][0], self.options["bounds"])
+        self.h = np.zeros([self.ntr, self.dim, self.dim])
+        self.Mc = np.zeros(self.ntr)
+        self.stencil_rad = np.zeros(self.ntr)
+        self._estimate_hessians(np.arange(self.ntr))
+
+    def _train_further_incremental(self, nnew, y_std_old):
+
+        nold = self.ntr - nnew
+        if self.h.ndim == 2:
+            self.h = symMatUnpack(self.h, self.dim)
+
+        # the Hessian solves are linear in the normalized data, so untouched
+        # stencils only see the change in output scaling
+        self.h = np.append(self.h*(y_std_old/self.y_std), np.zeros([nnew, self.dim, self.dim]), axis=0)
+        self.Mc = np.append(self.Mc, np.zeros(nnew))
+        self.stencil_rad = np.append(self.stencil_rad, np.zeros(nnew))
+
+        # old stencils change if a new point lands within their radius
+        inds = stale_stencils(self.tree, self.X_norma, self.stencil_rad, nold)
+        self._estimate_hessians(inds)
+
+    def _set_storage(self):
+        if self.options["packed_hessian"]:
+            self.h = symMatPack(self.h)
+        super()._set_storage()
+
+    def _estimate_hessians(self, inds):
+        """
+        Estimate the Hessians of training points inds from their nearest neighbor
+        stencils, and store them in self.h, along with the system condition
+        number in self.Mc and the stencil radius in self.stencil_rad
+        """
+        self.h[inds], self.Mc[inds], self.stencil_rad[inds] = estimate_stencil_hessians(
+            self.tree, self.X_norma, self.y_norma, self.g_norma, inds, self.options["neval"])
 
 
 
@@ -671,36 +1307,21 @@ class POUMetric():
         delta = self.options["delta"]
         rho = self.options["rho"]
         
-        # loop over rows in xt
+        # blocks of rows in xt, vectorized over the rows and the samples
         y = np.zeros([xt.shape[0], dim, dim])
-        for k in range(xt.shape[0]):
-            x = xt[k,:]
-            # exhaustive search for closest sample point, for regularization
-            # mindist = 1e100
-            # dists = np.zeros(numsample)
-            # for i in range(numsample):
-            #     dists[i] = np.sqrt(np.dot(x-xc[i],x-xc[i]) + delta)
+        nb = max(1, int(1e6//(numsample*dim)))
+        for k in range(0, xt.shape[0], nb):
+            work = xt[k:k+nb,None,:] - xc[None,:,:]
+            d2 = np.einsum('ijk,ijk->ij', work, work)
 
-            # mindist = min(dists)
-            
-            mindist = min(cdist(np.array([x]),xc)[0])
+            # closest sample point, for regularization
+            mindist = np.sqrt(np.min(d2, axis=1))
+            dist = np.sqrt(d2 + delta)
+            expfac = np.exp(-rho*(dist-mindist[:,None]))
 
-            # for i in range(numsample):
-            #     dist = np.sqrt(np.dot(x-xc[i],x-xc[i]) + delta)
-            #     mindist = min(mindist,dist)
-
-            numer = np.zeros([dim, dim])
-            denom = 0
-
-            # evaluate the surrogate, requiring the distance from every point
-            for i in range(numsample):
-                work = x-xc[i]
-                dist = np.sqrt(np.dot(work,work) + delta)
-                local = f[i]
-                expfac = np.exp(-rho*(dist-mindist))
-                numer += local*expfac
-                denom += expfac
-            y[k,:,:] = numer/denom
+            numer = np.einsum('ij,jkl->ikl', expfac, f)
+            denom = np.sum(expfac, axis=1)
+            y[k:k+nb,:,:] = numer/denom[:,None,None]
 
         return y
 
@@ -714,39 +1335,26 @@ class POUMetric():
         delta = self.options["delta"]
         rho = self.options["rho"]
         
-        # loop over rows in xt
+        # blocks of rows in xt, vectorized over the rows and the samples
         dydx = np.zeros([xt.shape[0], dim, dim, dim])
-        for k in range(xt.shape[0]):
-            x = xt[k,:]
-
-            # mindist = min(dists)
-            mindist = min(cdist(np.array([x]),xc)[0])
-
-            t1 = time.time()
-
-            numer = np.zeros([dim, dim])
-            dnumer = np.zeros([dim, dim, dim])
-            denom = 0
-            ddenom = np.zeros([dim])
-
-            # evaluate the surrogate, requiring the distance from every point
-            for i in range(numsample):
-                work = x-xc[i]
-                dist = np.sqrt(np.dot(work,work) + delta)
-                ddist = (1./dist)*work
-                local = f[i]
-                expfac = np.exp(-rho*(dist-mindist))
-                dexpfac = -rho*expfac*ddist
-                for j in range(dim):
-                    dnumer[j,:,:] += local*dexpfac[j]
-                ddenom += dexpfac
-                numer += local*expfac
-                denom += expfac
-            
-            t2 = np.zeros([dim, dim, dim])
-            for j in range(dim):
-                t2[j,:,:] = ddenom[j]*numer
-            dydx[k,:,:,:] = (denom*dnumer - t2)/(denom**2)
+        nb = max(1, int(1e6//(numsample*dim)))
+        for k in range(0, xt.shape[0], nb):
+            work = xt[k:k+nb,None,:] - xc[None,:,:]
+            d2 = np.einsum('ijk,ijk->ij', work, work)
+
+            mindist = np.sqrt(np.min(d2, axis=1))
+            dist = np.sqrt(d2 + delta)
+            ddist = work/dist[:,:,None]
+            expfac = np.exp(-rho*(dist-mindist[:,None]))
+            dexpfac = -rho*expfac[:,:,None]*ddist
+
+            numer = np.einsum('ij,jkl->ikl', expfac, f)
+            dnumer = np.einsum('ijm,jkl->imkl', dexpfac, f)
+            denom = np.sum(expfac, axis=1)
+            ddenom = np.sum(dexpfac, axis=1)
+
+            t2 = np.einsum('im,ikl->imkl', ddenom, numer)
+            dydx[k:k+nb,:,:,:] = (denom[:,None,None,None]*dnumer - t2)/(denom[:,None,None,None]**2)
         return dydx
 
     def set_training_values(self, xt: np.ndarray, yt: np.ndarray, name=None) -> None:
@@ -884,7 +1492,7 @@ class POUError():
     def predict_values(self, xt, model):
 
         xc = self.training_points[None][0][0]
-        f = self.training_points[None][0][1]
+        f = self.training_points[None][0][1].reshape(-1)
         g = np.zeros([xc.shape[0],xc.shape[1]])
         for i in range(xc.shape[1]):
             g[:,i] = self.training_points[None][i+1][1]
@@ -893,30 +1501,25 @@ class POUError():
         delta = self.options["delta"]
         rho = self.options["rho"]
         bounds = self.options["xscale"]
-        
-        # loop over rows in xt
-        y = np.zeros([xt.shape[0]])
-        for k in range(xt.shape[0]):
-            x = xt[k,:]
-            xscale = qmc.scale(np.array([x]), bounds[:,0], bounds[:,1])
-            
+        vol = np.ones(numsample)*self.volume_weight(np.arange(numsample))
 
-            # exhaustive search for closest sample point, for regularization
-            mindist = min(cdist(np.array([x]),xc)[0])
+        xt = np.atleast_2d(xt)
+        xm = model.predict_values(qmc.scale(xt, bounds[:,0], bounds[:,1]))[:,0]
 
-            numer = 0
-            denom = 0
-            xm = model.predict_values(xscale)
+        # blocks of rows in xt, vectorized over the rows and the samples
+        y = np.zeros([xt.shape[0]])
+        nb = max(1, int(1e6//(numsample*dim)))
+        for k in range(0, xt.shape[0], nb):
+            work = xt[k:k+nb,None,:] - xc[None,:,:]
+            d2 = np.einsum('ijk,ijk->ij', work, work)
 
-            # evaluate the surrogate, requiring the distance from every point
-            for i in range(numsample):
-                work = x-xc[i]
-                dist = np.sqrt(np.dot(work,work) + delta)
-                local = abs(f[i] + np.dot(g[i], work) - xm)*self.volume_weight(i)
-                expfac = np.exp(-rho*(dist-mindist))
-                numer += local*expfac
-                denom += expfac
-            y[k] = numer/denom
+            # closest sample point, for regularization
+            mindist = np.sqrt(np.min(d2, axis=1))
+            dist = np.sqrt(d2 + delta)
+            local = abs(f[None,:] + np.einsum('ijk,jk->ij', work, g) - xm[k:k+nb,None])*vol
+            expfac = np.exp(-rho*(dist-mindist[:,None]))
+
+            y[k:k+nb] = np.sum(local*expfac, axis=1)/np.sum(expfac, axis=1)
 
         return y
 
@@ -924,7 +1527,7 @@ class POUError():
     def predict_derivatives(self, xt, model):
 
         xc = self.training_points[None][0][0]
-        f = self.training_points[None][0][1]
+        f = self.training_points[None][0][1].reshape(-1)
         g = np.zeros([xc.shape[0],xc.shape[1]])
         for i in range(xc.shape[1]):
             g[:,i] = self.training_points[None][i+1][1]
@@ -933,43 +1536,39 @@ class POUError():
         delta = self.options["delta"]
         rho = self.options["rho"]
         bounds = self.options["xscale"]
-
-        # loop over rows in xt
+        vol = np.ones(numsample)*self.volume_weight(np.arange(numsample))
+
+        xt = np.atleast_2d(xt)
+        xscale = qmc.scale(xt, bounds[:,0], bounds[:,1])
+        dxscale = bounds[:,1] - bounds[:,0]
+        gm = np.zeros([xt.shape[0], dim])
+        for j in range(dim):
+            gm[:,j] = model.predict_derivatives(xscale, j)[:,0]
+        gm = np.multiply(gm, dxscale)
+        xm = model.predict_values(xscale)[:,0]
+
+        # blocks of rows in xt, vectorized over the rows and the samples
         dydx = np.zeros([xt.shape[0], dim])
-        for k in range(xt.shape[0]):
-            x = xt[k,:]
-            xscale = qmc.scale(np.array([x]), bounds[:,0], bounds[:,1])
-            dxscale = bounds[:,1] - bounds[:,0]
-
-            mindist = min(cdist(np.array([x]),xc)[0])
-
-            numer = 0
-            dnumer = np.zeros([dim])
-            denom = 0
-            ddenom = np.zeros([dim])
-            gm = np.zeros([dim])
-            for j in range(dim):
-                gm[j] = model.predict_derivatives(xscale, j)
-            gm = np.multiply(gm, dxscale)
-            plocal2 = -model.predict_values(xscale)
-            # evaluate the surrogate, requiring the distance from every point
-            for i in range(numsample):
-                work = x-xc[i]
-                dist = np.sqrt(np.dot(work,work) + delta)
-                ddist = (1./dist)*work
-                plocal1 = f[i] + np.dot(g[i], work) 
-                local = abs(plocal1 + plocal2)*self.volume_weight(i)
-                dlocal = (g[i] - gm)*np.sign(plocal1 + plocal2)*self.volume_weight(i)
-                expfac = np.exp(-rho*(dist-mindist))
-                dexpfac = -rho*expfac*ddist
-                dnumer += (local*dexpfac + dlocal*expfac)[0]
-                ddenom += dexpfac
-                numer += local*expfac
-                denom += expfac
-            
-
-            t2 = ddenom*numer
-            dydx[k,:] = (denom*dnumer - t2)/(denom**2)
+        nb = max(1, int(1e6//(numsample*dim)))
+        for k in range(0, xt.shape[0], nb):
+            work = xt[k:k+nb,None,:] - xc[None,:,:]
+            d2 = np.einsum('ijk,ijk->ij', work, work)
+
+            mindist = np.sqrt(np.min(d2, axis=1))
+            dist = np.sqrt(d2 + delta)
+            ddist = work/dist[:,:,None]
+            plocal = f[None,:] + np.einsum('ijk,jk->ij', work, g) - xm[k:k+nb,None]
+            local = abs(plocal)*vol
+            dlocal = (g[None,:,:] - gm[k:k+nb,None,:])*(np.sign(plocal)*vol)[:,:,None]
+            expfac = np.exp(-rho*(dist-mindist[:,None]))
+            dexpfac = -rho*expfac[:,:,None]*ddist
+
+            numer = np.sum(local*expfac, axis=1)
+            dnumer = np.einsum('ij,ijk->ik', local, dexpfac) + np.einsum('ij,ijk->ik', expfac, dlocal)
+            denom = np.sum(expfac, axis=1)
+            ddenom = np.sum(dexpfac, axis=1)
+
+            dydx[k:k+nb,:] = (denom[:,None]*dnumer - numer[:,None]*ddenom)/(denom[:,None]**2)
         return dydx
 
     def set_training_values(self, xt: np.ndarray, yt: np.ndarray, name=None) -> None:
@@ -1093,6 +1692,24 @@ class POUCV(SurrogateModel):
     """
     def _predict_values(self, xt):
 
+        y, dy = self._cv_terms(xt)
+
+        return y
+
+    def _predict_derivatives(self, xt, kx):
+
+        y, dy = self._cv_terms(xt, grad=True)
+
+        return dy[:,kx:kx+1]
+
+    def _predict_jacobian(self, xt):
+
+        y, dy = self._cv_terms(xt, grad=True)
+
+        return y, dy
+
+    def _cv_terms(self, xt, grad=False):
+
         pmodel = self.options["pmodel"]
 
         xc = pmodel.X_norma
@@ -1107,43 +1724,44 @@ class POUCV(SurrogateModel):
 
         # loop over rows in xt
         y_ = np.zeros(xt.shape[0])
+        dy_ = np.zeros(xt.shape)
         for k in range(xt.shape[0]):
             x = xt[k,:]
 
             # exhaustive search for closest sample point, for regularization
-            D = cdist(np.array([x]),xc)
-            mindist = min(D[0])
-
-            numer = 0
-            denom = 0
+            D = cdist(np.array([x]),xc)[0]
+            mindist = min(D)
 
             # evaluate the surrogate, requiring the distance from every point
-            # for i in range(numsample):
             work = x - xc
-            dist = D[0][:] + delta#np.sqrt(D[0][i] + delta)
+            dist = D + delta#np.sqrt(D[0][i] + delta)
             expfac = np.exp(-rho*(dist-mindist))
-            local = np.zeros(numsample)
-            for i in range(numsample):
-                local[i] = f[i] + pmodel.higher_terms(work[i], g[i], h[i])
+            local = f[:,0] + pmodel.higher_terms(work, g, h)
             numer = np.dot(local, expfac)
             denom = np.sum(expfac)
-            # t2 = time.time()
-
-            # exec1 += t1-t0
-            # exec2 += t2-t1
-            
 
+            # each sample's LOO prediction drops its term from both sums
             y_base = numer/denom
-            y_[k] = 0
-            for i in range(numsample):
-                y_i = (numer - local[i]*expfac[i])/(denom - expfac[i])
-                y_[k] += (y_base - y_i)**2
-            y_[k] = np.sqrt(y_[k]/numsample)
+            y_i = (numer - local*expfac)/(denom - expfac)
+            err = y_base - y_i
+            y_[k] = np.sqrt(np.sum(err**2)/numsample)
+
+            if grad:
+                ddist = np.divide(work, D[:,None], out=np.zeros_like(work), where=D[:,None] > 0.)
+                dexpfac = -rho*expfac[:,None]*ddist
+                dlocal = pmodel.higher_terms_grad(work, g, h)
+                dnumer = np.dot(local, dexpfac) + np.dot(expfac, dlocal)
+                ddenom = np.sum(dexpfac, axis=0)
+                dy_base = (dnumer*denom - numer*ddenom)/(denom**2)
+                dnr = dnumer[None,:] - (local[:,None]*dexpfac + expfac[:,None]*dlocal)
+                ddr = ddenom[None,:] - dexpfac
+                dr = denom - expfac
+                dy_i = dnr/dr[:,None] - ((numer - local*expfac)/dr**2)[:,None]*ddr
+                if y_[k] > 0.:
+                    dy_[k,:] = np.dot(err, dy_base[None,:] - dy_i)/(numsample*y_[k])
 
         y = y_.ravel()
-        # print("mindist  = ", exec1)
-        # print("evaluate = ", exec2)
 
-        return y
+        return y, dy_
 
 
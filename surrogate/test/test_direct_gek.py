@@ -0,0 +1,164 @@
+import unittest
+import inspect
+import numpy as np
+from scipy import linalg
+
+from surrogate.direct_gek import DGEK
+from smt.problems import Rosenbrock
+from smt.sampling_methods import LHS
+
+# the augmented correlation matrix needs the kernel hessian, only available
+# in the forked SMT kernels
+_squar_exp = DGEK._correlation_types["squar_exp"]
+_has_hess = "hess_params" in inspect.signature(_squar_exp).parameters
+
+
+def _squar_exp_hess(theta, d, grad_ind=None, hess_ind=None, derivative_params=None, hess_params=None):
+    """
+    Stock SMT squar_exp, with the hessian wrt x of the forked kernels
+    """
+    if hess_params is None:
+        return _squar_exp(theta, d, grad_ind, hess_ind, derivative_params)
+    r = _squar_exp(theta, d)[:,0]
+    dd = hess_params["dd"]
+    return r[:,None,None]*(dd[:,:,None]*dd[:,None,:] - np.diag(2.*theta)[None,:,:])
+
+
+def _dgek(dim=2, nt=10, train=True, **kwargs):
+    trueFunc = Rosenbrock(ndim=dim)
+    xlimits = trueFunc.xlimits
+    xt = LHS(xlimits=xlimits, criterion='m', random_state=0)(nt)
+
+    model = DGEK(xlimits=xlimits, print_global=False, **kwargs)
+    model.set_training_values(xt, trueFunc(xt))
+    for j in range(dim):
+        model.set_training_derivatives(xt, trueFunc(xt, j), j)
+    if train:
+        model.train()
+
+    xv = LHS(xlimits=xlimits, random_state=1)(5)
+    return model, trueFunc, xv
+
+
+def _block_inverse_likelihood(model, theta):
+    """
+    Reference likelihood, assembling R sample by sample and inverting it in
+    blocks (Lockwood and Anitescu 2012), without a nugget
+    """
+    nt = model.nt
+    nx = model.nx
+    X = model.X_norma
+    full_size = nt + nt*nx
+
+    R = np.zeros([full_size, full_size])
+    for i in range(nt):
+        for j in range(nt):
+            dx = X[i] - X[j]
+            r = np.exp(-np.dot(theta, dx**2))
+            dr = -2.*theta*dx*r
+            d2r = r*(4.*np.outer(theta*dx, theta*dx) - 2.*np.diag(theta))
+            gi = slice(nt + i*nx, nt + (i+1)*nx)
+            gj = slice(nt + j*nx, nt + (j+1)*nx)
+            R[i, j] = r
+            R[i, gj] = -dr
+            R[gi, j] = dr
+            R[gi, gj] = -d2r
+
+    P = R[:nt, :nt]
+    Pg = R[nt:, :nt]
+    S = R[nt:, nt:]
+    Pinv = linalg.inv(P)
+    PgPinv = np.dot(Pg, Pinv)
+    M = S - np.dot(PgPinv, Pg.T)
+    Minv = linalg.inv(M)
+    Rinv = np.block([[Pinv + np.dot(np.dot(PgPinv.T, Minv), PgPinv), -np.dot(PgPinv.T, Minv)],
+                     [-np.dot(Minv, PgPinv), Minv]])
+
+    Ya = model.y_norma[:, 0]
+    for i in range(nt):
+        for j in range(nx):
+            Ya = np.append(Ya, model.training_points[None][j+1][1][i]*(model.X_scale[j]/model.y_std))
+    Fa = np.append(model.F, np.zeros([nt*nx, model.F.shape[1]]), axis=0)
+
+    beta = linalg.lstsq(Fa, Ya)[0]
+    rho = Ya - np.dot(Fa, beta)
+    sigma2 = np.dot(np.dot(rho, Rinv), rho)/nt
+    rlf = -nt*np.log10(sigma2) - np.log10(linalg.det(P)*linalg.det(M))
+
+    return rlf, np.dot(Rinv, rho), R
+
+
+class DGEKTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls._corr = DGEK._correlation_types
+        if not _has_hess:
+            DGEK._correlation_types = dict(cls._corr, squar_exp=_squar_exp_hess)
+
+    @classmethod
+    def tearDownClass(cls):
+        DGEK._correlation_types = cls._corr
+
+    def test_likelihood_matches_block_inverse(self):
+        model, trueFunc, xv = _dgek()
+        theta = np.array([2., 1.])
+        rlf, par = model._reduced_likelihood_function(theta)
+        rlf_ref, gamma_ref, R = _block_inverse_likelihood(model, theta)
+
+        self.assertTrue(np.linalg.cond(R) < 1.e8)
+        self.assertTrue(abs(rlf - rlf_ref) < 1.e-8*abs(rlf_ref))
+        self.assertTrue(np.max(np.abs(par["gamma"] - gamma_ref)) < 1.e-8*np.max(np.abs(gamma_ref)))
+
+    def test_loo_matches_retraining(self):
+        model, trueFunc, xv = _dgek(dim=2, nt=8)
+        yloo_t = model.predict_loo_values()
+        yloo = model.predict_loo_values(xv)
+
+        # refit with the same theta and beta, without the value and gradient of sample i
+        nt = model.nt
+        nx = model.nx
+        C = model.optimal_par["C"]
+        R = np.dot(C, C.T)
+        aug = model._augmented_system()
+        rho = aug["Ya"] - np.dot(aug["Fa"], model.optimal_par["beta"])
+        f = np.dot(model.F, model.optimal_par["beta"])
+        Xv = (xv - model.X_offset)/model.X_scale
+        fv = np.dot(model._regression_types[model.options["poly"]](Xv), model.optimal_par["beta"])
+        rv = model._augmented_corr(Xv)
+        for i in [0, 5]:
+            k = np.setdiff1d(np.arange(nt + nt*nx), np.append(i, aug["gind"][i]))
+            w = np.linalg.solve(R[np.ix_(k, k)], rho[k])
+            yi = model.y_mean + model.y_std*(f[i] + np.dot(R[i, k], w))
+            yv = model.y_mean + model.y_std*(fv + np.dot(rv[:, k], w))
+            self.assertTrue(abs(yloo_t[i] - yi[0]) < 1.e-6*np.max(np.abs(yloo_t)))
+            self.assertTrue(np.max(np.abs(yloo[:, i] - yv)) < 1.e-6*np.max(np.abs(yv)))
+
+    def test_likelihood_gradient(self):
+        model, trueFunc, xv = _dgek(dim=3, nt=10)
+        for theta in [np.array([0.5, 1., 2.]), np.array([3., 0.3, 1.])]:
+            grad, par = model._reduced_likelihood_gradient(theta)
+            h = 1.e-6
+            for l in range(3):
+                step = np.zeros(3)
+                step[l] = h*theta[l]
+                fd = (model._reduced_likelihood_function(theta + step)[0]
+                      - model._reduced_likelihood_function(theta - step)[0])/(2*step[l])
+                self.assertTrue(abs(grad[l, 0] - fd) < 1.e-5*np.max(np.abs(grad)))
+
+    def test_optimizer_matches_cobyla(self):
+        rlf = {}
+        for hyper_opt in ["Cobyla", "L-BFGS-B", None]:
+            kwargs = {"theta0":[0.1]}
+            if hyper_opt is not None:
+                kwargs["hyper_opt"] = hyper_opt
+            model, trueFunc, xv = _dgek(dim=3, nt=25, **kwargs)
+            rlf[hyper_opt] = model._reduced_likelihood_function(model.optimal_theta)[0]
+
+        # the default, and the gradient-based optimizer
+        self.assertTrue(rlf[None] >= rlf["Cobyla"] - 1.e-6*abs(rlf["Cobyla"]))
+        self.assertTrue(rlf["L-BFGS-B"] >= rlf["Cobyla"] - 1.e-6*abs(rlf["Cobyla"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
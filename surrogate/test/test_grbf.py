@@ -0,0 +1,52 @@
+import unittest
+import os
+import sys
+import numpy as np
+
+# grbf imports sutils as a top level module
+_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(1, os.path.join(_root, "utils"))
+
+from surrogate.grbf import GRBF
+from smt.problems import Rosenbrock
+from smt.sampling_methods import LHS
+
+
+class GRBFTest(unittest.TestCase):
+
+    def test_wendland(self):
+        dim = 2
+        trueFunc = Rosenbrock(ndim=dim)
+        xlimits = trueFunc.xlimits
+        xt = LHS(xlimits=xlimits, criterion='m', random_state=0)(30)
+        ft = trueFunc(xt)
+
+        model = GRBF(corr="wendland", t0=1.0, print_global=False)
+        model.set_training_values(xt, ft)
+        for j in range(dim):
+            model.set_training_derivatives(xt, trueFunc(xt, j), j)
+        model.train()
+
+        # compact support, fewer nonzeros than the dense system
+        full_size = xt.shape[0]*(dim + 1)
+        self.assertTrue(model.par["nnz"] < full_size**2)
+
+        # interpolates values and gradients
+        yt = model.predict_values(xt)
+        self.assertTrue(np.max(np.abs(yt - ft)) < 1.e-8*np.max(np.abs(ft)))
+        for k in range(dim):
+            gt = trueFunc(xt, k)
+            self.assertTrue(np.max(np.abs(model.predict_derivatives(xt, k) - gt)) < 1.e-8*np.max(np.abs(gt)))
+
+        xv = LHS(xlimits=xlimits, random_state=1)(20)
+        h = 1.e-6
+        for k in range(dim):
+            step = np.zeros(dim)
+            step[k] = h
+            fd = (model.predict_values(xv + step) - model.predict_values(xv - step))/(2*h)
+            dy = model.predict_derivatives(xv, k)
+            self.assertTrue(np.max(np.abs(dy - fd)) < 1.e-6*np.max(np.abs(fd)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+import os
+import sys
+import numpy as np
+
+# lsrbf imports sutils and optimizers as top level modules
+_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(1, os.path.join(_root, "utils"))
+sys.path.insert(1, os.path.join(_root, "optimization"))
+
+from surrogate.lsrbf import LSRBF
+from smt.problems import Rosenbrock
+from smt.sampling_methods import LHS
+from smt.utils.kriging_utils import cross_distances
+
+
+def _train_lsrbf(dim=2, nt=30, nc=10, **kwargs):
+    trueFunc = Rosenbrock(ndim=dim)
+    xlimits = trueFunc.xlimits
+    xt = LHS(xlimits=xlimits, criterion='m', random_state=0)(nt)
+    xc = LHS(xlimits=xlimits, criterion='m', random_state=2)(nc)
+
+    model = LSRBF(basis_centers=xc, print_global=False, **kwargs)
+    model.set_training_values(xt, trueFunc(xt))
+    for j in range(dim):
+        model.set_training_derivatives(xt, trueFunc(xt, j), j)
+    model.train()
+
+    return model
+
+
+class LSRBFTest(unittest.TestCase):
+
+    def test_loo_gradient(self):
+        for use_derivatives in [False, True]:
+            model = _train_lsrbf(use_derivatives=use_derivatives)
+            D = cross_distances(model.X_norma, model.Xc_norma)[0]
+            dim = D.shape[1]
+
+            for theta in [np.array([0.5, 1.]), np.array([2., 0.2])]:
+                grad = model.looGrad(theta, D)
+                h = 1.e-6
+                for l in range(dim):
+                    step = np.zeros(dim)
+                    step[l] = h*theta[l]
+                    fd = (model.looEstimate(theta + step, D, opt=True)
+                          - model.looEstimate(theta - step, D, opt=True))/(2*step[l])
+                    self.assertTrue(abs(grad[l] - fd) < 1.e-5*np.max(np.abs(grad)))
+
+    def test_compute_theta(self):
+        model = _train_lsrbf(compute_theta=True, use_derivatives=True)
+        D = cross_distances(model.X_norma, model.Xc_norma)[0]
+
+        # the factorization is not kept on the trained model
+        self.assertTrue(model._fac is None)
+        sol = model.looEstimate(model.theta, D)
+        self.assertTrue(np.max(np.abs(sol[0][:-1] - model.par["gamma"])) < 1.e-10*np.max(np.abs(sol[0])))
+
+    def test_wendland_derivatives(self):
+        for use_derivatives in [False, True]:
+            model = _train_lsrbf(corr="wendland", t0=1.0, use_derivatives=use_derivatives)
+            xlimits = Rosenbrock(ndim=2).xlimits
+            xv = LHS(xlimits=xlimits, random_state=1)(20)
+
+            h = 1.e-6
+            for k in range(2):
+                step = np.zeros(2)
+                step[k] = h
+                fd = (model.predict_values(xv + step) - model.predict_values(xv - step))/(2*h)
+                dy = model.predict_derivatives(xv, k)
+                self.assertTrue(np.max(np.abs(dy - fd)) < 1.e-6*np.max(np.abs(fd)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+import numpy as np
+
+from surrogate.pce_strict import PCEStrictSurrogate
+from optimization.robust_objective import CollocationSampler
+from smt.problems import Rosenbrock
+
+
+def _train_pce(N):
+    dim = len(N)
+    trueFunc = Rosenbrock(ndim=dim)
+    xlimits = trueFunc.xlimits
+    sampler = CollocationSampler(np.array([0.]), N=N, xlimits=xlimits,
+                                 probability_functions=[['uniform']]*dim,
+                                 retain_uncertain_points=True)
+    xt = sampler.current_samples['x']
+    sampler.set_evaluated_func(trueFunc(xt))
+
+    model = PCEStrictSurrogate(bounds=xlimits, sampler=sampler, print_global=False)
+    model.sampler = sampler
+    model.set_training_values(xt, sampler.current_samples['f'])
+    model.train()
+
+    xv = np.random.default_rng(0).random([50, dim])*(xlimits[:,1] - xlimits[:,0]) + xlimits[:,0]
+    return model, trueFunc, xv
+
+
+class PCEStrictTest(unittest.TestCase):
+
+    def test_tensor_matches_dense(self):
+        model, trueFunc, xv = _train_pce([4, 3, 5])
+        xt = model.sampler.current_samples['x']
+        ft = model.sampler.current_samples['f']
+
+        yt = model.predict_values(xv)
+        ytt = model.predict_values(xt)
+        model.options.update({"eval_mode":"dense"})
+        yd = model.predict_values(xv)
+
+        self.assertTrue(np.max(np.abs(yt - yd)) < 1.e-10*np.max(np.abs(yd)))
+        self.assertTrue(np.max(np.abs(ytt - ft)) < 1.e-10*np.max(np.abs(ft)))
+
+        # small enough to force several chunks
+        model.options.update({"eval_mode":"tensor", "max_chunk_bytes":1000})
+        self.assertTrue(np.max(np.abs(model.predict_values(xv) - yt)) < 1.e-10*np.max(np.abs(yt)))
+
+    def test_tensor_exact_polynomial(self):
+        # Rosenbrock is quartic, reproduced by 5 points per direction
+        model, trueFunc, xv = _train_pce([5, 5, 5, 5])
+        y = model.predict_values(xv)
+        self.assertTrue(np.max(np.abs(y - trueFunc(xv))) < 1.e-10*np.max(np.abs(y)))
+
+
+if __name__ == '__main__':
+    unittest.main()
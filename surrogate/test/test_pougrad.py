@@ -0,0 +1,207 @@
+import unittest
+import numpy as np
+
+from surrogate.pougrad import POUHessian, POUError, POUCV
+from smt.problems import Rosenbrock
+from smt.sampling_methods import LHS
+
+
+def _train_pou(dim=3, nt=40, **kwargs):
+    trueFunc = Rosenbrock(ndim=dim)
+    xlimits = trueFunc.xlimits
+    sampling = LHS(xlimits=xlimits, criterion='m', random_state=0)
+    xt = sampling(nt)
+    ft = trueFunc(xt)
+
+    model = POUHessian(bounds=xlimits, rscale=5.5, neval=2*dim, print_global=False, **kwargs)
+    model.set_training_values(xt, ft)
+    for j in range(dim):
+        model.set_training_derivatives(xt, trueFunc(xt, j), j)
+    model.train()
+
+    xv = LHS(xlimits=xlimits, random_state=1)(100)
+    return model, xv
+
+
+class POUEvalTest(unittest.TestCase):
+
+    def test_batch_matches_loop(self):
+        for kwargs in [{}, {"min_contribution":1e-10}]:
+            model, xv = _train_pou(**kwargs)
+            yl = model.predict_values(xv)
+
+            model.options.update({"eval_mode":"batch", "batch_size":7})
+            yb = model.predict_values(xv)
+
+            self.assertTrue(np.max(np.abs(yl - yb)) < 1.e-10*np.max(np.abs(yl)))
+
+    def test_compiled_matches_loop(self):
+        # falls back to batch if numba is not available
+        for kwargs in [{}, {"min_contribution":1e-10}]:
+            model, xv = _train_pou(**kwargs)
+            yl = model.predict_values(xv)
+            jl = model.predict_jacobian(xv)
+
+            model.options.update({"eval_mode":"compiled"})
+            yc = model.predict_values(xv)
+            jc = model.predict_jacobian(xv)
+            dc = model.predict_derivatives(xv, 2)
+
+            self.assertTrue(np.max(np.abs(yl - yc)) < 1.e-10*np.max(np.abs(yl)))
+            self.assertTrue(np.max(np.abs(jl - jc)) < 1.e-10*np.max(np.abs(jl)))
+            self.assertTrue(np.max(np.abs(jl[:,2] - dc[:,0])) < 1.e-10*np.max(np.abs(jl)))
+
+    def test_chunked_matches_full(self):
+        model, xv = _train_pou(min_contribution=1e-10)
+        yf = model.predict_values(xv)
+        df = model.predict_derivatives(xv, 1)
+
+        # small enough to force several chunks
+        for eval_mode in ["loop", "batch", "compiled"]:
+            model.options.update({"max_chunk_bytes":5000, "eval_mode":eval_mode})
+            yc = model.predict_values(xv)
+            dc = model.predict_derivatives(xv, 1)
+
+            self.assertTrue(np.max(np.abs(yf - yc)) < 1.e-10*np.max(np.abs(yf)))
+            self.assertTrue(np.max(np.abs(df - dc)) < 1.e-10*np.max(np.abs(df)))
+
+    def test_jacobian_matches_derivatives(self):
+        model, xv = _train_pou(min_contribution=1e-10)
+        dim = xv.shape[1]
+        jac, y = model.predict_jacobian(xv, return_values=True)
+
+        yr = model.predict_values(xv)
+        jacr = np.zeros_like(jac)
+        for k in range(dim):
+            jacr[:,k] = model.predict_derivatives(xv, k)[:,0]
+
+        self.assertTrue(np.max(np.abs(y - yr)) < 1.e-10*np.max(np.abs(yr)))
+        self.assertTrue(np.max(np.abs(jac - jacr)) < 1.e-10*np.max(np.abs(jacr)))
+
+    def test_neighbor_cache(self):
+        model, xv = _train_pou(min_contribution=1e-10, neighbor_cache_size=2)
+        y0 = model.predict_values(xv)
+        d0 = model.predict_derivatives(xv, 0)
+        y1 = model.predict_values(xv)
+
+        self.assertEqual(model.cache_misses, 1)
+        self.assertEqual(model.cache_hits, 2)
+        self.assertTrue(np.all(y0 == y1))
+
+        # different points miss, retraining clears
+        model.predict_values(xv[:10])
+        self.assertEqual(model.cache_misses, 2)
+        model.train()
+        self.assertEqual(model.cache_hits + model.cache_misses, 0)
+        self.assertTrue(np.all(model.predict_derivatives(xv, 0) == d0))
+
+    def test_float32_close_to_float64(self):
+        model, xv = _train_pou(min_contribution=1e-10)
+        model32, xv = _train_pou(min_contribution=1e-10, dtype="float32")
+        self.assertEqual(model32.h.dtype, np.float32)
+
+        y = model.predict_values(xv)
+        jac = model.predict_jacobian(xv)
+        self.assertTrue(np.max(np.abs(y - model32.predict_values(xv))) < 1.e-5*np.max(np.abs(y)))
+        self.assertTrue(np.max(np.abs(jac - model32.predict_jacobian(xv))) < 1.e-5*np.max(np.abs(jac)))
+
+    def test_packed_matches_dense(self):
+        model, xv = _train_pou(min_contribution=1e-10)
+        modelp, xv = _train_pou(min_contribution=1e-10, packed_hessian=True)
+        self.assertEqual(modelp.h.shape, (40, 6))
+
+        for eval_mode in ["loop", "batch", "compiled"]:
+            model.options.update({"eval_mode":eval_mode})
+            modelp.options.update({"eval_mode":eval_mode})
+            y = model.predict_values(xv)
+            jac = model.predict_jacobian(xv)
+            self.assertTrue(np.max(np.abs(y - modelp.predict_values(xv))) < 1.e-10*np.max(np.abs(y)))
+            self.assertTrue(np.max(np.abs(jac - modelp.predict_jacobian(xv))) < 1.e-10*np.max(np.abs(jac)))
+            self.assertTrue(np.max(np.abs(jac[:,[0]] - modelp.predict_derivatives(xv, 0))) < 1.e-10*np.max(np.abs(jac)))
+
+    def test_add_points_matches_train(self):
+        model, xv = _train_pou(nt=43)
+        xt = model.training_points[None][0][0]
+        yt = model.training_points[None][0][1]
+        gt = np.hstack([model.training_points[None][j+1][1] for j in range(3)])
+
+        model_i, xv = _train_pou(nt=43)
+        model_i.set_training_values(xt[:40], yt[:40])
+        for j in range(3):
+            model_i.set_training_derivatives(xt[:40], gt[:40,[j]], j)
+        model_i.train()
+        model_i.add_points(xt[40:], yt[40:], gt[40:])
+
+        self.assertTrue(np.max(np.abs(model.h - model_i.h)) < 1.e-10*np.max(np.abs(model.h)))
+        y = model.predict_values(xv)
+        self.assertTrue(np.max(np.abs(y - model_i.predict_values(xv))) < 1.e-10*np.max(np.abs(y)))
+
+    def test_loo_matches_direct(self):
+        model, xv = _train_pou(min_contribution=0.)
+        yloo = model.predict_loo_values(xv)
+        yloo_t = model.predict_loo_values()
+
+        xc = model.X_norma
+        X = (xv - model.X_offset)/model.X_scale
+        rho = model.options["rscale"]*pow(xc.shape[0], 1./xc.shape[1])
+        for q in [0, 50]:
+            work = X[q] - xc
+            dist = np.sqrt(np.sum(work**2, axis=1) + model.options["delta"])
+            local = model.y_norma[:,0] + model.higher_terms(work, model.g_norma, model.h)
+            expfac = np.exp(-rho*(dist - np.min(dist)))
+            for i in [np.argmin(dist), 7]:
+                w = expfac.copy()
+                w[i] = 0.
+                yref = model.y_mean + model.y_std*np.dot(w, local)/np.sum(w)
+                self.assertTrue(abs(yloo[q,i] - yref) < 1.e-10*np.max(np.abs(yloo)))
+
+        # at the training points, the left out sample is always the closest
+        xt = model.training_points[None][0][0]
+        self.assertTrue(np.max(np.abs(np.diag(model.predict_loo_values(xt)) - yloo_t)) < 1.e-10*np.max(np.abs(yloo_t)))
+
+    def test_loo_derivatives(self):
+        model, xv = _train_pou(min_contribution=0.)
+        xv = xv[:5]
+        dim = xv.shape[1]
+        dloo = model.predict_loo_derivatives(xv)
+
+        cvmodel = POUCV(pmodel=model)
+        ycv, dcv = cvmodel._predict_jacobian(xv)
+
+        h = 1.e-6
+        for j in range(dim):
+            step = np.zeros(dim)
+            step[j] = h*(model.options["bounds"][j,1] - model.options["bounds"][j,0])
+            fd = (model.predict_loo_values(xv + step) - model.predict_loo_values(xv - step))/(2*step[j])
+            self.assertTrue(np.max(np.abs(dloo[:,:,j] - fd)) < 1.e-5*np.max(np.abs(dloo)))
+
+            fd = (cvmodel._predict_values(xv + step) - cvmodel._predict_values(xv - step))/(2*step[j])
+            self.assertTrue(np.max(np.abs(dcv[:,j] - fd)) < 1.e-5*np.max(np.abs(dcv)))
+
+    def test_error_model_batch(self):
+        model, xv = _train_pou(dim=2, nt=20)
+        bounds = model.options["bounds"]
+        xt = model.training_points[None][0][0]
+        xs = (xt - bounds[:,0])/(bounds[:,1] - bounds[:,0])
+        xq = (xv - bounds[:,0])/(bounds[:,1] - bounds[:,0])
+
+        emodel = POUError(rho=10., xscale=bounds)
+        emodel.set_training_values(xs, 1.1*model.training_points[None][0][1])
+        for j in range(2):
+            emodel.set_training_derivatives(xs, model.training_points[None][j+1][1][:,0], j)
+
+        y = emodel.predict_values(xq, model)
+        dy = emodel.predict_derivatives(xq, model)
+        for q in [0, 50]:
+            self.assertTrue(abs(emodel.predict_values(xq[q:q+1], model)[0] - y[q]) < 1.e-10*np.max(np.abs(y)))
+
+        h = 1.e-6
+        for j in range(2):
+            step = np.zeros(2)
+            step[j] = h
+            fd = (emodel.predict_values(xq + step, model) - emodel.predict_values(xq - step, model))/(2*h)
+            self.assertTrue(np.max(np.abs(dy[:,j] - fd)) < 1.e-5*np.max(np.abs(dy)))
+
+
+if __name__ == '__main__':
+    unittest.main()
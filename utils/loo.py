@@ -0,0 +1,219 @@
+import numpy as np
+import copy
+from scipy.linalg import solve_triangular
+from smt.surrogate_models.krg_based import KrgBased
+from smt.utils.kriging_utils import differences
+from utils.sutils import convert_to_smt_grads
+
+
+class LOOPredictor():
+    """
+    Leave-one-out predictions of a trained surrogate, without refitting it for
+    every left out sample where possible
+
+    In order of preference:
+        - models that implement predict_loo_values(xt=None) (POU models, DGEK)
+        - closed form LOO from the factored correlation matrix for SMT kriging
+          models, with the regression reestimated but theta fixed (Dubrule 1983)
+        - copying and retraining the model once per sample
+
+    Parameters
+    ----------
+    model : smt.surrogate_models.SurrogateModel
+        Trained model
+    retrain : bool
+        If False, retraining models are given their reduced data but not
+        retrained, as in the old looCV "approx" option
+    """
+    def __init__(self, model, retrain=True):
+
+        self.model = model
+        self.retrain = retrain
+
+        self.xtr = model.training_points[None][0][0]
+        self.ytr = model.training_points[None][0][1]
+        self.ntr = self.xtr.shape[0]
+
+        self.loosm = None
+        self.mode = "retrain"
+        if hasattr(model, "predict_loo_values"):
+            self.mode = "model"
+        elif self._krg_supported():
+            self.mode = "kriging"
+            self._krg_factor()
+
+    def values(self):
+        """
+        Prediction of the i-th leave-one-out model at the i-th training point
+
+        Returns
+        -------
+        y : np.ndarray[ntr]
+        """
+        if self.mode == "model":
+            return self.model.predict_loo_values()
+
+        if self.mode == "kriging":
+            # r(x_i) is row i of R without the nugget, so [r f] K^-1 e_i = 1 - nugget*Qn_ii
+            y = self.model.predict_values(self.xtr)[:,0]
+            return y - self.model.y_std*(1. - self.nugget*np.diag(self.Qn))*self.coef
+
+        self._build_models()
+        y = np.zeros(self.ntr)
+        for i in range(self.ntr):
+            y[i] = self.loosm[i].predict_values(self.xtr[i:i+1,:])[0,0]
+        return y
+
+    def predict(self, xt):
+        """
+        Predictions of every leave-one-out model at xt
+
+        Parameters
+        ----------
+        xt : np.ndarray[nt, nx]
+
+        Returns
+        -------
+        y : np.ndarray[nt, ntr]
+        """
+        xt = np.atleast_2d(xt)
+        if self.mode == "model":
+            return self.model.predict_loo_values(xt)
+
+        if self.mode == "kriging":
+            r, f = self._krg_corr(xt)
+            y = self.model.predict_values(xt)
+            return y - self.model.y_std*(np.dot(r, self.Qn) + np.dot(f, self.W))*self.coef[None,:]
+
+        self._build_models()
+        y = np.zeros([xt.shape[0], self.ntr])
+        for i in range(self.ntr):
+            y[:,i] = self.loosm[i].predict_values(xt)[:,0]
+        return y
+
+    def predict_derivatives(self, xt):
+        """
+        Gradients of every leave-one-out model at xt. Analytic for models that
+        implement predict_loo_derivatives, squared exponential kriging with a
+        constant or linear trend, and retrained models with derivatives,
+        central differences of predict otherwise
+
+        Parameters
+        ----------
+        xt : np.ndarray[nt, nx]
+
+        Returns
+        -------
+        dy : np.ndarray[nt, ntr, nx]
+        """
+        xt = np.atleast_2d(xt)
+        if self.mode == "model" and hasattr(self.model, "predict_loo_derivatives"):
+            return self.model.predict_loo_derivatives(xt)
+
+        if self.mode == "kriging" and self.model.options["corr"] == "squar_exp" and self.model.options["poly"] in ["constant", "linear"]:
+            model = self.model
+            nt, nx = xt.shape
+            r, f = self._krg_corr(xt)
+            X_cont = (xt - model.X_offset) / model.X_scale
+
+            # d r/dx and d f/dx in the normalized space
+            theta = model.optimal_theta
+            if model.name != "Kriging" and "KPLSK" not in model.name:
+                theta = np.sum(model.optimal_theta * model.coeff_pls ** 2, axis=1)
+            dx = X_cont[:,None,:] - model.X_norma[None,:,:]
+            dr = -2*theta[None,None,:]*dx*r[:,:,None]
+            df = np.zeros([nt, f.shape[1], nx])
+            if model.options["poly"] == "linear":
+                df[:,1:,:] = np.eye(nx)[None,:,:]
+
+            dfull = np.zeros([nt, nx])
+            for kx in range(nx):
+                dfull[:,kx] = model.predict_derivatives(xt, kx)[:,0]
+
+            dcorr = np.einsum('tik,ij->tjk', dr, self.Qn) + np.einsum('tpk,pj->tjk', df, self.W)
+            return dfull[:,None,:] - model.y_std*dcorr*self.coef[None,:,None]/model.X_scale[None,None,:]
+
+        if self.mode == "retrain" and self.model.supports["derivatives"]:
+            self._build_models()
+            nt, nx = xt.shape
+            dy = np.zeros([nt, self.ntr, nx])
+            for i in range(self.ntr):
+                for kx in range(nx):
+                    dy[:,i,kx] = self.loosm[i].predict_derivatives(xt, kx)[:,0]
+            return dy
+
+        # stack all the perturbed points in one prediction
+        h = 1e-6
+        nt, nx = xt.shape
+        xs = np.repeat(xt[None,:,:], 2*nx, axis=0)
+        for kx in range(nx):
+            xs[kx,:,kx] += h
+            xs[nx+kx,:,kx] -= h
+        ys = self.predict(xs.reshape(2*nx*nt, nx)).reshape(2*nx, nt, self.ntr)
+        return np.transpose((ys[:nx] - ys[nx:])/(2*h), (1, 2, 0))
+
+    def _krg_supported(self):
+        model = self.model
+        if not isinstance(model, KrgBased):
+            return False
+        if model.options._dict.get("categorical_kernel") is not None:
+            return False
+        # GEKPLS and the like train on more points than were given
+        if not isinstance(model.optimal_par.get("C"), np.ndarray) or model.X_norma.shape[0] != self.ntr:
+            return False
+        return True
+
+    def _krg_factor(self):
+        """
+        Blocks of the inverse of the bordered system K = [[R, F], [F^T, 0]],
+        Qn = R^-1 - R^-1 F (F^T R^-1 F)^-1 F^T R^-1 and
+        W = (F^T R^-1 F)^-1 F^T R^-1, from the Cholesky and QR factors kept by
+        the model
+        """
+        par = self.model.optimal_par
+        C = par["C"]
+        Q = par["Q"]
+        G = par["G"]
+
+        Cinv = solve_triangular(C, np.eye(self.ntr), lower=True)
+        QtC = np.dot(Q.T, Cinv)
+        self.Qn = np.dot(Cinv.T, Cinv) - np.dot(QtC.T, QtC)
+        self.W = solve_triangular(G, QtC)
+
+        # alpha = K^-1 [y; 0] is gamma, dropping sample i changes a prediction by k^T K^-1 e_i alpha_i/Qn_ii
+        self.coef = par["gamma"][:,0]/np.diag(self.Qn)
+
+        # diagonal of R above 1, nugget and noise
+        self.nugget = np.sum(C**2, axis=1) - 1.
+
+    def _krg_corr(self, xt):
+        model = self.model
+        X_cont = (xt - model.X_offset) / model.X_scale
+        dx = differences(X_cont, Y=model.X_norma.copy())
+        d = model._componentwise_distance(dx)
+        r = model._correlation_types[model.options["corr"]](model.optimal_theta, d).reshape(xt.shape[0], self.ntr)
+        f = model._regression_types[model.options["poly"]](X_cont)
+        return r, f
+
+    def _build_models(self):
+        if self.loosm is not None:
+            return
+
+        trg_all = None
+        if self.model.supports["training_derivatives"]:
+            trg_all = convert_to_smt_grads(self.model)
+
+        self.loosm = []
+        for i in range(self.ntr):
+            loosm = copy.deepcopy(self.model)
+            loosm.options.update({"print_global":False})
+
+            trx = np.delete(self.xtr, i, 0)
+            trf = np.delete(self.ytr, i, 0)
+            loosm.set_training_values(trx, trf)
+            if trg_all is not None:
+                convert_to_smt_grads(loosm, trx, np.delete(trg_all, i, 0))
+
+            if self.retrain:
+                loosm.train()
+            self.loosm.append(loosm)
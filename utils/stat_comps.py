@@ -3,6 +3,7 @@ from utils.sutils import convert_to_smt_grads
 import copy
 from mpi4py import MPI
 from math import ceil
+from scipy.stats import qmc
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
@@ -79,6 +80,12 @@ def _mu_sigma_grad(func_handle, N, tx, xlimits, scales, static_list, pdf_list, t
     
     N_act = 1
 
+    # if func_handle is a surrogate's predict_derivatives, use its jacobian if it has one
+    jac_handle = None
+    model = getattr(func_handle, "__self__", None)
+    if model is not None and getattr(model, "supports", {}).get("jacobian", False):
+        jac_handle = model.predict_jacobian
+
     split = ceil(dim_u/size)
     arrs = np.array_split(tx, split)
     l1 = 0
@@ -91,6 +98,9 @@ def _mu_sigma_grad(func_handle, N, tx, xlimits, scales, static_list, pdf_list, t
         
         if tg is not None:
             grads[l1:l2,:] = tg[l1:l2,:]
+        elif jac_handle is not None:
+            # all partials from one pass over the model
+            grads[l1:l2,:] = jac_handle(arrs[k])
         else:
             # grads[l1:l2,:] = convert_to_smt_grads(func_handle, arrs[k])
             for ki in range(dim):
@@ -126,3 +136,118 @@ def _mu_sigma_grad(func_handle, N, tx, xlimits, scales, static_list, pdf_list, t
     #return full gradients, but gmean and gstdev are only with respect to dvs
     return (gmean, gstdev), grads
 
+
+
+class SobolIntegrator():
+    """
+    Randomized quasi-Monte Carlo integration over the unit hypercube, with
+    independently scrambled Sobol sequences used as replicates for an error
+    estimate
+
+    The number of points per replicate doubles until the replicate spread
+    meets a relative tolerance or the point budget runs out. Integrand values
+    are kept while the key passed to integrate is unchanged, and the next
+    integration starts from the point count the previous one ended at.
+
+    Parameters
+    ----------
+    dim : int
+        Dimension of the unit hypercube
+    rtol : float
+        Target relative accuracy of the integral
+    nrep : int
+        Number of scrambled replicates
+    max_points : int
+        Total point budget over all replicates
+    m0 : int
+        Start with 2**m0 points per replicate
+    seed : int
+        Seed for the scrambles, drawn on rank 0 if None
+    """
+    def __init__(self, dim, rtol=1e-2, nrep=4, max_points=None, m0=6, seed=None):
+
+        self.dim = dim
+        self.rtol = rtol
+        self.nrep = nrep
+
+        if max_points is None:
+            max_points = 5000*dim
+        # powers of 2 per replicate keep the Sobol points balanced
+        self.n_max = 2**max(m0, int(np.floor(np.log2(max(max_points//nrep, 1)))))
+        self.n0 = 2**m0
+        self.n = self.n0
+
+        # same points on every proc
+        if seed is None:
+            if rank == 0:
+                seed = np.random.randint(2**31 - 1)
+            seed = comm.bcast(seed)
+        seeds = np.random.SeedSequence(seed).spawn(nrep)
+        self.samplers = [qmc.Sobol(d=dim, scramble=True, seed=np.random.default_rng(sd)) for sd in seeds]
+        self.x = [np.zeros([0, dim]) for r in range(nrep)]
+
+        self.key = None
+        self.vals = [None]*nrep
+        self.err = None
+
+    def points(self, n):
+        """
+        Get the first n points of every replicate, generating more if needed
+        """
+        for r in range(self.nrep):
+            nhave = self.x[r].shape[0]
+            if nhave < n:
+                self.x[r] = np.append(self.x[r], self.samplers[r].random(n - nhave), axis=0)
+
+        return [self.x[r][:n] for r in range(self.nrep)]
+
+    def integrate(self, func, key=None, estimate=None):
+        """
+        Integrate func over the unit hypercube
+
+        Parameters
+        ----------
+        func : callable
+            Integrand, maps points (n, dim) to values (n, k)
+        key : hashable
+            Integrand values are reused as long as key is the same as in the
+            previous call
+        estimate : callable
+            Maps the points (n, dim) and integrand values (n, k) of one
+            replicate to its estimate, the mean by default
+
+        Returns
+        -------
+        est : float
+            Mean of the replicate estimates
+        err : float
+            Standard error of the mean over replicates
+        """
+        if estimate is None:
+            estimate = lambda x, vals: np.mean(vals)
+
+        if key is None or key != self.key:
+            self.vals = [None]*self.nrep
+            self.key = key
+
+        n = self.n
+        while True:
+            xr = self.points(n)
+            ests = np.zeros(self.nrep)
+            for r in range(self.nrep):
+                nhave = 0 if self.vals[r] is None else self.vals[r].shape[0]
+                if nhave < n:
+                    work = np.asarray(func(xr[r][nhave:n])).reshape(n - nhave, -1)
+                    self.vals[r] = work if self.vals[r] is None else np.append(self.vals[r], work, axis=0)
+                ests[r] = estimate(xr[r], self.vals[r][:n])
+
+            est = np.mean(ests)
+            err = np.std(ests, ddof=1)/np.sqrt(self.nrep) if self.nrep > 1 else 0.
+            if err <= self.rtol*abs(est) or 2*n > self.n_max:
+                break
+            n *= 2
+
+        self.n = n
+        self.err = err
+        return est, err
+
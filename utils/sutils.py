@@ -2,6 +2,7 @@ import numpy as np
 from numpy.linalg import qr
 from scipy.linalg import lstsq, lu_factor, lu_solve, solve, inv, eig
 from scipy.stats import qmc
+from scipy.spatial import KDTree
 from scipy.spatial.distance import cdist
 from functions.example_problems import Heaviside, MultiDimJump, Quad2D
 from smt.problems import RobotArm
@@ -127,6 +128,68 @@ def getDirectCovariance(r, dr, d2r, theta, nt, ij):
 
     return P, Pg, S
 
+def wendland(dx, theta, order=0):
+    """
+    Compactly supported Wendland kernel phi(rho) = (1 - rho)_+^e (e rho + 1),
+    with rho^2 = sum_k theta_k dx_k^2 and e = floor(d/2) + 3, which is C2 and
+    positive definite in d dimensions. Zero for rho >= 1, so the support
+    radius in dimension k is 1/sqrt(theta_k)
+
+    Inputs:
+        dx - differences between pairs of points [n, d]
+        theta - hyperparameters
+        order - highest derivative order to return, up to 2
+    Outputs:
+        r - kernel values [n]
+        dr - kernel derivatives wrt dx [n, d], if order > 0
+        d2r - kernel second derivatives wrt dx [n, d, d], if order > 1
+    """
+    n, d = dx.shape
+    e = d//2 + 3
+    tdx = dx*theta
+    rho = np.sqrt(np.einsum('ij,ij->i', tdx, dx))
+    q = np.maximum(1. - rho, 0.)
+
+    r = q**e*(e*rho + 1.)
+    if order < 1:
+        return r
+
+    # phi'(rho)/rho, finite at rho = 0
+    g = -e*(e + 1)*q**(e - 1)
+    dr = g[:,None]*tdx
+    if order < 2:
+        return r, dr
+
+    # (dg/drho)/rho is singular at rho = 0, but tdx tdx^T vanishes faster
+    h = np.zeros(n)
+    nz = rho > 0.
+    h[nz] = (e + 1)*e*(e - 1)*q[nz]**(e - 2)/rho[nz]
+    d2r = h[:,None,None]*tdx[:,:,None]*tdx[:,None,:]
+    d2r[:, np.arange(d), np.arange(d)] += g[:,None]*theta[None,:]
+
+    return r, dr, d2r
+
+def wendlandNeighbors(X, Y, theta):
+    """
+    Find all pairs of points within the support of the wendland kernel,
+    using KD-trees in coordinates scaled by sqrt(theta)
+
+    Inputs:
+        X - first set of points
+        Y - second set of points
+        theta - hyperparameters
+    Outputs:
+        i - indices into X
+        j - indices into Y
+        dx - differences X[i] - Y[j]
+    """
+    s = np.sqrt(theta)
+    pairs = KDTree(X*s).sparse_distance_matrix(KDTree(Y*s), 1., output_type='ndarray')
+    i = pairs['i'].astype(int)
+    j = pairs['j'].astype(int)
+
+    return i, j, X[i] - Y[j]
+
 def quadraticSolve(x, xn, f, fn, g, gn):
 
     """
@@ -329,6 +392,76 @@ def quadraticSolveHOnly(x, xn, f, fn, g, gn, return_cond=False):
 
 
 
+def quadraticSolveHOnlyBatch(x, xn, f, fn, g, gn, return_cond=False):
+
+    """
+    Batched version of quadraticSolveHOnly, solving the Hessian fit for B
+    centers at once. The systems are assembled with a precomputed symmetric
+    index map and solved as stacked arrays instead of one lstsq call per center.
+
+    Inputs: 
+        x - points to center the approximations, (B, N)
+        xn - neighborhoods of points to attempt interpolation through, (B, M, N)
+        f - function values at center points, (B)
+        fn - function values of neighborhood points, (B, M)
+        g - gradients at center points, (B, N)
+        gn - gradients at neighborhood points, (B, M, N)
+
+    Outputs
+        Hh - solved center Hessians in compressed symmetric form, (B, N(N+1)/2)
+        cond - condition numbers of the systems, (B), if return_cond
+    """
+    B, M, N = xn.shape
+    vN = sum(range(N+1))
+    imap = symMatIndexMap(N)
+    # compressed entries in order, off-diagonals appear twice in dx^T H dx
+    iu, ju = np.triu_indices(N)
+    wu = np.where(iu == ju, 0.5, 1.0)
+    ii, jj = np.meshgrid(np.arange(N), np.arange(N), indexing='ij')
+
+    dx = xn - x[:,None,:]
+
+    # assemble rhs
+    rhs = np.zeros([B, M+M*N])
+    rhs[:,:M] = np.reshape(fn, [B, M]) - np.reshape(f, [B, 1]) - np.einsum('bkj,bj->bk', dx, g)
+    rhs[:,M:] = (gn - g[:,None,:]).reshape(B, M*N)
+
+    # assemble mat
+    mat = np.zeros([B, M+M*N, vN])
+    # function fitting
+    mat[:,:M,:] = wu*dx[:,:,iu]*dx[:,:,ju]
+    # gradient fitting
+    matg = np.zeros([B, M, N, vN])
+    matg[:,:,ii,imap] = dx[:,:,jj]
+    mat[:,M:,:] = matg.reshape(B, M*N, vN)
+
+    # now solve the systems in a least squares sense, same as quadraticSolveHOnly
+    if N < 6:
+        # minimum norm solution, with lstsq's default cutoff
+        u, sv, vt = np.linalg.svd(mat, full_matrices=False)
+        cut = sv > np.finfo(float).eps*sv[:,[0]]
+        sinv = np.zeros_like(sv)
+        sinv[cut] = 1./sv[cut]
+        Hh = (np.transpose(vt, (0,2,1)) @ (sinv*(np.transpose(u, (0,2,1)) @ rhs[:,:,None])[:,:,0])[:,:,None])[:,:,0]
+        cond = sv[:,0]/sv[:,-1]
+    else:
+        lamb = 1e-3
+        matT = np.transpose(mat, (0,2,1))
+        mat2 = matT @ mat
+        Hh = np.linalg.solve(mat2 + lamb*np.eye(vN), matT @ rhs[:,:,None])[:,:,0]
+        # singular values of mat from the (much smaller) normal matrix
+        ev = np.linalg.eigvalsh(mat2)
+        cond = np.sqrt(ev[:,-1]/np.maximum(ev[:,0], np.finfo(float).tiny))
+
+    Hh[np.any(abs(Hh) > 1e6, axis=1),:] = 0.
+
+    if return_cond:
+        return Hh, cond
+
+    return Hh
+
+
+
 
 def quadratic(x, x0, f0, g, h):
     """
@@ -418,6 +551,83 @@ def symMatfromVec(i, j, N):
         return int(i*N - (i - 1) * i/2 + j - i)
     else:
         return int(j*N - (j - 1) * j/2 + i - j)
+
+def symMatIndexMap(N):
+    """
+    Precompute the compressed vector index of every entry of a symmetric matrix, 
+    such that Hh[symMatIndexMap(N)] expands a compressed matrix to full form
+
+    Inputs:
+        N - matrix size
+    Outputs:
+        imap - int array (N, N), imap[i,j] = symMatfromVec(i,j,N)
+    """
+    i, j = np.meshgrid(np.arange(N), np.arange(N), indexing='ij')
+    lo = np.minimum(i, j)
+    hi = np.maximum(i, j)
+    return (lo*N - (lo - 1)*lo//2 + hi - lo).astype(int)
+
+def symMatPack(H):
+    """
+    Compress symmetric matrices to their upper triangular vector form, in the
+    same ordering as symMatfromVec
+
+    Inputs:
+        H - symmetric matrices (..., N, N)
+    Outputs:
+        Hp - compressed matrices (..., N(N+1)/2)
+    """
+    iu, ju = np.triu_indices(H.shape[-1])
+    return H[..., iu, ju]
+
+def symMatUnpack(Hp, N):
+    """
+    Expand compressed symmetric matrices to full form
+
+    Inputs:
+        Hp - compressed matrices (..., N(N+1)/2)
+        N - matrix size
+    Outputs:
+        H - symmetric matrices (..., N, N)
+    """
+    return Hp[..., symMatIndexMap(N)]
+
+def symMatQuadPacked(Hp, dx):
+    """
+    Compute dx_k^T H_k dx_k for a set of compressed symmetric matrices, without
+    expanding them
+
+    Inputs:
+        Hp - compressed matrices (n, N(N+1)/2)
+        dx - vectors (n, N)
+    Outputs:
+        q - quadratic forms (n)
+    """
+    iu, ju = np.triu_indices(dx.shape[1])
+    # off-diagonal entries appear twice in the full matrix
+    w = np.where(iu == ju, 1.0, 2.0)
+    return np.einsum('iv,iv,iv->i', Hp, dx[:,iu], dx[:,ju]*w)
+
+def symMatVecPacked(Hp, dx):
+    """
+    Compute H_k dx_k for a set of compressed symmetric matrices, without
+    expanding them
+
+    Inputs:
+        Hp - compressed matrices (n, N(N+1)/2)
+        dx - vectors (n, N)
+    Outputs:
+        Hdx - matrix-vector products (n, N)
+    """
+    N = dx.shape[1]
+    iu, ju = np.triu_indices(N)
+    off = (iu != ju).astype(Hp.dtype)
+    # entry (i,j) contributes to row i, its mirror (j,i) to row j
+    Ei = np.zeros([iu.shape[0], N], dtype=Hp.dtype)
+    Ej = np.zeros([iu.shape[0], N], dtype=Hp.dtype)
+    Ei[np.arange(iu.shape[0]), iu] = 1.
+    Ej[np.arange(iu.shape[0]), ju] = off
+    return (Hp*dx[:,ju]) @ Ei + (Hp*dx[:,iu]) @ Ej
     
 # def symMatVecProd(S, x, N):
 #     """
@@ -576,7 +786,138 @@ def divide_cases(ncases, nprocs):
     return data
 
 
-def estimate_pou_volume(trx, bounds):
+def gather_cases(local, cases, comm=comm):
+    """
+    Assemble the full array of results from the rows each proc computed for its
+    cases, with a single Allgatherv. Each proc only sends its own rows, instead
+    of allreducing a zero-padded array over every case.
+
+    Parameters
+    ----------
+    local : np.ndarray
+        Results on this proc, one row per case in cases[comm.rank], in order.
+    cases : list of list of int
+        Case numbers for each proc, as given by divide_cases.
+    comm : MPI.Comm
+        Communicator the cases were divided over.
+
+    Returns
+    -------
+    np.ndarray
+        Results for all cases, in case order, on every proc.
+    """
+    local = np.ascontiguousarray(local, dtype=float)
+    rshape = local.shape[1:]
+    rsize = int(np.prod(rshape))
+    order = np.concatenate([np.asarray(c, dtype=int) for c in cases])
+
+    if comm.Get_size() == 1:
+        recv = local
+    else:
+        counts = np.array([len(c)*rsize for c in cases], dtype=int)
+        displs = np.zeros_like(counts)
+        displs[1:] = np.cumsum(counts)[:-1]
+        recv = np.zeros((order.shape[0],) + rshape)
+        comm.Allgatherv(local, [recv, counts, displs, MPI.DOUBLE])
+
+    full = np.zeros((order.shape[0],) + rshape)
+    full[order] = recv
+    return full
+
+
+def estimate_stencil_hessians(tree, x, y, g, inds, neval, comm=comm):
+    """
+    Estimate the Hessians at points inds from quadratic fits over their
+    nearest neighbor stencils, with the cases divided over procs.
+
+    Parameters
+    ----------
+    tree : KDTree
+        Tree built on x.
+    x : np.ndarray [n, dim]
+        Points.
+    y : np.ndarray [n] or [n, 1]
+        Function values.
+    g : np.ndarray [n, dim]
+        Gradients.
+    inds : np.ndarray
+        Points to estimate the Hessian at.
+    neval : int
+        Stencil size, including the point itself.
+    comm : MPI.Comm
+        Communicator to divide the cases over.
+
+    Returns
+    -------
+    hess : np.ndarray [len(inds), dim, dim]
+        Hessian estimates.
+    mc : np.ndarray [len(inds)]
+        Condition number of each stencil system.
+    rad : np.ndarray [len(inds)]
+        Radius of each stencil.
+    """
+    y = np.asarray(y).reshape(-1)
+    dim = x.shape[1]
+    hess = np.zeros([inds.shape[0], dim, dim])
+    mcs = np.zeros(inds.shape[0])
+    rads = np.zeros(inds.shape[0])
+    imap = symMatIndexMap(dim)
+    cases_all = divide_cases(inds.shape[0], comm.Get_size())
+    cases = np.asarray(cases_all[comm.Get_rank()], dtype=int)
+
+    # stacked systems grow as neval*dim^3, so solve them in blocks
+    bsize = 500
+    for l1 in range(0, cases.shape[0], bsize):
+        c = cases[l1:l1+bsize]
+        i = inds[c]
+        dists, indn = tree.query(x[i], neval)
+        nb = indn[:,1:neval]
+        Hh, mc = quadraticSolveHOnlyBatch(x[i,:], x[nb,:], y[i], y[nb], g[i,:], g[nb,:], return_cond=True)
+
+        mcs[c] = mc
+        rads[c] = dists[:,-1]
+        hess[c] = Hh[:,imap]
+
+    return (gather_cases(hess[cases], cases_all, comm),
+            gather_cases(mcs[cases], cases_all, comm),
+            gather_cases(rads[cases], cases_all, comm))
+
+
+def stale_stencils(tree, x, rad, nold):
+    """
+    Find the stencils to recompute after points x[nold:] were appended: the
+    old points with a new point within their stencil radius, and the new
+    points themselves.
+
+    Parameters
+    ----------
+    tree : KDTree
+        Tree built on all of x.
+    x : np.ndarray [n, dim]
+        Points, the new ones last.
+    rad : np.ndarray [nold]
+        Stencil radius of the old points.
+    nold : int
+        Number of old points.
+
+    Returns
+    -------
+    np.ndarray
+        Sorted indices of the stencils to recompute.
+    """
+    xnew = x[nold:]
+    close = tree.query_ball_point(xnew, np.max(rad[:nold]))
+    affected = []
+    for j in range(xnew.shape[0]):
+        cand = np.array([i for i in close[j] if i < nold], dtype=int)
+        if cand.shape[0] > 0:
+            dnew = np.linalg.norm(x[cand] - xnew[j], axis=1)
+            affected.extend(cand[dnew <= rad[cand]].tolist())
+
+    return np.union1d(np.array(affected, dtype=int), np.arange(nold, x.shape[0]))
+
+
+def estimate_pou_volume(trx, bounds, seed=None, return_samples=False):
     """
     Estimate volume of partition-of-unity basis cells by counting closest randomly-distributed points
 
@@ -588,29 +929,111 @@ def estimate_pou_volume(trx, bounds):
     bounds: np.ndarray
         bounds of the domain, expected to be unit hypercube
 
+    seed: int
+        seed for the random points, for reproducible volumes
+
+    return_samples: bool
+        also return the random points and their closest training points, to
+        pass to update_pou_volume when points are appended
+
     Returns
     -------
     dV: np.ndarray
         list of cell volumes ordered like trx
+
+    samples: tuple
+        random points, distance to and index of their closest training points,
+        if return_samples
     """
     m, n = trx.shape
 
-    dV = np.ones(m)
-    sampling = LHS(xlimits=bounds)
+    sampling = LHS(xlimits=bounds, random_state=seed)
     vx = sampling(100*m)
-    ms, ns = vx.shape
-    dists = cdist(vx, trx)
-
-    # loop over the random points
-    for i in range(ms):
-        cind = np.argmin(dists[i])
-        dV[cind] += 1.
+    dist, ind = _closest_points(KDTree(trx), vx)
 
-    dV /= ms
+    dV = _count_pou_volume(ind, m)
 
+    if return_samples:
+        return dV, (vx, dist, ind)
     return dV
 
 
+def update_pou_volume(trx, nnew, bounds, samples, seed=None):
+    """
+    Update estimate_pou_volume after nnew points were appended to trx. Only the
+    random points closer to a new point change cells, and 100 random points are
+    added per new point
+
+    Parameters
+    ----------
+    trx: np.ndarray
+        list of training point locations, the last nnew of which are new
+
+    nnew: int
+        number of appended points
+
+    bounds: np.ndarray
+        bounds of the domain, expected to be unit hypercube
+
+    samples: tuple
+        random points, distance to and index of their closest training points,
+        from estimate_pou_volume or a previous update
+
+    seed: int
+        seed for the added random points, offset by the number of old points
+
+    Returns
+    -------
+    dV: np.ndarray
+        list of cell volumes ordered like trx
+
+    samples: tuple
+        updated random points and closest training points
+    """
+    m, n = trx.shape
+    nold = m - nnew
+    vx, dist, ind = samples
+
+    # reassign old random points that are closer to a new point
+    dnew, inew = _closest_points(KDTree(trx[nold:]), vx)
+    moved = dnew < dist
+    dist = np.where(moved, dnew, dist)
+    ind = np.where(moved, inew + nold, ind)
+
+    # keep the sample density at 100 points per cell
+    if seed is not None:
+        seed = seed + nold
+    sampling = LHS(xlimits=bounds, random_state=seed)
+    vxa = sampling(100*nnew)
+    dista, inda = _closest_points(KDTree(trx), vxa)
+
+    vx = np.append(vx, vxa, axis=0)
+    dist = np.append(dist, dista)
+    ind = np.append(ind, inda)
+
+    dV = _count_pou_volume(ind, m)
+
+    return dV, (vx, dist, ind)
+
+
+def _closest_points(tree, vx, chunk=100000):
+    # nearest neighbor queries in chunks, to bound the memory of large sample sets
+    dist = np.zeros(vx.shape[0])
+    ind = np.zeros(vx.shape[0], dtype=int)
+    for k in range(0, vx.shape[0], chunk):
+        dist[k:k+chunk], ind[k:k+chunk] = tree.query(vx[k:k+chunk])
+
+    return dist, ind
+
+
+def _count_pou_volume(ind, m):
+    # every cell starts with a count of one
+    ms = ind.shape[0]
+    dV = 1. + np.bincount(ind, minlength=m)
+
+    return dV/ms
+
+
 #TODO: Probably need a test for this function, but it seems to work well
 # haven't tested predict derivatives or get training derivatives though
 def convert_to_smt_grads(smt_func, x_array=None, g_array=None, deriv_predict=False, name=None):
@@ -673,6 +1096,10 @@ def convert_to_smt_grads(smt_func, x_array=None, g_array=None, deriv_predict=Fal
 
         return g_array
 
+    # surrogates with a jacobian give every partial in one pass
+    if isinstance(smt_func, SMT_SM) and deriv_predict and smt_func.supports.get("jacobian", False):
+        return smt_func.predict_jacobian(x_array)
+
     # otherwise, extract gradients from whatever we have
     g_array = np.zeros([nt, ndim])
     for i in range(ndim):
@@ -794,14 +1221,13 @@ def print_rc_plots(bounds, name, obj, dir=0):
         # x = np.linspace(bounds[0][0], bounds[0][1], ndir)
         # y = np.linspace(bounds[1][0], bounds[1][1], ndir)
         x = np.linspace(0., 1., ndir)
-        F  = np.zeros([ndir])
         dim_t = len(obj.sub_ind) + len(obj.fix_ind) 
         xi = np.zeros([dim_t])
         xi[obj.fix_ind] = qmc.scale(np.array([obj.fix_val]), obj.bounds[obj.fix_ind,0], obj.bounds[obj.fix_ind,1], reverse=True)
         # xi[0, obj.fix_ind] = obj.fix_val
-        for i in range(ndir):
-            xi[obj.sub_ind] = x[i]
-            F[i]  = -obj.evaluate(xi, obj.bounds, dir)  #TODO: ADD DIR
+        xg = np.tile(xi, (ndir, 1))
+        xg[:, obj.sub_ind] = x[:,None]
+        F  = -obj.evaluate_batch(xg, obj.bounds, dir)  #TODO: ADD DIR
         if(obj.ntr == 10):
             obj.scaler = np.max(F)
         obj.scaler = 1.0
@@ -854,17 +1280,12 @@ def print_rc_plots(bounds, name, obj, dir=0):
         x = np.linspace(0., 1., ndir)
         y = np.linspace(0., 1., ndir)   
         X, Y = np.meshgrid(x, y)
-        F  = np.zeros([ndir, ndir]) 
-        FM = np.zeros([ndir, ndir]) 
-        FT = np.zeros([ndir, ndir]) 
-        for i in range(ndir):
-            for j in range(ndir):
-                xi = np.zeros([2])
-                xi[0] = x[i]
-                xi[1] = y[j]
-                FM[i,j] = obj.model.predict_values(np.atleast_2d(xi))
-                # FT[i,j] = trueFunc(np.atleast_2d(xi))
-                F[i,j]  = obj.evaluate(xi, bounds, dir) #TODO: ADD DIR
+        # F[i,j] at (x[i], y[j])
+        xg, yg = np.meshgrid(x, y, indexing='ij')
+        xi = np.column_stack([xg.ravel(), yg.ravel()])
+        FM = obj.model.predict_values(xi).reshape(ndir, ndir)
+        # FT = trueFunc(xi).reshape(ndir, ndir)
+        F  = obj.evaluate_batch(xi, bounds, dir).reshape(ndir, ndir) #TODO: ADD DIR
         cs = plt.contourf(Y, X, F, levels = np.linspace(np.min(F), 0., 25))
         plt.colorbar(cs)
         trx = obj.trx
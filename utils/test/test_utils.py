@@ -2,11 +2,13 @@ import unittest
 import numpy as np
 import sys
 
-from utils.sutils import quadraticSolve, quadraticSolveHOnly, symMatfromVec, maxEigenEstimate, boxIntersect
+from utils.sutils import quadraticSolve, quadraticSolveHOnly, quadraticSolveHOnlyBatch, symMatfromVec, symMatIndexMap, maxEigenEstimate, boxIntersect, divide_cases, gather_cases, estimate_pou_volume, update_pou_volume, wendland, wendlandNeighbors
 from utils.error import stat_comp, meane
+from utils.loo import LOOPredictor
+from utils.stat_comps import SobolIntegrator
 from smt.problems import RobotArm, Rosenbrock
 from smt.surrogate_models import KRG
-from smt.sampling_methods import FullFactorial
+from smt.sampling_methods import FullFactorial, LHS
 
 class UtilTest(unittest.TestCase):
     
@@ -24,6 +26,134 @@ class UtilTest(unittest.TestCase):
         self.assertTrue(p0 - -3.238279585853798 < 1.e-14)
         self.assertTrue(p1 - 0.41231056256176596 < 1.e-14)
 
+    def test_quadraticSolveHOnlyBatch(self):
+        rng = np.random.default_rng(0)
+        # both the lstsq (N < 6) and regularized (N >= 6) branches
+        for N in [3, 7]:
+            B = 10
+            M = 2*N
+            x = rng.random([B, N])
+            xn = rng.random([B, M, N])
+            f = rng.random(B)
+            fn = rng.random([B, M])
+            g = rng.random([B, N])
+            gn = rng.random([B, M, N])
+
+            imap = symMatIndexMap(N)
+            for i in range(N):
+                for j in range(N):
+                    self.assertEqual(imap[i,j], symMatfromVec(i,j,N))
+
+            Hb, cb = quadraticSolveHOnlyBatch(x, xn, f, fn, g, gn, return_cond=True)
+            for b in range(B):
+                Hh, c = quadraticSolveHOnly(x[b], xn[b], f[b], fn[b], g[b], gn[b], return_cond=True)
+                self.assertTrue(np.max(np.abs(Hh - Hb[b])) < 1.e-10*np.max(np.abs(Hh)))
+                self.assertTrue(abs(c - cb[b]) < 1.e-8*c)
+
+    def test_gather_cases(self):
+        # single process, but rows must still come back in case order
+        x = np.arange(14.).reshape(7,2)
+        cases = divide_cases(7, 1)
+        self.assertTrue(np.all(gather_cases(x[cases[0]], cases) == x))
+        self.assertTrue(np.all(gather_cases(x[cases[0],0], cases) == x[:,0]))
+
+    def test_pou_volume(self):
+        bounds = np.zeros([2, 2])
+        bounds[:,1] = 1.
+        xt = LHS(xlimits=bounds, random_state=0)(20)
+        xn = LHS(xlimits=bounds, random_state=1)(3)
+        xa = np.append(xt, xn, axis=0)
+
+        dV, samples = estimate_pou_volume(xt, bounds, seed=2, return_samples=True)
+        self.assertTrue(np.all(dV == estimate_pou_volume(xt, bounds, seed=2)))
+        dVu, samples = update_pou_volume(xa, 3, bounds, samples, seed=2)
+
+        # counts must match a brute force search over the same random points
+        for x, dVc, vx in [(xt, dV, samples[0][:2000]), (xa, dVu, samples[0])]:
+            cind = np.argmin(np.linalg.norm(vx[:,None,:] - x[None,:,:], axis=2), axis=1)
+            dVb = (1. + np.bincount(cind, minlength=x.shape[0]))/vx.shape[0]
+            self.assertTrue(np.max(np.abs(dVc - dVb)) < 1.e-14)
+
+    def test_sobol_integrator(self):
+        integ = SobolIntegrator(3, rtol=1e-3, seed=0)
+        calls = []
+        def func(x):
+            calls.append(x.shape[0])
+            return np.prod(np.sin(np.pi*x), axis=1)
+
+        # exact integral is (2/pi)^3
+        est, err = integ.integrate(func, key=0)
+        self.assertTrue(abs(est - (2./np.pi)**3) < 1.e-3*(2./np.pi)**3 or integ.n == integ.n_max)
+        self.assertTrue(abs(est - (2./np.pi)**3) < 5.*err + 1.e-12)
+
+        # same key, no new evaluations
+        ncalls = len(calls)
+        est2, err2 = integ.integrate(func, key=0)
+        self.assertEqual(len(calls), ncalls)
+        self.assertEqual(est, est2)
+
+    def test_loo_kriging(self):
+        trueFunc = Rosenbrock(ndim=2)
+        xt = LHS(xlimits=trueFunc.xlimits, random_state=0)(15)
+        xv = LHS(xlimits=trueFunc.xlimits, random_state=1)(5)
+        model = KRG(poly="linear", print_global=False)
+        model.set_training_values(xt, trueFunc(xt))
+        model.train()
+
+        loo = LOOPredictor(model)
+        self.assertEqual(loo.mode, "kriging")
+        yloo_t = loo.values()
+        yloo = loo.predict(xv)
+
+        # refit with the same theta, without sample i
+        C = model.optimal_par["C"]
+        R = np.dot(C, C.T)
+        F = model._regression_types["linear"](model.X_norma)
+        Fv = model._regression_types["linear"]((xv - model.X_offset)/model.X_scale)
+        Rv = loo._krg_corr(xv)[0]
+        for i in [0, 9]:
+            k = np.delete(np.arange(15), i)
+            K = np.block([[R[np.ix_(k,k)], F[k]], [F[k].T, np.zeros([3, 3])]])
+            sol = np.linalg.solve(K, np.append(model.y_norma[k,0], np.zeros(3)))
+            yi = model.y_mean + model.y_std*np.dot(np.append(R[i,k], F[i]), sol)
+            yv = model.y_mean + model.y_std*np.dot(np.hstack([Rv[:,k], Fv]), sol)
+            self.assertTrue(abs(yloo_t[i] - yi) < 1.e-6*abs(yi))
+            self.assertTrue(np.max(np.abs(yloo[:,i] - yv)) < 1.e-6*np.max(np.abs(yv)))
+
+    def test_wendland(self):
+        rng = np.random.default_rng(0)
+        for dim in [1, 2, 3]:
+            theta = rng.random(dim) + 0.5
+            X = rng.random([30, dim])
+            Y = rng.random([20, dim])
+
+            # neighbors against all pairs
+            i, j, dx = wendlandNeighbors(X, Y, theta)
+            r = wendland(dx, theta)
+            dxa = (X[:,None,:] - Y[None,:,:]).reshape(-1, dim)
+            ra = wendland(dxa, theta).reshape(30, 20)
+            rs = np.zeros([30, 20])
+            rs[i, j] = r
+            self.assertTrue(np.max(np.abs(rs - ra)) < 1.e-14)
+            self.assertEqual(r.shape[0], np.count_nonzero(ra))
+
+            r, dr, d2r = wendland(dx, theta, order=2)
+            self.assertTrue(np.all(np.abs(d2r - d2r.transpose(0, 2, 1)) < 1.e-14))
+            h = 1.e-6
+            for k in range(dim):
+                step = np.zeros(dim)
+                step[k] = h
+                rp, drp = wendland(dx + step, theta, order=1)
+                rm, drm = wendland(dx - step, theta, order=1)
+                self.assertTrue(np.max(np.abs((rp - rm)/(2*h) - dr[:,k])) < 1.e-6)
+                self.assertTrue(np.max(np.abs((drp - drm)/(2*h) - d2r[:,:,k])) < 1.e-5*np.max(np.abs(d2r)))
+
+            # C2 at the origin, with the Hessian -e(e+1) diag(theta)
+            e = dim//2 + 3
+            r, dr, d2r = wendland(np.zeros([1, dim]), theta, order=2)
+            self.assertEqual(r[0], 1.)
+            self.assertTrue(np.max(np.abs(d2r[0] + e*(e + 1)*np.diag(theta))) < 1.e-12)
+
 
 # dim = 2
 # trueFunc = Quad2D(ndim=dim, theta=np.pi/4)